@@ -0,0 +1,52 @@
+import re
+from typing import Dict, FrozenSet, List, Tuple, Union
+
+
+def normalize(text: str) -> str:
+    """ Case-insensitive, whitespace-insensitive form of an utterance / answer """
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def char_ngrams(text: str, n: int = 3) -> FrozenSet[str]:
+    text = f" {text} "
+    return frozenset(text[i:i+n] for i in range(max(1, len(text) - n + 1)))
+
+
+class LexicalAnswerMatcher:
+    """
+    Cheap answer matching tiers, tried before the sentence encoder:
+    1. exact match of the normalized utterance (e.g. button clicks sending the answer text)
+    2. character trigram overlap (Dice coefficient), accepted only if the best answer is clearly ahead of the second best
+    """
+    LEXICAL_THRESHOLD = 0.8 # minimum overlap for a lexical match
+    LEXICAL_MARGIN = 0.2    # minimum distance to the second best answer
+
+    def __init__(self, answer_texts: List[str]) -> None:
+        self.exact: Dict[str, int] = {}
+        self.ngrams: List[Tuple[int, FrozenSet[str]]] = []
+        for index, text in enumerate(answer_texts):
+            normalized = normalize(text)
+            if not normalized:
+                continue
+            self.exact.setdefault(normalized, index) # first answer wins, like argmax over identical embeddings
+            self.ngrams.append((index, char_ngrams(normalized)))
+
+    def match_exact(self, utterance: str) -> Union[int, None]:
+        return self.exact.get(normalize(utterance))
+
+    def match_lexical(self, utterance: str) -> Union[Tuple[int, float], None]:
+        """ (Index, Dice score) of the answer with the highest trigram overlap, if it is unambiguous """
+        normalized = normalize(utterance)
+        if not normalized or not self.ngrams:
+            return None
+        utterance_ngrams = char_ngrams(normalized)
+        best_index, best_score, second_score = None, 0.0, 0.0
+        for index, answer_ngrams in self.ngrams:
+            score = 2.0 * len(utterance_ngrams & answer_ngrams) / (len(utterance_ngrams) + len(answer_ngrams))
+            if score > best_score:
+                best_index, best_score, second_score = index, score, best_score
+            elif score > second_score:
+                second_score = score
+        if best_score >= self.LEXICAL_THRESHOLD and best_score - second_score >= self.LEXICAL_MARGIN:
+            return best_index, best_score
+        return None
@@ -0,0 +1,79 @@
+import asyncio
+from inspect import isawaitable
+from typing import Awaitable, Callable, List, Set, Tuple, Union
+
+import numpy as np
+
+
+class BatchingEncoder:
+    """
+    Collects concurrent `encode` requests (e.g. utterances of different users arriving at the same time) into batches.
+    A batch is encoded once it holds `max_batch_size` texts or `max_wait_ms` milliseconds after its first text arrived,
+    using a single call to `encode_fn` (regular function or coroutine), and each caller receives its own row of the result.
+    """
+    def __init__(self, encode_fn: Callable[[List[str]], Union[np.ndarray, Awaitable[np.ndarray]]], max_batch_size: int = 32, max_wait_ms: float = 5.0) -> None:
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self.pending: List[Tuple[str, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle = None
+        self.tasks: Set[asyncio.Task] = set() # running batches (referenced until done, see `close`)
+        # statistics
+        self.num_batches = 0
+        self.num_texts = 0
+
+    async def encode(self, text: str) -> np.ndarray:
+        """ Returns the embedding of a single text (embedding_dim), encoded together with all other pending texts """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif isinstance(self.timer, type(None)):
+            self.timer = loop.call_later(self.max_wait_ms / 1000.0, self._flush)
+        return await future
+
+    def _flush(self):
+        if not isinstance(self.timer, type(None)):
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            batch = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+            task = asyncio.ensure_future(self._encode_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def close(self):
+        """ Cancel all pending texts and running batches, their callers receive a `CancelledError` """
+        if not isinstance(self.timer, type(None)):
+            self.timer.cancel()
+            self.timer = None
+        for _, future in self.pending:
+            future.cancel()
+        self.pending = []
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def _encode_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        self.num_batches += 1
+        self.num_texts += len(batch)
+        try:
+            embeddings = self.encode_fn([text for text, _ in batch])
+            if isawaitable(embeddings):
+                embeddings = await embeddings
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done(): # caller might have been cancelled in the meantime
+                future.set_result(embedding)
+
+    def average_batch_size(self) -> float:
+        return self.num_texts / self.num_batches if self.num_batches else 0.0
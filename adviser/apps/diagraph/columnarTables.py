@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from apps.diagraph.tableQuery import Column, TextColumn
+
+
+# On-disk layout of a table version (`<root>/<table id>-<content hash>/`):
+#   meta.json          column names + kinds, number of rows
+#   <i>.npy            values of numeric column i
+#   <i>.codes.npy      text column i: int32 index into the dictionary per row (-1: missing)
+#   <i>.dictionary.json sorted distinct texts of column i
+# Versions are immutable (a new content hash gets a new directory), so files can be memory-mapped by any number of processes.
+
+# typed columnar copies of all table versions, shared by all processes (empty: disabled)
+DATA_TABLE_DIR = os.environ.get('DATA_TABLE_DIR', '.data_tables')
+
+
+def table_dir(root: str, table_id: int, content_hash: str) -> str:
+    return os.path.join(root, f"{table_id}-{content_hash}")
+
+
+def write_columns(root: str, table_id: int, content_hash: str, column_names: List[str], columns: Dict[str, Column], num_rows: int) -> str:
+    """
+    Writes a parsed table (see `tableUpload.StreamingTableParser.typed_columns`) to its version directory
+    (atomically, a concurrent writer of the same version wins)
+    """
+    directory = table_dir(root, table_id, content_hash)
+    if os.path.isdir(directory):
+        return directory
+    os.makedirs(root, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=root, prefix=".tmp-")
+    try:
+        meta_columns = []
+        for i, name in enumerate(column_names):
+            values = columns[name]
+            if isinstance(values, TextColumn):
+                np.save(os.path.join(tmp_dir, f"{i}.codes.npy"), values.codes.astype(np.int32, copy=False))
+                with open(os.path.join(tmp_dir, f"{i}.dictionary.json"), "w") as f:
+                    json.dump(values.dictionary, f)
+                meta_columns.append({"name": name, "kind": "text"})
+            else:
+                np.save(os.path.join(tmp_dir, f"{i}.npy"), values)
+                meta_columns.append({"name": name, "kind": "numeric"})
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"columns": meta_columns, "num_rows": num_rows}, f)
+        os.rename(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(directory):
+            raise
+    return directory
+
+
+def read_columns(root: str, table_id: int, content_hash: str) -> Union[Tuple[List[str], Dict[str, Column], int], None]:
+    """
+    Opens a stored table version: (column names, column name -> values, number of rows), or None if it wasn't written yet.
+    Numeric columns and text codes are memory-mapped (shared page cache), texts stay encoded (see `tableQuery.TextColumn`).
+    """
+    directory = table_dir(root, table_id, content_hash)
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    names = []
+    columns = {}
+    for i, column in enumerate(meta["columns"]):
+        names.append(column["name"])
+        if column["kind"] == "numeric":
+            columns[column["name"]] = np.load(os.path.join(directory, f"{i}.npy"), mmap_mode="r")
+        else:
+            codes = np.load(os.path.join(directory, f"{i}.codes.npy"), mmap_mode="r")
+            with open(os.path.join(directory, f"{i}.dictionary.json")) as f:
+                dictionary = json.load(f)
+            columns[column["name"]] = TextColumn(codes, dictionary)
+    return names, columns, meta["num_rows"]
+
+
+def remove_columns(root: str, table_id: int):
+    """ Deletes all stored versions of a table (processes still mapping them keep their copy) """
+    if not os.path.isdir(root):
+        return
+    for entry in os.listdir(root):
+        if entry.startswith(f"{table_id}-"):
+            shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
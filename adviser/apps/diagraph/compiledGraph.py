@@ -0,0 +1,235 @@
+from threading import RLock
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+from apps.diagraph.data.dialogGraph import Answer, DialogGraph, NodeType, SimilarityModelType
+from apps.diagraph.dataTableCache import get_data_table_values, get_data_table_values_many
+from apps.diagraph.graphEvents import GraphChange
+from apps.diagraph.parsers.systemTemplateParser import SystemTemplateParser
+
+
+# sentence embedding model per `DialogGraphSettings.similarity_model`
+# (multilingual graphs keep the model they were always matched with, so stored embeddings stay valid)
+SIMILARITY_MODELS = {
+    SimilarityModelType.MULTILINGUAL: 'distiluse-base-multilingual-cased',
+    SimilarityModelType.ENGLISH: 'sentence-transformers/all-mpnet-base-v2',
+}
+
+
+class CompiledAnswer:
+    """
+    Read-only runtime copy of an `Answer` row.
+    `variable` (variable template) is parsed lazily on first use and then reused.
+    """
+    __slots__ = ('key', 'index', 'text', 'connected_key', 'variable')
+
+    def __init__(self, key: int, index: int, text: str, connected_key: Union[int, None]) -> None:
+        self.key = key
+        self.index = index
+        self.text = text
+        self.connected_key = connected_key
+        self.variable = None
+
+
+class CompiledNode:
+    """
+    Read-only runtime copy of a `DialogNode` row, including its answers (ordered by index).
+    `template` (the compiled markup), `branches` (decision table of logic nodes), `answer_matcher` (lexical answer lookup)
+    and `answer_embeddings` (model name -> answer embedding matrix) are built lazily on first use and then reused.
+    """
+    __slots__ = ('key', 'node_type', 'type_display', 'text', 'markup', 'position_x', 'position_y', 'connected_key', 'answers', 'template', 'branches', 
+                 'answer_matcher', 'answer_embeddings')
+
+    def __init__(self, key: int, node_type: str, text: str, markup: str, position_x: float, position_y: float, connected_key: Union[int, None]) -> None:
+        self.key = key
+        self.node_type = node_type
+        self.type_display = str(NodeType(node_type).label)
+        self.text = text
+        self.markup = markup
+        self.position_x = position_x
+        self.position_y = position_y
+        self.connected_key = connected_key
+        self.answers: Tuple[CompiledAnswer] = ()
+        self.template = None
+        self.branches = None
+        self.answer_matcher = None
+        self.answer_embeddings = {}
+
+    def get_node_type_display(self) -> str:
+        return self.type_display
+
+
+class MacroStep:
+    """
+    Pre-rendered run of consecutive INFO nodes whose markup doesn't depend on the beliefstate or data tables.
+    Traversing the run is equivalent to visiting each of its nodes in order.
+    """
+    __slots__ = ('keys', 'utterances', 'last_key', 'next_key')
+
+    def __init__(self, keys: Tuple[int], utterances: Tuple[Tuple[str, str]], next_key: Union[int, None]) -> None:
+        self.keys = keys # keys of all collapsed nodes (in traversal order)
+        self.utterances = utterances
+        self.last_key = keys[-1]
+        self.next_key = next_key # node following the run (None: end of graph)
+
+
+_static_templates = SystemTemplateParser()
+
+
+class CompiledGraph:
+    """
+    Immutable snapshot of a `DialogGraph` that can be traversed by the dialog policy without any database access.
+    Nodes and answers are indexed by their (graph-unique) keys, connections are stored as target node keys.
+    Macro steps (see `macro_step`) are computed on first use and kept until one of their nodes changes.
+    """
+    __slots__ = ('uuid', 'version', 'model', 'start_key', 'similarity_model', 'nodes', 'answers', 'macros')
+
+    def __init__(self, graph: DialogGraph, version: int, start_key: Union[int, None], similarity_model: str, nodes: Dict[int, CompiledNode], answers: Dict[int, CompiledAnswer], 
+                    macros: Dict[int, Union[MacroStep, None]] = None) -> None:
+        self.uuid = str(graph.uuid)
+        self.version = version
+        self.model = graph
+        self.start_key = start_key
+        self.similarity_model = similarity_model # name of the sentence embedding model (see `DialogGraphSettings`)
+        self.nodes = nodes
+        self.answers = answers
+        self.macros = {} if isinstance(macros, type(None)) else macros # node key -> macro step starting at this node (None: not collapsible)
+
+    @staticmethod
+    def _load_nodes(graph: DialogGraph, node_keys: Union[Iterable[int], None] = None) -> Tuple[Dict[int, CompiledNode], Dict[int, CompiledAnswer]]:
+        """ Load all nodes (or only the nodes with the given keys) of a graph including their answers in 2 queries """
+        node_rows = graph.nodes.all()
+        answer_rows = Answer.objects.filter(node__graph=graph)
+        if not isinstance(node_keys, type(None)):
+            node_rows = node_rows.filter(key__in=node_keys)
+            answer_rows = answer_rows.filter(node__key__in=node_keys)
+
+        nodes = {}
+        for key, node_type, text, markup, position_x, position_y, connected_key in node_rows.values_list('key', 'node_type', 'text', 'markup', 'position_x', 'position_y', 'connected_node__key'):
+            nodes[key] = CompiledNode(key=key, node_type=node_type, text=text, markup=markup, position_x=position_x, position_y=position_y, connected_key=connected_key)
+
+        answers = {}
+        answers_by_node = {}
+        for key, index, text, node_key, connected_key in answer_rows.order_by('index').values_list('key', 'index', 'text', 'node__key', 'connected_node__key'):
+            answer = CompiledAnswer(key=key, index=index, text=text, connected_key=connected_key)
+            answers[key] = answer
+            answers_by_node.setdefault(node_key, []).append(answer)
+        for node_key, node_answers in answers_by_node.items():
+            nodes[node_key].answers = tuple(node_answers)
+        return nodes, answers
+
+    @classmethod
+    def from_db(cls, graph_id: str) -> "CompiledGraph":
+        """ Load a graph in a fixed number of queries (graph + settings, nodes, answers), independent of the graph size """
+        graph: DialogGraph = DialogGraph.objects.select_related('first_node', 'settings').get(uuid=graph_id)
+        nodes, answers = cls._load_nodes(graph)
+        start_key = graph.first_node.key if graph.first_node else None
+        similarity_model = SIMILARITY_MODELS[SimilarityModelType(graph.settings.similarity_model)]
+        return cls(graph=graph, version=graph.version, start_key=start_key, similarity_model=similarity_model, nodes=nodes, answers=answers)
+
+    def patched(self, node_keys: Iterable[int], version: int) -> "CompiledGraph":
+        """ Copy of this graph where only the given nodes (and their answers) are reloaded, all other records are shared """
+        node_keys = set(node_keys)
+        stale_answers = set(answer.key for key in node_keys if key in self.nodes for answer in self.nodes[key].answers)
+        nodes = {key: node for key, node in self.nodes.items() if not key in node_keys}
+        answers = {key: answer for key, answer in self.answers.items() if not key in stale_answers}
+        changed_nodes, changed_answers = self._load_nodes(self.model, node_keys)
+        nodes.update(changed_nodes)
+        answers.update(changed_answers)
+        # keep macro steps not containing (or leading to) any of the changed nodes
+        macros = {key: macro for key, macro in self.macros.items() 
+                        if not key in node_keys and (isinstance(macro, type(None)) or node_keys.isdisjoint(macro.keys + (macro.next_key,)))}
+        return CompiledGraph(graph=self.model, version=version, start_key=self.start_key, similarity_model=self.similarity_model, nodes=nodes, answers=answers, macros=macros)
+
+    def node(self, key: Union[int, str, None]) -> Union[CompiledNode, None]:
+        if key is None:
+            return None
+        return self.nodes.get(int(key))
+
+    def get_start_node(self) -> Union[CompiledNode, None]:
+        return self.node(self.start_key)
+
+    def macro_step(self, key: int) -> Union[MacroStep, None]:
+        """
+        Returns the run of static INFO nodes starting at the given node (or None if that node is not a static INFO node).
+        The run ends before the first node that needs the beliefstate, data tables or user input, and before revisiting a node (cycles).
+        """
+        if key in self.macros:
+            return self.macros[key]
+
+        # walk the chain until a node that is not static (or already has a macro step)
+        chain: List[CompiledNode] = []
+        utterances = []
+        visited = set()
+        node = self.nodes.get(key)
+        while not isinstance(node, type(None)) and not node.key in visited and not node.key in self.macros:
+            if node.node_type != NodeType.INFO:
+                break
+            text = _static_templates.render_static(node.markup)
+            if isinstance(text, type(None)):
+                break
+            visited.add(node.key)
+            chain.append(node)
+            utterances.append((text, node.get_node_type_display()))
+            node = self.node(node.connected_key)
+        if not chain:
+            self.macros[key] = None
+            return None
+
+        # every suffix of the chain is a macro step as well
+        tail = self.macros.get(chain[-1].connected_key) if chain[-1].connected_key in self.macros and not chain[-1].connected_key in visited else None
+        keys = tail.keys if tail else ()
+        rendered = tail.utterances if tail else ()
+        next_key = tail.next_key if tail else chain[-1].connected_key
+        for node, utterance in zip(reversed(chain), reversed(utterances)):
+            keys = (node.key,) + keys
+            rendered = (utterance,) + rendered
+            self.macros[node.key] = MacroStep(keys=keys, utterances=rendered, next_key=next_key)
+        return self.macros[key]
+
+    def get_data_table_values(self, table_name: str, column_constraints: Dict[str, Any] = {}, return_columns: Union[None, List[str]] = None) -> List[Dict[str, Any]]:
+        return get_data_table_values(self.uuid, table_name, column_constraints, return_columns)
+
+    def get_data_table_values_many(self, table_name: str, constraint_sets: List[Dict[str, Any]], return_columns: Union[None, List[str]] = None) -> List[List[Dict[str, Any]]]:
+        return get_data_table_values_many(self.uuid, table_name, constraint_sets, return_columns)
+
+
+class CompiledGraphCache:
+    """
+    Process-wide cache of compiled graphs (graph uuid -> `CompiledGraph`).
+    Graphs are compiled on first access and shared between all users and services of the process.
+    Changed nodes are reloaded lazily on the next access (see `apply_change`).
+    """
+    def __init__(self) -> None:
+        self.lock = RLock()
+        self.graphs: Dict[str, CompiledGraph] = {}
+        self.stale: Dict[str, Tuple[int, Set[int]]] = {} # graph uuid -> (latest version, keys of changed nodes)
+
+    def get(self, graph_id: str) -> CompiledGraph:
+        graph_id = str(graph_id)
+        with self.lock:
+            if not graph_id in self.graphs:
+                self.graphs[graph_id] = CompiledGraph.from_db(graph_id)
+            elif graph_id in self.stale:
+                version, node_keys = self.stale.pop(graph_id)
+                self.graphs[graph_id] = self.graphs[graph_id].patched(node_keys, version)
+            return self.graphs[graph_id]
+
+    def invalidate(self, graph_id: str):
+        with self.lock:
+            self.graphs.pop(str(graph_id), None)
+            self.stale.pop(str(graph_id), None)
+
+    def apply_change(self, change: GraphChange):
+        """ Mark the nodes touched by a change as stale (or drop the whole graph on reload); ignores already applied versions """
+        with self.lock:
+            graph = self.graphs.get(change.graph_id)
+            if isinstance(graph, type(None)) or graph.version >= change.version:
+                return
+            if change.reload:
+                self.invalidate(change.graph_id)
+            elif change.nodes:
+                version, node_keys = self.stale.get(change.graph_id, (graph.version, set()))
+                self.stale[change.graph_id] = (max(version, change.version), node_keys.union(change.nodes))
+
+
+compiled_graphs = CompiledGraphCache()
@@ -1,12 +1,10 @@
-from io import StringIO
+import hashlib
 import random
 import time
 from typing import Any, Dict, List, Union
-import warnings
-import pandas
-from io import StringIO
 import uuid
 
+from apps.diagraph.columnarTables import DATA_TABLE_DIR, remove_columns
 from apps.diagraph.utils import html_to_raw_text
 from django.utils.translation import gettext_lazy as _
 
@@ -44,10 +42,19 @@ class NodeType(models.TextChoices):
         app_label = "data"
 
 
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
 class DataTable(models.Model):
     graph = models.ForeignKey("DialogGraph", on_delete=models.CASCADE, related_name="tables")
     name = models.TextField()
     content = models.TextField() # csv file
+    content_hash = models.CharField(max_length=40, default="") # sha1 of content, identifies the table version (see `apps.diagraph.dataTableCache`)
+
+    def save(self, *args, **kwargs):
+        self.content_hash = content_hash(self.content)
+        super().save(*args, **kwargs)
 
     class Meta:
         app_label = 'data'
@@ -166,13 +173,20 @@ class DialogGraph(models.Model):
     name = models.TextField()
     first_node = models.OneToOneField(DialogNode, null=True, on_delete=models.SET_NULL, default=None)
     settings = models.OneToOneField(DialogGraphSettings, on_delete=models.CASCADE, default=None)
+    version = models.BigIntegerField(default=0) # incremented on every change to the graph's content (see `bump_version`)
 
     class Meta:
         app_label = 'data'
 
+    def bump_version(self) -> int:
+        """ Atomically increment the graph version and return the new value """
+        DialogGraph.objects.filter(uuid=self.uuid).update(version=models.F('version') + 1)
+        self.version = DialogGraph.objects.values_list('version', flat=True).get(uuid=self.uuid)
+        return self.version
+
     def get_data_table_values(self, table_name: str, column_constraints: Dict[str, Any] = {}, return_columns: Union[None, List[str]] = None) -> List[Dict[str, Any]]:
         """
-        Perform lookip in data table.
+        Perform lookup in data table (parsed tables are cached, see `apps.diagraph.dataTableCache`).
 
         Args:
             column_constraints: provide exact matching values matching rows have to fulfill
@@ -180,81 +194,81 @@ class DialogGraph(models.Model):
         Returns:
             list of all rows (including only the subset of columns specified in return_columns) satisfying the constraints
         """
-        if not self.tables.filter(name=table_name).exists():
-            warnings.warn("Data table", table_name, "not found")
-            return []
-
-        # load and parse table
-        csv_file = StringIO(self.tables.get(name=table_name).content)
-        table = pandas.read_csv(csv_file, delimiter=";")     
-
-        # create list of row indices (start: all rows are candidates)
-        if len(table) == 0:
-            warnings.warn("Data table", table_name, "is empty")
-            return []
-       
-        results = table.query(" and ".join([f"{col} == {column_constraints[col]}" for col in column_constraints]))        
-        # construct list of return columns
-        result_cols = return_columns if return_columns else list(table.keys())
-        return [{col: row[1][col] for col in result_cols} for row in results[result_cols].iterrows()]
+        from apps.diagraph.dataTableCache import get_data_table_values
+        return get_data_table_values(self.uuid, table_name, column_constraints, return_columns)
 
     def get_start_node(self) -> Union[None, DialogNode]:
         return self.first_node
 
     def copyToUser(self, user: User):
-        default_settings = DialogGraphSettings()
-        default_settings.save()
-        graph = DialogGraph(owner=user, name=self.name, settings=default_settings)
-        graph.save()
-
-        for node in self.nodes.all():
-            newNode = DialogNode(key=node.key, graph=graph, node_type=node.node_type, text=node.text, markup=node.markup, position_x=node.position_x, position_y=node.position_y)
-            newNode.save()
-            for answer in node.answers.all():
-                newAnswer = Answer(key=answer.key, node=newNode, index=answer.index, text=answer.text)
-                newAnswer.save()
-            for question in node.questions.all():
-                newQuestion = Question(key=question.key, node=newNode, text=question.text)
-                newQuestion.save()
-
-        for node in self.nodes.all():
-            if not isinstance(node.connected_node, type(None)):
-                newNode = graph.nodes.get(key=node.key)
-                newNode.connected_node = graph.nodes.get(key=node.connected_node.key)
-                newNode.save()
-            for answer in node.answers.all():
-                if not isinstance(answer.connected_node, type(None)):
-                    newAnswer = graph.nodes.get(key=node.key).answers.get(key=answer.key)
-                    newAnswer.connected_node = graph.nodes.get(key=answer.connected_node.key)
-                    newAnswer.save()
-
-        # TODO copy data tables
-        graph.first_node = graph.nodes.get(key=self.first_node.key)
-        graph.save()
+        """
+        Copy this graph (nodes, answers, FAQ questions, tags and data tables) to the given user.
+        Rows are copied with one `bulk_create` per table (keys stay the same, foreign keys are remapped), inside one transaction.
+        """
+        with transaction.atomic():
+            default_settings = DialogGraphSettings()
+            default_settings.save()
+            graph = DialogGraph(owner=user, name=self.name, settings=default_settings)
+            graph.save()
 
-    def clear_nodes(self, delete_start_node: bool = True):
-        for node in self.nodes.all():
-            node.connected_node = None
-            node.save()
-            for incoming in node.incoming_nodes.all():
-                incoming.connected_node = None
-                incoming.save()
-            for answer in node.answers.all():
-                answer.connected_node = None
-                answer.save()
-                answer.delete()
-            for answer in node.incoming_answers.all():
-                answer.connected_node = None
-                answer.save()
-            if node.key != self.first_node.key:
-                node.delete()
-            elif delete_start_node:
-                # only delete start node if whole graph should be deleted
-                node.delete()
+            tags = {tag.pk: Tag(key=tag.key, color=tag.color, graph=graph) for tag in self.tags.all()}
+            Tag.objects.bulk_create(tags.values())
+
+            # old node pk -> copy
+            nodes = {}
+            old_connections = {}
+            for node in self.nodes.all():
+                nodes[node.pk] = DialogNode(key=node.key, graph=graph, node_type=node.node_type, text=node.text, markup=node.markup, 
+                                            position_x=node.position_x, position_y=node.position_y)
+                if not isinstance(node.connected_node_id, type(None)):
+                    old_connections[node.pk] = node.connected_node_id
+            DialogNode.objects.bulk_create(nodes.values())
+            for old_pk, connected_pk in old_connections.items():
+                nodes[old_pk].connected_node = nodes[connected_pk]
+            DialogNode.objects.bulk_update([nodes[old_pk] for old_pk in old_connections], ['connected_node'])
+
+            Answer.objects.bulk_create([Answer(key=answer.key, node=nodes[answer.node_id], index=answer.index, text=answer.text,
+                                               connected_node=nodes[answer.connected_node_id] if not isinstance(answer.connected_node_id, type(None)) else None)
+                                        for answer in Answer.objects.filter(node__graph=self)])
+            Question.objects.bulk_create([Question(key=question.key, node=nodes[question.node_id], text=question.text)
+                                          for question in Question.objects.filter(node__graph=self)])
+            Through = DialogNode.tags.through
+            Through.objects.bulk_create([Through(dialognode_id=nodes[link.dialognode_id].pk, tag_id=tags[link.tag_id].pk)
+                                         for link in Through.objects.filter(dialognode__graph=self)])
+
+            tables = {table.pk: DataTable(graph=graph, name=table.name, content=table.content, content_hash=table.content_hash or content_hash(table.content))
+                      for table in self.tables.all()}
+            DataTable.objects.bulk_create(tables.values())
+            DataTableColumn.objects.bulk_create([DataTableColumn(table=tables[column.table_id], label=column.label)
+                                                 for column in DataTableColumn.objects.filter(table__graph=self)])
+
+            graph.first_node = nodes[self.first_node_id] if not isinstance(self.first_node_id, type(None)) else None
+            graph.save(update_fields=['first_node'])
+        return graph
 
+    def clear_nodes(self, delete_start_node: bool = True):
+        """ Delete all answers and nodes (except the start node, if `delete_start_node` is False) in a fixed number of queries """
+        Answer.objects.filter(node__graph=self).delete()
+        self.nodes.update(connected_node=None)
+        nodes = self.nodes.all()
+        if not delete_start_node and not isinstance(self.first_node, type(None)):
+            nodes = nodes.exclude(key=self.first_node.key)
+        nodes.delete()
+
+    def clear_tables(self):
+        """ Delete all data tables, their columnar copies (see `apps.diagraph.columnarTables`) are removed once the deletion is committed """
+        table_ids = list(self.tables.values_list('id', flat=True))
+        self.tables.all().delete()
+        if DATA_TABLE_DIR and table_ids:
+            transaction.on_commit(lambda: [remove_columns(DATA_TABLE_DIR, table_id) for table_id in table_ids])
 
     @classmethod
     def fromJSON(cls, graph_name: str, owner: User, data: str):
+        """
+        Import a graph exported by `toJSON` (replaces the content of the owner's graph with the same name, if there is one).
+        All rows are written with one `bulk_create` / `bulk_update` per table, so the number of queries doesn't depend on the graph size
+        (apart from batching of very large graphs, see `tools/benchmark_graph_import.py`).
+        """
         with transaction.atomic():
             nodes_by_key = {}
             answers_by_key = {}
@@ -265,87 +279,94 @@ class DialogGraph(models.Model):
             print("IMPORTING...")
 
             # clear existing values 
-            if cls.objects.filter(name=graph_name, owner=owner).exists():
-                graph = cls.objects.get(name=graph_name, owner=owner)
-                graph.first_node.delete()
-                graph.clear_nodes(delete_start_node=False)
+            graph = cls.objects.filter(name=graph_name, owner=owner).first()
+            replaced = not isinstance(graph, type(None))
+            if replaced:
+                graph.first_node = None
+                graph.save(update_fields=['first_node'])
+                graph.clear_nodes()
                 graph.logs.all().delete()
-                graph.tables.all().delete()
+                graph.clear_tables()
                 graph.tags.all().delete()
             else:
                 # create new graph
                 default_settings = DialogGraphSettings()
                 default_settings.save()
                 graph = cls(owner=owner, name=graph_name, settings=default_settings) 
+                graph.save()
             
             for tag_json in data['tags']:
                 tag = Tag(key=tag_json['id'], color=tag_json['color'], graph=graph)
                 tag_by_key[tag_json['id']] = tag
             Tag.objects.bulk_create(tag_by_key.values())
+
+            # create all nodes first (answers and connections can link to any node)
             for dialognode_json in data['nodes']:
-                # parse node info (have to create all nodes before we can create the answers because they can be linked to otherwise not yet existing nodes)
-                node = None
                 content_markup = dialognode_json['data']['markup']
-                content_text = html_to_raw_text(content_markup)
                 node_type_realname = dialognode_json['type']
-              
                 node = DialogNode(key=dialognode_json['id'], graph=graph,
                                 node_type=NodeType.from_real_value(node_type_realname), 
-                                text=content_text, markup=content_markup,
+                                text=html_to_raw_text(content_markup), markup=content_markup,
                                 position_x=dialognode_json['position']['x'], position_y=dialognode_json['position']['y']
                         )
-                node.save()
                 if node_type_realname == "startNode":
                     start_node = node
-                
                 assert not node.key in nodes_by_key, f"Node {node.key} already in dataset"
                 nodes_by_key[dialognode_json['id']] = node
+            DialogNode.objects.bulk_create(nodes_by_key.values())
 
-                ansewers_to_create = []
+            answers = []
+            tag_links = {}
+            for dialognode_json in data['nodes']:
+                node = nodes_by_key[dialognode_json['id']]
                 for index, answer_json in enumerate(dialognode_json['data']['answers']):
-                    # parse answer info and add to created nodes
-                    answer = Answer(key=answer_json['id'], node=node,
-                                        text=html_to_raw_text(answer_json['text']),
-                                        index=index) # store answers in correct order
+                    # store answers in correct order
+                    answer = Answer(key=answer_json['id'], node=node, text=html_to_raw_text(answer_json['text']), index=index)
                     answers_by_key[answer_json['id']] = answer
-                    ansewers_to_create.append(answer)
-                Answer.objects.bulk_create(ansewers_to_create)
-                
-                faqs_to_create = []
+                    answers.append(answer)
                 for faq_json in dialognode_json['data']['questions']:
                     question = Question(key=faq_json['id'],text=faq_json['text'], node=node)
                     assert not question.key in questions_by_key, f"Question {question.key} already in dataset"
                     questions_by_key[faq_json['id']] = question
-                    faqs_to_create.append(question)
-                Question.objects.bulk_create(faqs_to_create)
-
                 for tag_id in dialognode_json['data']['tags']:
-                    node.tags.add(tag_by_key[tag_id])
-            
-            # parse connections
+                    tag_links[(node.pk, tag_by_key[tag_id].pk)] = DialogNode.tags.through(dialognode_id=node.pk, tag_id=tag_by_key[tag_id].pk)
+
+            # parse connections (answers are created afterwards, including their connection)
+            connected_nodes = {}
             for connection in data['connections']:
                 fromDialogNode = nodes_by_key[connection['source']]
                 if fromDialogNode.node_type in [NodeType.INFO,  NodeType.START, NodeType.UPDATE]:
                     fromDialogNode.connected_node = nodes_by_key[connection['target']]
-                    fromDialogNode.save()
+                    connected_nodes[fromDialogNode.key] = fromDialogNode
                 else:
                     fromDialogAnswer = answers_by_key[connection['sourceHandle']]
                     fromDialogAnswer.connected_node = nodes_by_key[connection['target']]
-                    fromDialogAnswer.save()
+
+            Answer.objects.bulk_create(answers)
+            Question.objects.bulk_create(questions_by_key.values())
+            DialogNode.tags.through.objects.bulk_create(tag_links.values())
+            DialogNode.objects.bulk_update(connected_nodes.values(), ['connected_node'])
 
             assert not isinstance(start_node, type(None))
             graph.first_node = start_node
-            graph.save()
+            # only the changed field is written, the version is incremented atomically (concurrent `bump_version` calls aren't lost)
+            graph.save(update_fields=['first_node'])
+            if replaced:
+                graph.bump_version() # invalidates cached exports (see `views.graphs.load_graph`)
 
             return graph
 
     def toJSON(self) -> Dict[str, Any]:
+        """ Export the graph for the dialog designer (a fixed number of queries: nodes, answers, questions, tags, tables and columns are prefetched) """
         nodes = []
         connections = []
         faqquestions = []
         tags = [{'id': tag.key, 'color': tag.color} for tag in self.tags.all()]
         tables = []
-        for dialog_node in self.nodes.all():
+        dialog_nodes = self.nodes.select_related('connected_node').prefetch_related(
+            models.Prefetch('answers', queryset=Answer.objects.select_related('connected_node').order_by('index')),
+            'questions', 'tags')
+        for dialog_node in dialog_nodes:
             answers = []
             faqquestions = []
             if dialog_node.node_type in [NodeType.START, NodeType.INFO, NodeType.UPDATE] and dialog_node.connected_node:
@@ -353,7 +374,7 @@ class DialogGraph(models.Model):
                 nodeId = "0" if dialog_node.node_type == NodeType.START else str(int(time.time())) + str(random.randint(1000,9999))
                 connections.append({'id': nodeId, "source": str(dialog_node.key), "sourceHandle": str(dialog_node.key), "target": str(dialog_node.connected_node.key), 'targetHandle': None})
             else:
-                for answer in dialog_node.answers.order_by('index'): # add answers in correct order
+                for answer in dialog_node.answers.all(): # add answers in correct order (see prefetch)
                     answers.append({
                         'id': str(answer.key),
                         'nodeId': str(dialog_node.key),
@@ -396,7 +417,7 @@ class DialogGraph(models.Model):
                 },
             })
         
-        for table in self.tables.all():
+        for table in self.tables.prefetch_related('columns'):
             tables.append({
                 "name": table.name,
                 "columns": [col.label for col in table.columns.all()]
@@ -418,7 +439,6 @@ def init_new_user(instance, created, raw, **kwargs):
             tutorial_graph.copyToUser(instance) # instance = new user
 
     
-# TODO on any of the above changes, trigger reload of dialog policy (let policy handle replay? or add dialog buffer as service, and this service can trigger replay from memory)
 # TODO add logger as a service insteaed of logger instances per service (this also allows easier collection of distributed logging)
 # TODO add UI + service to live change NLU 
 # TODO add divider line to chat UI 
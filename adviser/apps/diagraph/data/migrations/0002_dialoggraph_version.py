@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialoggraph',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
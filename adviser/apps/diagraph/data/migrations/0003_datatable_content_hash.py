@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:05
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_contents(apps, schema_editor):
+    DataTable = apps.get_model('data', 'DataTable')
+    for table in DataTable.objects.all().only('id', 'content'):
+        DataTable.objects.filter(id=table.id).update(content_hash=hashlib.sha1(table.content.encode("utf-8")).hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0002_dialoggraph_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datatable',
+            name='content_hash',
+            field=models.CharField(default='', max_length=40),
+        ),
+        migrations.RunPython(hash_contents, migrations.RunPython.noop),
+    ]
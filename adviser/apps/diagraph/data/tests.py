@@ -0,0 +1,48 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from data.dialogGraph import DialogGraph, NodeType
+
+
+def make_graph(num_nodes: int) -> dict:
+    """ Graph export (see `DialogGraph.toJSON`): start node, then a chain of user response nodes with two answers, a FAQ question and a tag each """
+    nodes = [{"id": "0", "type": "startNode", "position": {"x": 0, "y": 0}, "data": {"markup": "<p>START</p>", "answers": [], "questions": [], "tags": []}}]
+    connections = [{"source": "0", "sourceHandle": None, "target": "1"}]
+    for key in range(1, num_nodes + 1):
+        nodes.append({"id": str(key), "type": "userResponseNode", "position": {"x": 100 * key, "y": 0},
+                      "data": {"markup": f"<p>Question {key}?</p>",
+                               "answers": [{"id": str(10 * key + 1), "text": "Yes"}, {"id": str(10 * key + 2), "text": "No"}],
+                               "questions": [{"id": str(10 * key + 3), "text": f"FAQ {key}"}],
+                               "tags": ["tag"]}})
+        if key < num_nodes:
+            connections.append({"source": str(key), "sourceHandle": str(10 * key + 1), "target": str(key + 1)})
+    return {"nodes": nodes, "connections": connections, "tags": [{"id": "tag", "color": "#FF595E"}]}
+
+
+class GraphImportQueriesTest(TestCase):
+    """
+    `DialogGraph.fromJSON` writes every table with one bulk query, so the number of queries doesn't depend on the graph size.
+    The larger graph still fits into a single batch on SQLite (999 query parameters), see `tools/benchmark_graph_import.py` for real graphs.
+    """
+    IMPORT_QUERIES = 12     # new graph
+    REIMPORT_QUERIES = 29   # replaces the content of an existing graph (and increments its version)
+
+    def setUp(self):
+        self.owner = User.objects.create(username="graph_import_test")
+
+    def test_query_count_independent_of_graph_size(self):
+        for num_nodes in (3, 60):
+            with self.subTest(num_nodes=num_nodes):
+                data = make_graph(num_nodes)
+                graph_name = f"graph_{num_nodes}"
+                with self.assertNumQueries(self.IMPORT_QUERIES):
+                    version = DialogGraph.fromJSON(graph_name=graph_name, owner=self.owner, data=data).version
+                with self.assertNumQueries(self.REIMPORT_QUERIES):
+                    DialogGraph.fromJSON(graph_name=graph_name, owner=self.owner, data=data)
+
+                graph = DialogGraph.objects.get(name=graph_name, owner=self.owner)
+                self.assertEqual(graph.version, version + 1)
+                self.assertEqual(graph.nodes.count(), num_nodes + 1)
+                self.assertEqual(graph.first_node.node_type, NodeType.START)
+                self.assertEqual(graph.nodes.filter(answers__connected_node__isnull=False).count(), num_nodes - 1)
+                self.assertEqual(graph.nodes.filter(tags__key="tag").count(), num_nodes)
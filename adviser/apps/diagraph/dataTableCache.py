@@ -0,0 +1,181 @@
+from collections import OrderedDict
+import os
+import traceback
+from threading import RLock
+from typing import Any, Dict, List, Set, Tuple, Union
+import warnings
+
+from apps.diagraph.columnarTables import DATA_TABLE_DIR, read_columns, write_columns
+from apps.diagraph.data.dialogGraph import DataTable, content_hash
+from apps.diagraph.graphEvents import GraphChange
+from apps.diagraph.tableQuery import Column, ColumnIndex, Predicate, TableQuery, predicates_from_constraints
+from apps.diagraph.tableUpload import StreamingTableParser
+
+
+def parse_table(content: str) -> StreamingTableParser:
+    """ Parses the CSV content of a `DataTable` (column types are inferred like on upload, see `StreamingTableParser`) """
+    parser = StreamingTableParser()
+    parser.feed(content)
+    parser.close()
+    return parser
+
+
+class ParsedTable:
+    """
+    Parsed, column-typed content of a `DataTable` row, stored as one NumPy array per column (texts dictionary encoded, see `tableQuery.TextColumn`).
+    Lookups are evaluated by `tableQuery.TableQuery` using per-column indices (built on first use and kept with the table).
+    """
+    __slots__ = ('table_id', 'content_hash', 'column_names', 'columns', 'num_rows', 'indices')
+
+    def __init__(self, table_id: int, content_hash: str, column_names: List[str], columns: Dict[str, Column], num_rows: int) -> None:
+        self.table_id = table_id
+        self.content_hash = content_hash
+        self.column_names = column_names
+        self.columns = columns
+        self.num_rows = num_rows
+        self.indices: Dict[str, ColumnIndex] = {}
+
+    @classmethod
+    def from_parser(cls, table_id: int, content_hash: str, parser: StreamingTableParser) -> "ParsedTable":
+        columns = parser.typed_columns()
+        return cls(table_id=table_id, content_hash=content_hash, column_names=list(columns.keys()), columns=columns, num_rows=parser.num_rows)
+
+    def query(self, column_constraints: Union[Dict[str, Any], List[Predicate]] = {}, return_columns: Union[None, List[str]] = None) -> List[Dict[str, Any]]:
+        """
+        All rows (projected to `return_columns`, or all columns if None) matching the given constraints.
+        Constraints are either predicates or a dict column -> value (equality) / (operator, value), e.g. `{"age": (">=", 18)}`.
+        """
+        return self.query_many([column_constraints], return_columns)[0]
+
+    def query_many(self, constraint_sets: List[Union[Dict[str, Any], List[Predicate]]], return_columns: Union[None, List[str]] = None) -> List[List[Dict[str, Any]]]:
+        """ Batch version of `query`: results for each constraint set, predicates shared between the sets are evaluated once """
+        engine = TableQuery(self.columns, self.num_rows, self.indices)
+        result_cols = return_columns if return_columns else self.column_names
+        constraint_sets = [predicates_from_constraints(constraints) if isinstance(constraints, dict) else constraints for constraints in constraint_sets]
+        return [engine.project(rows, result_cols) for rows in engine.select_many(constraint_sets)]
+
+
+# maximum number of parsed tables kept per process (least recently used ones are dropped)
+DATA_TABLE_CACHE_SIZE = int(os.environ.get('DATA_TABLE_CACHE_SIZE', 64))
+
+
+class DataTableCache:
+    """
+    Process-wide cache of parsed data tables.
+    Per graph, table names are resolved to (table id, content hash) once (unknown names to None, so missing tables aren't looked up every turn);
+    parsed tables are keyed by (table id, content hash), so a table is parsed only once per content, at most `max_tables` are kept (LRU).
+    Kept up to date by `graph.changed` events of the dialog designer
+    (`on_datatable_import`, `on_datatable_name_changed`, `on_datatable_delete`, see `apply_change`).
+
+    If `columnar_dir` is set, tables are opened from their memory-mapped columnar copy (written on import, see `store`),
+    so worker processes share one copy in the page cache and don't parse any CSV; missing copies are written on first use.
+    """
+    def __init__(self, columnar_dir: str = DATA_TABLE_DIR, max_tables: int = DATA_TABLE_CACHE_SIZE) -> None:
+        self.lock = RLock()
+        self.columnar_dir = columnar_dir
+        self.max_tables = max_tables
+        self.names: Dict[str, Dict[str, Union[Tuple[int, str], None]]] = {} # graph uuid -> table name -> (table id, content hash) / None: no such table
+        self.tables: Dict[Tuple[int, str], ParsedTable] = OrderedDict() # least recently used first
+
+    def get(self, graph_id: str, table_name: str) -> Union[ParsedTable, None]:
+        """ The parsed table named `table_name` of the given graph (None if the graph has no such table) """
+        graph_id = str(graph_id)
+        with self.lock:
+            names = self.names.setdefault(graph_id, {})
+            content = None
+            if not table_name in names:
+                rows = list(DataTable.objects.filter(graph_id=graph_id, name=table_name).values_list('id', 'content_hash')[:2])
+                if not rows:
+                    names[table_name] = None
+                    return None
+                if len(rows) > 1:
+                    raise DataTable.MultipleObjectsReturned(f"Data table {table_name} is not unique")
+                table_id, table_hash = rows[0]
+                if not table_hash:
+                    # not hashed yet (created with `bulk_create`)
+                    content = DataTable.objects.values_list('content', flat=True).get(id=table_id)
+                    table_hash = content_hash(content)
+                names[table_name] = (table_id, table_hash)
+            key = names[table_name]
+            if isinstance(key, type(None)):
+                return None
+            if key in self.tables:
+                self.tables.move_to_end(key)
+            else:
+                self.tables[key] = self._load(key[0], key[1], content)
+                while len(self.tables) > max(self.max_tables, 1):
+                    self.tables.popitem(last=False)
+            return self.tables[key]
+
+    def _load(self, table_id: int, table_hash: str, content: Union[str, None]) -> ParsedTable:
+        stored = read_columns(self.columnar_dir, table_id, table_hash) if self.columnar_dir else None
+        if isinstance(stored, type(None)):
+            if isinstance(content, type(None)):
+                content = DataTable.objects.values_list('content', flat=True).get(id=table_id)
+            parser = parse_table(content)
+            if not self.store(table_id, table_hash, parser):
+                return ParsedTable.from_parser(table_id=table_id, content_hash=table_hash, parser=parser)
+            stored = read_columns(self.columnar_dir, table_id, table_hash)
+        column_names, columns, num_rows = stored
+        return ParsedTable(table_id=table_id, content_hash=table_hash, column_names=column_names, columns=columns, num_rows=num_rows)
+
+    def store(self, table_id: int, table_hash: str, parser: StreamingTableParser) -> bool:
+        """
+        Write the columnar copy of a table version from its parsed cells (called on upload, so the CSV isn't parsed again),
+        failures only disable the copy. Returns whether the copy exists.
+        """
+        if not self.columnar_dir:
+            return False
+        try:
+            write_columns(self.columnar_dir, table_id, table_hash, parser.columns, parser.typed_columns(), parser.num_rows)
+            return True
+        except:
+            print("Could not store columnar copy of data table", table_id)
+            traceback.print_exc()
+            return False
+
+    def apply_change(self, change: GraphChange):
+        """ Forget the name lookups of a graph whose tables changed, and drop the parsed versions of changed / deleted tables """
+        with self.lock:
+            if not (change.reload or change.tables):
+                return
+            names = self.names.pop(change.graph_id, {})
+            table_ids: Set[int] = set(change.tables)
+            if change.reload:
+                table_ids.update(key[0] for key in names.values() if not isinstance(key, type(None)))
+            for key in [key for key in self.tables if key[0] in table_ids]:
+                del self.tables[key]
+
+
+def _get_table(graph_id: str, table_name: str) -> Union[ParsedTable, None]:
+    table = data_tables.get(graph_id, table_name)
+    if isinstance(table, type(None)):
+        warnings.warn(f"Data table {table_name} not found")
+        return None
+    if table.num_rows == 0:
+        warnings.warn(f"Data table {table_name} is empty")
+        return None
+    return table
+
+
+def get_data_table_values(graph_id: str, table_name: str, column_constraints: Union[Dict[str, Any], List[Predicate]] = {}, return_columns: Union[None, List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Perform lookup in a data table of the given graph.
+
+    Args:
+        column_constraints: provide values matching rows have to fulfill (column -> value or (operator, value)), or a list of predicates
+        return_columns: provide column names whose values should be returned (or None, if all columns should be returned)
+    Returns:
+        list of all rows (including only the subset of columns specified in return_columns) satisfying the constraints
+    """
+    table = _get_table(graph_id, table_name)
+    return table.query(column_constraints, return_columns) if not isinstance(table, type(None)) else []
+
+
+def get_data_table_values_many(graph_id: str, table_name: str, constraint_sets: List[Union[Dict[str, Any], List[Predicate]]], return_columns: Union[None, List[str]] = None) -> List[List[Dict[str, Any]]]:
+    """ Batch version of `get_data_table_values`: one result list per constraint set """
+    table = _get_table(graph_id, table_name)
+    return table.query_many(constraint_sets, return_columns) if not isinstance(table, type(None)) else [[] for _ in constraint_sets]
+
+
+data_tables = DataTableCache()
@@ -1,13 +1,15 @@
 from enum import Enum
 import logging
 import traceback
-from attr import dataclass
 from typing import Dict, List, Tuple
 
-from sentence_transformers import SentenceTransformer
 from django.utils.html import strip_tags
 
-from apps.diagraph.data.dialogGraph import Answer, DialogNode, DialogGraph, NodeType, ConversationLogEntry
+from apps.diagraph.data.dialogGraph import DialogNode, NodeType, ConversationLogEntry
+from apps.diagraph.compiledGraph import CompiledAnswer, CompiledGraph, CompiledNode, compiled_graphs
+from apps.diagraph.dataTableCache import data_tables
+from apps.diagraph.graphEvents import GraphChange, GraphChangeListener
+from apps.diagraph.modelRegistry import models
 from apps.diagraph.parsers.answerTemplateParser import AnswerTemplateParser
 from apps.diagraph.parsers.logicParser import LogicTemplateParser
 from apps.diagraph.parsers.systemTemplateParser import SystemTemplateParser
@@ -26,9 +28,11 @@ class IntentTracker:
     def __init__(self, device: str = "cpu", ckpt_dir='./.models/intentpredictor') -> None:
         from transformers import AutoModelForSequenceClassification, AutoTokenizer
         self.device = device
-        self.tokenizer = AutoTokenizer.from_pretrained('deepset/gbert-large', use_fast=True, cache_dir=".models/gbert", truncation_side='left')
-        self.model = AutoModelForSequenceClassification.from_pretrained(ckpt_dir, output_hidden_states = True).to(device)
-        self.model.eval()
+        # shared with all other services of this process
+        self.tokenizer = models.get('deepset/gbert-large:tokenizer', 'cpu', 
+                                    lambda: AutoTokenizer.from_pretrained('deepset/gbert-large', use_fast=True, cache_dir=".models/gbert", truncation_side='left'))
+        self.model = models.get(ckpt_dir, device, 
+                                lambda: AutoModelForSequenceClassification.from_pretrained(ckpt_dir, output_hidden_states = True).to(device).eval())
         self.free_counter = 0
         self.guided_counter = 0
 
@@ -39,53 +43,10 @@ class IntentTracker:
         return Intent(class_idx)
             
 
-@dataclass
-class FAQSearchResult:
-    query: str
-    similarity: float
-    top_k: int
-    goal_node_key: int
-
-
-MAX_NODE_RECURSION_DEPTH = 100
-
-# TODO: re-enable
-# class FAQPolicy:
-#     def __init__(self, tree: DialogDesigner, similarity_model: SentenceTransformer) -> None:
-#         self.similarityModel = similarity_model
-#         self.corpus_keys = []
-#         self.corpus_texts = []
-#         self.tree = tree
-
-#         if os.path.isfile("corpus.pt"):
-#             data = torch.load('corpus.pt')
-#             self.copus_embedding = data['embedding']
-#             self.corpus_keys = data['keys']
-#         else:
-#             node_ids = set()
-#             for faq in Data.objects[version].faq_list():
-#                 if not faq.dialog_node.key in node_ids:
-#                     node_ids.add(faq.dialog_node.key)
-#                     self.corpus_keys.append(faq.dialog_node.key)
-#                     self.corpus_texts.append(faq.dialog_node.content.text)
-#             self.copus_embedding = self.similarityModel.encode(self.corpus_texts, convert_to_tensor=True)
-#             torch.save({"keys": self.corpus_keys, "embedding": self.copus_embedding}, "corpus.pt")
-
-#     def top_k(self, query: str, k: int) -> List[FAQSearchResult]:
-#         query_emb = self.similarityModel.encode(query, convert_to_tensor=True, show_progress_bar=False)
-#         cos_scores = cos_sim(query_emb, self.copus_embedding)[0]
-#         top_results = torch.topk(cos_scores, k=k)
-            
-#         results = []
-#         counter = 0
-#         for score, idx in zip(top_results[0], top_results[1]):
-#             results.append(FAQSearchResult(deepcopy(query), similarity=score, top_k=counter, goal_node_key=self.corpus_keys[idx]))
-#             counter += 1
-        
-#         assert len(results) == k
-#         return results
+MAX_NODE_STEPS = 100 # a run of static info nodes counts as one step
+
 
-class DialogTreePolicy(Service):
+class DialogTreePolicy(GraphChangeListener, Service):
     def __init__(self, domain: str ='tree', logger: DiasysLogger = None, device: str = 'cpu', k: int = 1, identifier: str = "dialogTreePolicy", 
                     transports: str = "ws://localhost:8080/ws", realm="adviser") -> None:
         super().__init__(domain=domain, transports=transports, realm=realm, identifier=identifier)
@@ -95,20 +56,23 @@ class DialogTreePolicy(Service):
         self.answerParser = AnswerTemplateParser()
         self.logicParser = LogicTemplateParser()
         self.device = device
-        self.similarityModel = SentenceTransformer("distiluse-base-multilingual-cased-v2", device=self.device, cache_folder = '.models')
+        # models are shared via `apps.diagraph.modelRegistry` and loaded on first use
         # TODO: re-enable
         # self.intentPredictor = IntentTracker(device=self.device)
-        # TODO: re-enable
-        # self.faq_policy = FAQPolicy(tree=self.treeDesigner, similarity_model=self.similarityModel)
+        # FAQ search runs in the NLU (see `SimilarityMatchingNLU._search_faq`), matches arrive as `UserActionType.FAQ`
         self.k = k
 
         self.turn = UserState(lambda: 0)
         self.node_id = UserState(lambda: "-1")
         self.intent = UserState(lambda: None)
 
-    def get_first_node(self, graph: DialogGraph) -> DialogNode:
+    def on_graph_changed(self, change: GraphChange):
+        compiled_graphs.apply_change(change)
+        data_tables.apply_change(change)
+
+    def get_first_node(self, graph: CompiledGraph) -> CompiledNode:
         # find start node and then return its successor
-        return graph.get_start_node().connected_node
+        return graph.node(graph.get_start_node().connected_key)
 
     async def on_dialog_start(self, user_id: str):
         print("ON DIALOG START")
@@ -116,24 +80,33 @@ class DialogTreePolicy(Service):
         self.node_id[user_id] = "-1"
         logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: 0, turn: 0) - START")
 
-    def fillTemplate(self, graph: DialogGraph, delexicalized_utterance: str, beliefstate: dict):
+    def fillTemplate(self, graph: CompiledGraph, node: CompiledNode, beliefstate: dict):
         try:
-            return self.templateParser.parse_template(delexicalized_utterance, graph, beliefstate)
+            if isinstance(node.template, type(None)):
+                # parse markup only once per graph version
+                node.template = self.templateParser.compile_template(node.markup)
+            return node.template(graph, beliefstate)
         except:
             traceback.print_exc()
-            return delexicalized_utterance
+            return node.markup
 
-    def fillLogicTemplate(self, graph: DialogGraph, delexicalized_utterance: str, beliefstate: dict):
-        try:
-            return self.logicParser.parse_template(delexicalized_utterance, graph, beliefstate)
-        except:
-            return f"There was an error in the logic template: {delexicalized_utterance}"
+    def selectLogicBranch(self, graph: CompiledGraph, node: CompiledNode, beliefstate: dict):
+        """ Returns the index of the answer to follow from a logic node (or None) """
+        if isinstance(node.branches, type(None)):
+            # compile all branches only once per graph version
+            node.branches = self.logicParser.compile_branches(node.text, [answer.text for answer in node.answers])
+        return node.branches.select(graph, beliefstate)
 
-    def get_possible_answers(self, node: DialogNode, beliefstate: dict):
+    def find_variable(self, answer: CompiledAnswer):
+        if isinstance(answer.variable, type(None)):
+            answer.variable = self.answerParser.find_variable(answer.text)
+        return answer.variable
+
+    def get_possible_answers(self, node: CompiledNode, beliefstate: dict):
         candidates = []
-        for answer in node.answers.all():
+        for answer in node.answers:
             if "{{" in answer.text:
-                var = self.answerParser.find_variable(answer.text)
+                var = self.find_variable(answer)
                 if var.name:
                     # if answer is template, fill in example values
                     if var.type == "BOOLEAN":
@@ -145,51 +118,52 @@ class DialogTreePolicy(Service):
                     candidates.append(answer.text)
         return candidates
 
-    def _handle_logic_node(self, user_id: int, graph: DialogGraph, node: DialogNode, beliefstate: dict):
+    def _handle_logic_node(self, user_id: int, graph: CompiledGraph, node: CompiledNode, beliefstate: dict):
         # check if we are currently at a logic node
         if node.node_type == NodeType.LOGIC:
             # logic template in node! 
             # Form: "{{ lhs"
             #  -> incomplete, add each answer of form "operator rhs }}" to complete statement
-            lhs = node.text	
-            default_answer = None
-            for answer in node.answers.all():
-                # check if full statement {{{lhs rhs}}} evaluates to True
-                rhs = answer.text
-                if not "DEFAULT" in rhs: # handle DEFAULT case last!
-                    if self.fillLogicTemplate(graph, f"{lhs} {rhs}", beliefstate):
-                        # evaluates to True, follow this path!
-                        next_node = answer.connected_node
-                        self.node_id[user_id] = next_node.key
-                        logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - LOGIC NODE CONDITION: {lhs} {rhs}")
-                        return next_node, True
-                else:
-                    default_answer = answer
-                    logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - LOGIC NODE CONDITION: DEFAULT")
-            # default case
-            self.node_id[user_id] = default_answer.connected_node.key
-            return default_answer.connected_node, True
+            lhs = node.text
+            # the lhs is evaluated once, all branches are checked in a single pass (first satisfied branch wins, DEFAULT last)
+            answer_index = self.selectLogicBranch(graph, node, beliefstate)
+            answer = node.answers[answer_index]
+            if "DEFAULT" in answer.text:
+                logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - LOGIC NODE CONDITION: DEFAULT")
+            else:
+                logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - LOGIC NODE CONDITION: {lhs} {answer.text}")
+            next_node = graph.node(answer.connected_key)
+            self.node_id[user_id] = next_node.key
+            return next_node, True
         return node, False
 
-    def _handle_info_node(self, user_id: int, graph: DialogGraph, node: DialogNode, beliefstate: dict):
-        """ Skip user input for nodes with answer [null] """
-        # skip [null] anwsers to get to next system output immediately without user input
+    def _handle_info_nodes(self, user_id: int, graph: CompiledGraph, node: CompiledNode, beliefstate: dict):
+        """ Output info nodes without waiting for user input, returns (next node, utterances, last info node) """
         sys_utterances = []
         if node.node_type == NodeType.INFO:
-            sys_utterances.append((self.fillTemplate(graph, node.markup, beliefstate), node.get_node_type_display()))
-            self.node_id[user_id] = None if isinstance(node.connected_node, type(None)) else node.key
-            node = node.connected_node
+            macro = graph.macro_step(node.key)
+            if macro:
+                # run of static info nodes: pre-rendered, output at once
+                sys_utterances += macro.utterances
+                node = graph.node(macro.last_key)
+                logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - INFO NODES: {len(macro.keys)} (pre-rendered)")
+            else:
+                sys_utterances.append((self.fillTemplate(graph, node, beliefstate), node.get_node_type_display()))
+            last_info_node = node
+            self.node_id[user_id] = None if isinstance(node.connected_key, type(None)) else node.key
+            node = graph.node(node.connected_key)
             logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - INFO NODE: {sys_utterances[-1]}")
-        return node, sys_utterances
+            return node, sys_utterances, last_info_node
+        return node, sys_utterances, None
 
-    def _handle_var_node(self, user_id: int, graph: DialogGraph, node: DialogNode, beliefstate: dict):
+    def _handle_var_node(self, user_id: int, graph: CompiledGraph, node: CompiledNode, beliefstate: dict):
         if node.node_type == NodeType.VARIABLE:
             # check if variable is already known
-            answer = node.answers.first()
-            expected_var = self.answerParser.find_variable(answer.text)
+            answer = node.answers[0]
+            expected_var = self.find_variable(answer)
             if expected_var.name in beliefstate:
                 # variable is alredy knonwn, skip to next node
-                next_node = answer.connected_node
+                next_node = graph.node(answer.connected_key)
                 self.node_id[user_id] = next_node.key
                 logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - VAR NODE - ALREADY KNOWN: VAR {expected_var}")
                 return next_node, [], True
@@ -197,7 +171,7 @@ class DialogTreePolicy(Service):
                 # variable is not known, ask
                 self.node_id[user_id] = node.key
                 logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}) - VAR NODE - NOT KNOWN: VAR {expected_var}")
-                return node, [(self.fillTemplate(graph, node.markup, beliefstate), node.get_node_type_display())], True 
+                return node, [(self.fillTemplate(graph, node, beliefstate), node.get_node_type_display())], True 
         return node, [], False
 
     def _math_op(self, lhs: str, op: str, rhs: str):
@@ -212,7 +186,7 @@ class DialogTreePolicy(Service):
                 return 0
             return float(lhs) / float(rhs)
 
-    def _handle_varUpdate_node(self, user_id: int, graph: DialogGraph, node: DialogNode, beliefstate: dict):
+    def _handle_varUpdate_node(self, user_id: int, graph: CompiledGraph, node: CompiledNode, beliefstate: dict):
         sys_utterances = []
         if node.node_type == NodeType.UPDATE:
             # parse content
@@ -287,16 +261,16 @@ class DialogTreePolicy(Service):
 
             beliefstate[var_name] = result
             print(" - bst update", var_name, ":",result)
-            self.node_id[user_id] = None if isinstance(node.connected_node, type(None)) else node.key
-            node = node.connected_node
+            self.node_id[user_id] = None if isinstance(node.connected_key, type(None)) else node.key
+            node = graph.node(node.connected_key)
             return node, sys_utterances, True
         return node, sys_utterances, False
 
 
-    def log_to_database(self, graph: DialogGraph, user_id: int, sys_utterances: List[str]):
+    def log_to_database(self, graph: CompiledGraph, user_id: int, sys_utterances: List[str]):
         log = []
         for utterance in sys_utterances:
-            log.append(ConversationLogEntry(graph=graph, user=user_id, module="POLICY", content=f"{utterance[1]}: {strip_tags(utterance[0])}"))
+            log.append(ConversationLogEntry(graph_id=graph.uuid, user=user_id, module="POLICY", content=f"{utterance[1]}: {strip_tags(utterance[0])}"))
         ConversationLogEntry.objects.bulk_create(log)
 
 
@@ -304,8 +278,8 @@ class DialogTreePolicy(Service):
     def choose_sys_act(self, user_acts: List[UserAct], beliefstate: dict, user_id: int, graph_id: str) -> dict(sys_utterances=str, node_id=int, answer_candidates=list, user_acts=list,beliefstate=dict, node_pos=dict):
         turn_count = self.turn[user_id]
 
-        # get context for current user and selected conversation graph
-        graph: DialogGraph = DialogGraph.objects.get(uuid=graph_id)
+        # get context for current user and selected conversation graph (compiled once per graph, shared between users)
+        graph: CompiledGraph = compiled_graphs.get(graph_id)
 
         print("TURN COUNT", turn_count)
         if turn_count == 0:
@@ -317,7 +291,7 @@ class DialogTreePolicy(Service):
             self.node_id[user_id] = first_node.key
 
         sys_utterances = []
-        node: DialogNode = graph.nodes.get(key=self.node_id[user_id])
+        node: CompiledNode = graph.node(self.node_id[user_id])
         logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}, turn: {turn_count})")
 
         # check if we have unrecognized user inputs
@@ -347,15 +321,21 @@ class DialogTreePolicy(Service):
         # (TODO later: depending on beliefstate as well)
         for act_dict in user_acts:
             act = UserAct.from_json(act_dict)
-            selected_answer: Answer = None
-            for answer in node.answers.all():
+            if act.type == UserActionType.FAQ:
+                # user asked a question of the graph's FAQ: jump to the node answering it
+                logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}, turn: {turn_count}) - FAQ: {act.text} - GOAL NODE {act.value}")
+                node = graph.node(act.value)
+                self.node_id[user_id] = node.key
+                continue
+            selected_answer: CompiledAnswer = None
+            for answer in node.answers:
                 if answer.text == act.text:
                     selected_answer = answer
                     break
-            node = selected_answer.connected_node
+            node = graph.node(selected_answer.connected_key)
             self.node_id[user_id] = node.key
         
-        output = self.handle_node(user_id=user_id, graph=graph, node=node, user_acts=user_acts, beliefstate=beliefstate, sys_utterances=sys_utterances, tree_end_reached=False, call_num=0)
+        output = self.handle_node(user_id=user_id, graph=graph, node=node, user_acts=user_acts, beliefstate=beliefstate, sys_utterances=sys_utterances, tree_end_reached=False)
         self.node_id[user_id] = output['node_id']
         
         print("FINAL OUTPUT", output['beliefstate'])
@@ -363,156 +343,152 @@ class DialogTreePolicy(Service):
         self.log_to_database(graph, user_id, output['sys_utterances'])
         return output
 
-    def handle_node(self, user_id: str, graph: DialogGraph, node: DialogNode, user_acts: List[UserAct], beliefstate: Dict, sys_utterances: List[Tuple], tree_end_reached: bool, call_num: int):
-        # Handle Logic nodes
-        print("START HANDLE NODE - BST ", call_num, beliefstate)
-        x_pos = node.position_x
-        y_pos = node.position_y
-        if call_num >= MAX_NODE_RECURSION_DEPTH:
-            sys_utterances.append((f"Traversing more than {MAX_NODE_RECURSION_DEPTH} nodes without user input in between is not currently supported (also verify that your graph doesn't contain infinite loops)!", "errorMsg"))
-            return {
-                "sys_utterances": sys_utterances,
-                "node_id": None,
-                "answer_candidates": [],
-                'user_acts': [],
-                'beliefstate': beliefstate,
-                "tree_end_reached": True,
-                "node_pos": {"x": x_pos, "y": y_pos}
-            }
-
-        turn_count = self.turn[user_id]
-        logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}, turn: {turn_count}) - HANDLE NODE: TREE END REACHED {tree_end_reached}")
-        node, isLogicTemplate = self._handle_logic_node(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
-        if isLogicTemplate:
-            self.turn[user_id] = turn_count + 1
-            if node:
-                return self.handle_node(user_id, graph, node, [], beliefstate, sys_utterances, False, call_num+1)
-            elif sys_utterances:
-                # if self.logger:
-                    # self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, node: {node.key if node else 'None'}, TYPE: {node.node_type}, TEXT: {node.text}")
+    def handle_node(self, user_id: str, graph: CompiledGraph, node: CompiledNode, user_acts: List[UserAct], beliefstate: Dict, sys_utterances: List[Tuple], tree_end_reached: bool):
+        """ Traverse the graph starting at `node` until user input is required or the end of the graph is reached """
+        steps = 0
+        while True:
+            print("START HANDLE NODE - BST ", steps, beliefstate)
+            x_pos = node.position_x
+            y_pos = node.position_y
+            if steps >= MAX_NODE_STEPS:
+                sys_utterances.append((f"Traversing more than {MAX_NODE_STEPS} nodes without user input in between is not currently supported (also verify that your graph doesn't contain infinite loops)!", "errorMsg"))
                 return {
                     "sys_utterances": sys_utterances,
-                    "node_id": node.key,
+                    "node_id": None,
                     "answer_candidates": [],
                     'user_acts': [],
                     'beliefstate': beliefstate,
-                    "node_pos": {"x": node.position_x, "y": node.position_y}
-                }
-            else:
-                return {
-                    'user_acts': [],
-                    'beliefstate': beliefstate,
-                    "node_id": node.key,
-                    "node_pos": {"x": node.position_x, "y": node.position_y}
-                }
-
-        node, isInfoNode = self._handle_info_node(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
-        if isInfoNode:
-            self.turn[user_id] = turn_count + 1
-            sys_utterances += isInfoNode
-            # if self.logger:
-                # self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, NODE: {node}, TYPE: infoNode, TEXT: {sys_utterances}")
-            if not node: 
-                # no follow-up node
-                return {
-                    "sys_utterances": sys_utterances,
-                    "node_id": None,
-                    "answer_candidates": [],
                     "tree_end_reached": True,
-                    'beliefstate': beliefstate,
                     "node_pos": {"x": x_pos, "y": y_pos}
                 }
-            return self.handle_node(user_id, graph, node, [], beliefstate, sys_utterances, False, call_num+1)
-            # return {
-            #     "sys_utterances": sys_utterances,
-            #     "node_id": node,
-            #     "answer_candidates": [],
-            #     'user_acts': [],
-            #     'beliefstate': beliefstate
-            # }
-
-        node, varUtterances, isVarNode = self._handle_var_node(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
-        if isVarNode:
-            self.turn[user_id] = turn_count + 1
-            sys_utterances += varUtterances
-            if len(varUtterances) > 0:
-                # value unkown, don't skip user input
+            steps += 1
+
+            turn_count = self.turn[user_id]
+            logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}, turn: {turn_count}) - HANDLE NODE: TREE END REACHED {tree_end_reached}")
+            node, isLogicTemplate = self._handle_logic_node(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
+            if isLogicTemplate:
+                self.turn[user_id] = turn_count + 1
+                if node:
+                    continue
+                elif sys_utterances:
+                    # if self.logger:
+                        # self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, node: {node.key if node else 'None'}, TYPE: {node.node_type}, TEXT: {node.text}")
+                    return {
+                        "sys_utterances": sys_utterances,
+                        "node_id": node.key,
+                        "answer_candidates": [],
+                        'user_acts': [],
+                        'beliefstate': beliefstate,
+                        "node_pos": {"x": node.position_x, "y": node.position_y}
+                    }
+                else:
+                    return {
+                        'user_acts': [],
+                        'beliefstate': beliefstate,
+                        "node_id": node.key,
+                        "node_pos": {"x": node.position_x, "y": node.position_y}
+                    }
+
+            node, infoUtterances, last_info_node = self._handle_info_nodes(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
+            if infoUtterances:
+                self.turn[user_id] = turn_count + len(infoUtterances)
+                sys_utterances += infoUtterances
                 # if self.logger:
-                #     self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, node: {node.key if node else 'None'}, TYPE: {node.node_type}, TEXT: {sys_utterances}")
-                return {
-                    "sys_utterances": sys_utterances,
-                    "node_id": node.key,
-                    "answer_candidates": self.get_possible_answers(node, beliefstate),
-                    'beliefstate': beliefstate,
-                    "node_pos": {"x": node.position_x, "y": node.position_y}
-                }
-            else:
-                # value alredy known skip user input
-                if self.logger:
-                    self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, NODE: {node}, TYPE: varNode, TEXT: {sys_utterances}")
-                return {
-                    "sys_utterances": sys_utterances,
-                    "node_id": node.key,
-                    "answer_candidates": [],
-                    'user_acts': [],
-                    'beliefstate': beliefstate,
-                    "node_pos": {"x": node.position_x, "y": node.position_y}                   
-                }
+                    # self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, NODE: {node}, TYPE: infoNode, TEXT: {sys_utterances}")
+                if not node: 
+                    # no follow-up node
+                    return {
+                        "sys_utterances": sys_utterances,
+                        "node_id": None,
+                        "answer_candidates": [],
+                        "tree_end_reached": True,
+                        'beliefstate': beliefstate,
+                        "node_pos": {"x": last_info_node.position_x, "y": last_info_node.position_y}
+                    }
+                continue
+
+            node, varUtterances, isVarNode = self._handle_var_node(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
+            if isVarNode:
+                self.turn[user_id] = turn_count + 1
+                sys_utterances += varUtterances
+                if len(varUtterances) > 0:
+                    # value unkown, don't skip user input
+                    # if self.logger:
+                    #     self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, node: {node.key if node else 'None'}, TYPE: {node.node_type}, TEXT: {sys_utterances}")
+                    return {
+                        "sys_utterances": sys_utterances,
+                        "node_id": node.key,
+                        "answer_candidates": self.get_possible_answers(node, beliefstate),
+                        'beliefstate': beliefstate,
+                        "node_pos": {"x": node.position_x, "y": node.position_y}
+                    }
+                else:
+                    # value alredy known skip user input
+                    if self.logger:
+                        self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, NODE: {node}, TYPE: varNode, TEXT: {sys_utterances}")
+                    return {
+                        "sys_utterances": sys_utterances,
+                        "node_id": node.key,
+                        "answer_candidates": [],
+                        'user_acts': [],
+                        'beliefstate': beliefstate,
+                        "node_pos": {"x": node.position_x, "y": node.position_y}                   
+                    }
+
+            node, updateUtterances, isUpdateNode = self._handle_varUpdate_node(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
+            if isUpdateNode:
+                print("UPDATE NODE")
+                self.turn[user_id] = turn_count + 1
+                sys_utterances += updateUtterances
+
+                if not node:
+                    return {
+                        "sys_utterances": sys_utterances,
+                        "node_id": None,
+                        "answer_candidates": [],
+                        "tree_end_reached": True,
+                        "beliefstate": beliefstate,
+                        "node_pos": {"x": x_pos, "y": y_pos}
+                    }
+                else:
+                    # skip user input
+                    # if self.logger:
+                    # self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, NODE: {node}, TYPE: varNode, TEXT: {sys_utterances}")
+                    print("HANDLE NODE BST", beliefstate)
+                    continue
+
 
-        node, updateUtterances, isUpdateNode = self._handle_varUpdate_node(user_id=user_id, graph=graph, node=node, beliefstate=beliefstate)
-        if isUpdateNode:
-            print("UPDATE NODE")
+
+            # normal template, fill with values from beliefstate
+            # sys_utterances.append(self.fillTemplate(node.content.markup, beliefstate))
+            # if self.logger:
+            # 	self.logger.dialog_turn(f'Policy: user selected answer {selected_answer.content.text}')
+            # 	self.logger.dialog_turn(f'Policy: transitioning to next node {node.key}')
+
+            # Handle self-calls
             self.turn[user_id] = turn_count + 1
-            sys_utterances += updateUtterances
+            # if not isinstance(node, DialogNode):
+            #     node = self.treeDesigner.tree._node_by_key[node]
+            sys_utterances += [(self.fillTemplate(graph, node, beliefstate), node.get_node_type_display())]
 
-            if not node:
-                return {
-                    "sys_utterances": sys_utterances,
-                    "node_id": None,
-                    "answer_candidates": [],
-                    "tree_end_reached": True,
-                    "beliefstate": beliefstate,
-                    "node_pos": {"x": x_pos, "y": y_pos}
-                }
-            else:
-                # skip user input
-                # if self.logger:
-                # self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, NODE: {node}, TYPE: varNode, TEXT: {sys_utterances}")
-                print("HANDLE NODE BST", beliefstate)
-                return self.handle_node(user_id, graph, node, [], beliefstate, sys_utterances, False, call_num+1)
-
-
-
-        # normal template, fill with values from beliefstate
-        # sys_utterances.append(self.fillTemplate(node.content.markup, beliefstate))
-        # if self.logger:
-        # 	self.logger.dialog_turn(f'Policy: user selected answer {selected_answer.content.text}')
-        # 	self.logger.dialog_turn(f'Policy: transitioning to next node {node.key}')
-
-        # Handle self-calls
-        self.turn[user_id] = turn_count + 1
-        # if not isinstance(node, DialogNode):
-        #     node = self.treeDesigner.tree._node_by_key[node]
-        sys_utterances += [(self.fillTemplate(graph, node.markup, beliefstate), node.get_node_type_display())]
-
-        if isinstance(node.connected_node, type(None)) and all([isinstance(ans.connected_node, type(None)) for ans in node.answers.all()]):
-            tree_end_reached = True
-
-        print("ANSWER CANDIDATES", self.get_possible_answers(node, beliefstate))
-
-        logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}, turn: {turn_count}) - HANDLE NODE: SYS UTTERANCE: {sys_utterances}")    
-        # if self.logger:
-        #     self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, node: {node.key if node else 'None'}, TYPE: {node.node_type}, TEXT: {sys_utterances}")
-        # for sysutt in sys_utterances:
-        # 	if "vielen dank" in sysutt[0].lower():
-        # 		return {
-        # 			f'{Topic.DIALOG_END}': True
-        # 		}
-        return {
-            "sys_utterances": sys_utterances,
-            "node_id": node.key,
-            "answer_candidates": self.get_possible_answers(node, beliefstate),
-            "tree_end_reached": tree_end_reached,
-            "beliefstate": beliefstate,
-            "node_pos": {"x": node.position_x, "y": node.position_y}
-        }
\ No newline at end of file
+            if isinstance(node.connected_key, type(None)) and all([isinstance(ans.connected_key, type(None)) for ans in node.answers]):
+                tree_end_reached = True
+
+            print("ANSWER CANDIDATES", self.get_possible_answers(node, beliefstate))
+
+            logging.getLogger('chat').info(f"POLICY (user: {user_id}, node: {node.key if node else 'None'}, turn: {turn_count}) - HANDLE NODE: SYS UTTERANCE: {sys_utterances}")    
+            # if self.logger:
+            #     self.logger.dialog_turn(f"POLICY {user_id}: TURN {turn_count}, node: {node.key if node else 'None'}, TYPE: {node.node_type}, TEXT: {sys_utterances}")
+            # for sysutt in sys_utterances:
+            # 	if "vielen dank" in sysutt[0].lower():
+            # 		return {
+            # 			f'{Topic.DIALOG_END}': True
+            # 		}
+            return {
+                "sys_utterances": sys_utterances,
+                "node_id": node.key,
+                "answer_candidates": self.get_possible_answers(node, beliefstate),
+                "tree_end_reached": tree_end_reached,
+                "beliefstate": beliefstate,
+                "node_pos": {"x": node.position_x, "y": node.position_y}
+            }
\ No newline at end of file
@@ -1,7 +1,10 @@
 from urllib.parse import urlencode
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.http import HttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
 import json
 
@@ -25,13 +28,14 @@ def create_graph(request):
     graph.save()
     startNode.save()
     graph.first_node = startNode
-    graph.save()
+    graph.save(update_fields=['first_node'])
     return redirect('home')
 
 @login_required
 def delelete_graph(request, graphId: str):
     graph = DialogGraph.objects.get(owner=request.user, uuid=graphId)
     graph.clear_nodes()
+    graph.clear_tables()
     graph.delete()
     return redirect("home")
 
@@ -39,7 +43,7 @@ def delelete_graph(request, graphId: str):
 def rename_graph(request, graphId: str):
     graph = DialogGraph.objects.get(owner=request.user, uuid=graphId)
     graph.name = request.POST['newName']
-    graph.save()
+    graph.save(update_fields=['name']) # don't overwrite the version (see `DialogGraph.bump_version`)
     return redirect("home")
 
 @login_required
@@ -72,11 +76,23 @@ def edit_graph(request):
     print("Redirecting to", url)
     return redirect(url)
 
+def _graph_etag(request, graphId: str):
+    # the version changes with every modification of the graph (see `DialogGraph.bump_version`)
+    version = DialogGraph.objects.filter(owner=request.user, uuid=graphId).values_list('version', flat=True).first()
+    return None if isinstance(version, type(None)) else f"{graphId}-{version}"
+
 @login_required
+@cache_control(private=True, no_cache=True) # browsers revalidate with If-None-Match, unchanged graphs are answered with 304
+@condition(etag_func=_graph_etag)
 def load_graph(request, graphId: str):
-    # expert graph as json
+    # expert graph as json, cached per graph version
     graph = DialogGraph.objects.get(owner=request.user, uuid=graphId)
-    return HttpResponse(json.dumps(graph.toJSON()))
+    cache_key = f"graph_json:{graph.uuid}:{graph.version}"
+    graph_json = cache.get(cache_key)
+    if isinstance(graph_json, type(None)):
+        graph_json = json.dumps(graph.toJSON())
+        cache.set(cache_key, graph_json)
+    return HttpResponse(graph_json)
 
 @login_required
 def dialog_logs(request, graphId: str):
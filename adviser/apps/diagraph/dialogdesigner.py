@@ -1,8 +1,11 @@
+import asyncio
 from typing import Dict, Iterable
 from typing_extensions import override
-import pandas
-from io import StringIO
 from apps.diagraph.data.dialogGraph import DataTable, DialogGraph, DialogNode, NodeType, Question, Answer, DataTableColumn, Tag
+from apps.diagraph.columnarTables import remove_columns
+from apps.diagraph.dataTableCache import data_tables
+from apps.diagraph.graphEvents import GraphChange, publish_graph_changed
+from apps.diagraph.tableUpload import TableFormatError, TableUpload, TableUploads
 from django.db import transaction
 from services.service import Service
 import os 
@@ -19,6 +22,7 @@ TABLE_LIMIT_PER_GRAPH = get_limit('TABLE_LIMIT_PER_GRAPH')
 ANSWER_LIMIT_PER_NODE = get_limit('ANSWER_LIMIT_PER_NODE')
 FAQ_LIMIT_PER_NODE = get_limit('FAQ_LIMIT_PER_NODE')
 TEXT_LENGTH_LIMIT = get_limit('TEXT_LENGTH_LIMIT')
+TABLE_SIZE_LIMIT = get_limit('TABLE_SIZE_LIMIT') # bytes of CSV data per table
 
 # TODO re-enable tags
 # TODO all add / rename functions should return boolean now: quota exceeded or not
@@ -29,6 +33,7 @@ class DialogDesigner(Service):
     def __init__(self, domain: str = "tree", identifier: str = "dialogDesigner",  transports: str = "ws://localhost:8080/ws", realm="adviser") -> None:
         super().__init__(domain=domain, transports=transports, realm=realm, identifier=identifier)
         self.registered = False
+        self.table_uploads = TableUploads()
 
     @override
     async def _register(self, session):
@@ -51,6 +56,10 @@ class DialogDesigner(Service):
             await self._component._session.register(self.on_faq_text_changed, "dialogdesigner.faq.text.changed")
             await self._component._session.register(self.on_file_import, "dialogdesigner.import")
             await self._component._session.register(self.on_datatable_import, "dialogdesigner.datatable.import")
+            await self._component._session.register(self.on_datatable_upload_start, "dialogdesigner.datatable.upload.start")
+            await self._component._session.register(self.on_datatable_upload_chunk, "dialogdesigner.datatable.upload.chunk")
+            await self._component._session.register(self.on_datatable_upload_commit, "dialogdesigner.datatable.upload.commit")
+            await self._component._session.register(self.on_datatable_upload_abort, "dialogdesigner.datatable.upload.abort")
             await self._component._session.register(self.on_datatable_name_changed, "dialogdesigner.datatable.name.changed")
             await self._component._session.register(self.on_datatable_delete, "dialogdesigner.datatable.delete")
             await self._component._session.register(self.on_tag_add, "dialogdesigner.tag.add")
@@ -60,29 +69,39 @@ class DialogDesigner(Service):
 
             self.registered = True
 
+    def _graph_changed(self, graph: DialogGraph, nodes: Iterable[int] = (), answers: Iterable[int] = (), questions: Iterable[int] = (), tables: Iterable[int] = (), reload: bool = False):
+        """ Increment the graph version and notify all runtime services (policy, NLU) which parts of the graph were modified """
+        change = GraphChange(graph_id=str(graph.uuid), version=graph.bump_version(),
+                             nodes=[int(key) for key in nodes], answers=[int(key) for key in answers], questions=[int(key) for key in questions],
+                             tables=list(tables), reload=reload)
+        publish_graph_changed(self._component._session, change)
 
     def on_tag_add(self, graphId: str, tagId: str, color: str):
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         tag = Tag(key=tagId, color=color, graph=graph)
         tag.save()
+        self._graph_changed(graph)
 
     def on_tag_delete(self, graphId: str, tagId: str):
         # TODO make sure to detach tag in UI 
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         tag = graph.tags.get(key=tagId)
         tag.delete()
+        self._graph_changed(graph)
     
     def on_tag_apply(self, graphId: str, tagId: str, nodeId: str):
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         tag = graph.tags.get(key=tagId)
         node = graph.nodes.get(key=nodeId)
         node.tags.add(tag)
+        self._graph_changed(graph, nodes=[node.key])
 
     def on_tag_detach(self, graphId: str, tagId: str, nodeId: str):
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         tag = graph.tags.get(key=tagId)
         node = graph.nodes.get(key=nodeId)
         node.tags.remove(tag)
+        self._graph_changed(graph, nodes=[node.key])
 
     def on_graph_rename(self, graphId: str, newName: str) -> bool:
         if not isinstance(TEXT_LENGTH_LIMIT, type(None)) and len(newName) > TEXT_LENGTH_LIMIT:
@@ -90,42 +109,102 @@ class DialogDesigner(Service):
 
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         graph.name = newName
-        graph.save()
+        graph.save(update_fields=['name']) # the version is incremented atomically by `_graph_changed`
+        self._graph_changed(graph)
 
         return True
 
-    def on_datatable_import(self, graphId: str, data: str, name: str):
+    async def on_datatable_import(self, graphId: str, data: str, name: str):
         """
+        Import a data table sent in a single message (small tables, see `on_datatable_upload_start` for chunked uploads)
+
         Args:
             data: CSV data
         """
-        # TODO limit upload size of a single table, too
         try:
-            graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
-            
-            # save content
-            name = name.replace(".csv", "")
-            table = DataTable(name=name, content=data, graph=graph)
-            table.save()
+            upload = TableUpload(graph_id=graphId, name=name, size_limit=TABLE_SIZE_LIMIT)
+            return await self._save_table(upload, data)
+        except:
+            print("Problem while uploading data table:")
+            traceback.print_exc()
+            return False
+
+    def on_datatable_upload_start(self, graphId: str, name: str, size: int = None):
+        """
+        Start a chunked data table upload: send the CSV data in pieces via `dialogdesigner.datatable.upload.chunk`,
+        then store the table with `dialogdesigner.datatable.upload.commit`.
+
+        Args:
+            size: total size of the CSV data in bytes (optional, rejected early if above the limit)
+        Returns:
+            upload id or False (limit exceeded)
+        """
+        if not isinstance(TABLE_SIZE_LIMIT, type(None)) and not isinstance(size, type(None)) and size > TABLE_SIZE_LIMIT:
+            return False
+        if not isinstance(TEXT_LENGTH_LIMIT, type(None)) and len(name) > TEXT_LENGTH_LIMIT:
+            return False
+        upload = self.table_uploads.start(graph_id=graphId, name=name, size_limit=TABLE_SIZE_LIMIT)
+        return upload.upload_id
+
+    def on_datatable_upload_chunk(self, uploadId: str, data: str) -> bool:
+        """ Append the next piece of CSV data, the upload is aborted if it exceeds the size limit or isn't valid CSV """
+        upload = self.table_uploads.get(uploadId)
+        if isinstance(upload, type(None)):
+            return False
+        try:
+            upload.add_chunk(data)
+            return True
+        except TableFormatError as error:
+            print("Problem while uploading data table:", error)
+        except:
+            print("Problem while uploading data table:")
+            traceback.print_exc()
+        self.table_uploads.abort(uploadId)
+        return False
 
-            # extract metadata
-            csv_file = StringIO(data)
-            content = pandas.read_csv(csv_file, delimiter=";") 
-            columns = list(content)
-            for column in columns:
-                col = DataTableColumn(label=column, table=table)
-                col.save()
-
-            print("GOT DATA TABLE WITH COLUMNS", columns)
-            return {
-                "name": table.name,
-                "columns": columns
-            }
+    async def on_datatable_upload_commit(self, uploadId: str):
+        upload = self.table_uploads.pop(uploadId)
+        if isinstance(upload, type(None)):
+            return False
+        try:
+            return await self._save_table(upload)
         except:
             print("Problem while uploading data table:")
             traceback.print_exc()
             return False
 
+    def on_datatable_upload_abort(self, uploadId: str):
+        self.table_uploads.abort(uploadId)
+
+    async def _save_table(self, upload: TableUpload, data: str = None) -> dict:
+        """ Parsing and storing run in a worker thread, so large tables don't block the other calls on the event loop """
+        graph, table = await asyncio.get_running_loop().run_in_executor(None, self._store_table, upload, data)
+        columns = upload.parser.columns
+        print("GOT DATA TABLE WITH COLUMNS", columns, "AND", upload.parser.num_rows, "ROWS")
+        self._graph_changed(graph, tables=[table.id])
+        return {
+            "name": table.name,
+            "columns": columns,
+            "types": upload.parser.column_types(),
+            "rows": upload.parser.num_rows
+        }
+
+    def _store_table(self, upload: TableUpload, data: str = None):
+        """ Stores the upload (`data`: last piece of CSV data) as `DataTable` and columnar copy (worker thread, see `_save_table`) """
+        try:
+            if not isinstance(data, type(None)):
+                upload.add_chunk(data)
+            content = upload.content()
+        finally:
+            upload.discard()
+        graph: DialogGraph = DialogGraph.objects.get(uuid=upload.graph_id)
+        with transaction.atomic():
+            table = DataTable(name=upload.name.replace(".csv", ""), content=content, graph=graph)
+            table.save()
+            DataTableColumn.objects.bulk_create([DataTableColumn(label=column, table=table) for column in upload.parser.columns])
+        data_tables.store(table.id, table.content_hash, upload.parser)
+        return graph, table
+
     def on_datatable_name_changed(self, graphId: str, oldName: str, newName: str) -> bool:
         if not isinstance(TEXT_LENGTH_LIMIT, type(None)) and len(newName) > TEXT_LENGTH_LIMIT:
             return False
@@ -135,6 +214,7 @@ class DialogDesigner(Service):
 
         table.name = newName
         table.save()
+        self._graph_changed(graph, tables=[table.id])
 
         print("CHANGED DATA TABLE NAME FROM", oldName, "TO", newName)
         return True
@@ -142,9 +222,13 @@ class DialogDesigner(Service):
     def on_datatable_delete(self, graphId: str, name: str):
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         table: DataTable = graph.tables.get(name=name)
+        table_id = table.id
         table.columns.all().delete()
 
         table.delete() 
+        if data_tables.columnar_dir:
+            remove_columns(data_tables.columnar_dir, table_id)
+        self._graph_changed(graph, tables=[table_id])
 
         print("DELETED DATA TABLE", name)
 
@@ -157,6 +241,7 @@ class DialogDesigner(Service):
 
         graph = DialogGraph.fromJSON(graph_name=graph_name, owner=owner, data=json_data)
         print("IMPORTED TREE with", graph.nodes.count(), "nodes")
+        self._graph_changed(graph, reload=True)
 
     def on_answer_add(self, graphId: str, nodeId: int, answer: dict) -> bool:
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
@@ -168,6 +253,7 @@ class DialogDesigner(Service):
         print(answer)
         answer = Answer(key=answer['id'], index=node.answers.count(), text=answer['text'], node=node)
         answer.save()
+        self._graph_changed(graph, nodes=[node.key], answers=[answer.key])
 
         print("Added answer")
         return True
@@ -179,6 +265,7 @@ class DialogDesigner(Service):
         answer: Answer = node.answers.get(key=answerId)
 
         answer.delete()
+        self._graph_changed(graph, nodes=[node.key], answers=[answerId])
 
         print("DELETED ANSWER")
 
@@ -192,6 +279,7 @@ class DialogDesigner(Service):
 
         answer.text = text
         answer.save()
+        self._graph_changed(graph, nodes=[node.key], answers=[answer.key])
 
         print("CHANGED ANSWER TEXT")
         return True
@@ -204,6 +292,7 @@ class DialogDesigner(Service):
             answer: Answer = node.answers.get(key=answerId)
             answer.index = idx
             answer.save()
+        self._graph_changed(graph, nodes=[node.key], answers=answerIds)
 
         print("CHANGED ANSWER ORDER")
 
@@ -218,6 +307,7 @@ class DialogDesigner(Service):
                                     position_x=node['position']['x'], position_y=node['position']['y'],
                                     graph=graph)
         nodeobj.save()
+        self._graph_changed(graph, nodes=[nodeobj.key])
         # for answer in node['data']['answers']:
         #     result = self.on_answer_add(graphId=graphId, nodeId=nodeobj.key, answer=answer)
         #     if not result:
@@ -238,6 +328,7 @@ class DialogDesigner(Service):
         node.text = raw
         node.markup = markup
         node.save()
+        self._graph_changed(graph, nodes=[node.key])
 
         print("Node text changed to", raw)
         return True
@@ -254,6 +345,7 @@ class DialogDesigner(Service):
         node.position_x = position['x']
         node.position_y = position['y']
         node.save()
+        self._graph_changed(graph, nodes=[node.key])
 
         print("POSITION CHANGE", nodeId, position)
     
@@ -261,6 +353,10 @@ class DialogDesigner(Service):
         print("DELETING NODE")
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         node: DialogNode = graph.nodes.get(key=nodeId)
+        # collect everything pointing to or owned by the node before deleting it
+        touched_nodes = [node.key] + [incoming.key for incoming in node.incoming_nodes.all()] + [answer.node.key for answer in node.incoming_answers.select_related('node')]
+        touched_answers = [answer.key for answer in node.answers.all()] + [answer.key for answer in node.incoming_answers.all()]
+        touched_questions = [question.key for question in node.questions.all()]
 
         node.connected_node = None
         node.save()
@@ -283,6 +379,7 @@ class DialogDesigner(Service):
         # node.questions.all().delete()
         print("DELET INCOMING COUNT", node.incoming_nodes.count())
         node.delete()
+        self._graph_changed(graph, nodes=touched_nodes, answers=touched_answers, questions=touched_questions)
 
         print("DELETE NODE", nodeId)
         return True
@@ -294,6 +391,7 @@ class DialogDesigner(Service):
 
         node.node_type = NodeType.from_real_value(nodeType)
         node.save()
+        self._graph_changed(graph, nodes=[node.key])
 
         print("CHANGED NODE TYPE")
         return True
@@ -310,17 +408,20 @@ class DialogDesigner(Service):
             # either start node oder info node (no answers, only direct node-node connection)
             fromNode.connected_node = toNode
             fromNode.save()
+            self._graph_changed(graph, nodes=[fromNode.key])
         else:
             # neither start node nor info node (we do have an answer-node connection)
             answer: Answer = fromNode.answers.get(key=connection['sourceHandle'])
             answer.connected_node = toNode
             answer.save()
+            self._graph_changed(graph, nodes=[fromNode.key], answers=[answer.key])
 
         print("Added connection")
 
     def on_connection_delete(self, graphId: str, sourceNodeId: int, sourceHandle: int):
         graph: DialogGraph = DialogGraph.objects.get(uuid=graphId)
         fromNode: DialogNode = graph.nodes.get(key=sourceNodeId)
+        touched_answers = []
 
         fromNode.connected_node = None
         print("- FROM NODE", fromNode.key)
@@ -331,7 +432,9 @@ class DialogDesigner(Service):
             answer: Answer = fromNode.answers.get(key=sourceHandle)
             answer.connected_node = None
             answer.save()
+            touched_answers.append(answer.key)
         fromNode.save()
+        self._graph_changed(graph, nodes=[fromNode.key], answers=touched_answers)
 
         print("Deleted connection")
         
@@ -344,6 +447,7 @@ class DialogDesigner(Service):
 
         question = Question(key=faq['id'], text=faq['text'], node=node)
         question.save()
+        self._graph_changed(graph, questions=[question.key])
 
         print("ADDED FAQ", faq)
         return True
@@ -354,6 +458,7 @@ class DialogDesigner(Service):
 
         question: Question = node.questions.get(key=faqId)
         question.delete()
+        self._graph_changed(graph, questions=[faqId])
 
         print("DELETED FAQ")
 
@@ -367,6 +472,7 @@ class DialogDesigner(Service):
         question: Question = node.questions.get(key=faqId)
         question.text = text
         question.save()
+        self._graph_changed(graph, questions=[question.key])
 
         print("CHANGED FAQ TEXT", text)
         return True
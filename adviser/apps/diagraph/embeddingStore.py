@@ -0,0 +1,132 @@
+import fcntl
+import hashlib
+import os
+from threading import RLock
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    Persistent cache of sentence embeddings for one model, keyed by the sha1 hash of the embedded text.
+
+    Embeddings are appended to `<name>.f32` (float32 rows of size `embedding_dim`) and the text hashes to `<name>.keys` (one per line).
+    On startup, all stored rows are memory-mapped, so embeddings computed by previous runs don't have to be recomputed.
+    The files can be shared by several processes: appends and repairs hold an exclusive lock on `<name>.lock` (`fcntl.flock`).
+    """
+    KEY_LINE_SIZE = 41 # sha1 hex digest + newline
+    MAX_RECENT = 1024 # embeddings kept in memory before the files are re-mapped
+    def __init__(self, model_name: str, embedding_dim: int, cache_dir: str = '.models/embeddings') -> None:
+        self.embedding_dim = embedding_dim
+        self.lock = RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+        file_name = model_name.replace("/", "_")
+        self.vector_file = os.path.join(cache_dir, f"{file_name}.f32")
+        self.key_file = os.path.join(cache_dir, f"{file_name}.keys")
+        self.lock_file = os.path.join(cache_dir, f"{file_name}.lock")
+
+        self.rows: Dict[str, int] = {} # text hash -> row in `self.stored`
+        self.stored = np.zeros((0, embedding_dim), dtype=np.float32)
+        self.recent: Dict[str, np.ndarray] = {} # text hash -> embedding computed by this process (not memory-mapped yet)
+        self._load()
+
+    def _load(self):
+        with self.lock, self._file_lock():
+            num_rows = self._repair()
+            if num_rows == 0:
+                return
+            with open(self.key_file) as f:
+                keys = f.read().split()[:num_rows]
+        self.stored = np.memmap(self.vector_file, dtype=np.float32, mode='r', shape=(num_rows, self.embedding_dim))
+        self.rows = {key: row for row, key in enumerate(keys)}
+        self.recent = {}
+
+    def _file_lock(self):
+        """ Exclusive lock on the store files, shared by all processes using them (released when the returned file is closed) """
+        lock = open(self.lock_file, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _repair(self) -> int:
+        """
+        Drop incomplete rows (e.g. after a crash while writing), so that appended rows stay aligned with their keys.
+        Has to be called while holding the file lock. Returns the number of complete rows.
+        """
+        if not (os.path.isfile(self.vector_file) and os.path.isfile(self.key_file)):
+            open(self.vector_file, 'ab').close()
+            open(self.key_file, 'a').close()
+        row_size = 4 * self.embedding_dim
+        vector_size = os.path.getsize(self.vector_file)
+        key_size = os.path.getsize(self.key_file)
+        num_rows = min(vector_size // row_size, key_size // self.KEY_LINE_SIZE)
+        if vector_size != num_rows * row_size:
+            os.truncate(self.vector_file, num_rows * row_size)
+        if key_size != num_rows * self.KEY_LINE_SIZE:
+            os.truncate(self.key_file, num_rows * self.KEY_LINE_SIZE)
+        return num_rows
+
+    @staticmethod
+    def text_key(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, text: str) -> np.ndarray:
+        """ Returns the stored embedding for the given text or None """
+        key = self.text_key(text)
+        if key in self.rows:
+            return self.stored[self.rows[key]]
+        return self.recent.get(key)
+
+    def embed(self, texts: List[str], encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Returns the embeddings of all texts (#texts x embedding_dim).
+        Texts not in the store are encoded with a single call to `encode_fn` and persisted.
+        Empty texts are embedded as zero vectors.
+        """
+        embeddings, missing = self._lookup(texts)
+        if missing:
+            self._fill(embeddings, missing, encode_fn(list(missing.keys())))
+        return embeddings
+
+    async def embed_async(self, texts: List[str], encode_fn: Callable[[List[str]], Awaitable[np.ndarray]]) -> np.ndarray:
+        """ Same as `embed`, for coroutine encode functions """
+        embeddings, missing = self._lookup(texts)
+        if missing:
+            self._fill(embeddings, missing, await encode_fn(list(missing.keys())))
+        return embeddings
+
+    def _lookup(self, texts: List[str]) -> Tuple[np.ndarray, Dict[str, List[int]]]:
+        embeddings = np.zeros((len(texts), self.embedding_dim), dtype=np.float32)
+        missing: Dict[str, List[int]] = {} # text -> indices in `texts`
+        for index, text in enumerate(texts):
+            if not text:
+                continue
+            embedding = self.get(text)
+            if isinstance(embedding, type(None)):
+                missing.setdefault(text, []).append(index)
+            else:
+                embeddings[index] = embedding
+        return embeddings, missing
+
+    def _fill(self, embeddings: np.ndarray, missing: Dict[str, List[int]], new_embeddings: np.ndarray):
+        missing_texts = list(missing.keys())
+        new_embeddings = np.asarray(new_embeddings, dtype=np.float32).reshape(len(missing_texts), self.embedding_dim)
+        self._append(missing_texts, new_embeddings)
+        for text, embedding in zip(missing_texts, new_embeddings):
+            embeddings[missing[text]] = embedding
+
+    def _append(self, texts: List[str], embeddings: np.ndarray):
+        with self.lock:
+            keys = [self.text_key(text) for text in texts]
+            with self._file_lock():
+                # other processes append to the same files: the rows of one append are written while holding the lock
+                self._repair()
+                with open(self.vector_file, 'ab') as f:
+                    f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+                with open(self.key_file, 'a') as f:
+                    f.write("".join(f"{key}\n" for key in keys))
+            for key, embedding in zip(keys, embeddings):
+                self.recent[key] = embedding
+            if len(self.recent) > self.MAX_RECENT:
+                # map all rows (including those appended by other processes) instead of keeping copies in memory
+                self._load()
@@ -0,0 +1,129 @@
+import asyncio
+from dataclasses import dataclass
+from threading import RLock
+from typing import Awaitable, Callable, Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+from apps.diagraph.data.dialogGraph import Question
+from apps.diagraph.graphEvents import GraphChange
+
+
+@dataclass
+class FAQSearchResult:
+    query: str
+    similarity: float
+    top_k: int
+    goal_node_key: int
+
+
+class FAQIndex:
+    """
+    Embeddings of all FAQ questions of a graph, stored as rows of one contiguous (L2-normalized) float32 matrix,
+    so the top-k questions for an utterance are found with a single matrix-vector product.
+    Rows are added / replaced / removed in place when questions change (see `mark_stale`), the matrix grows by doubling.
+    """
+    def __init__(self, graph_id: str, embedding_dim: int, capacity: int = 64) -> None:
+        self.graph_id = graph_id
+        self.embedding_dim = embedding_dim
+        self.size = 0
+        self.matrix = np.zeros((capacity, embedding_dim), dtype=np.float32)
+        self.node_keys = np.zeros(capacity, dtype=np.int64)
+        self.question_keys: List[int] = [] # row -> question key
+        self.rows: Dict[int, int] = {}     # question key -> row
+        self.stale: Set[int] = set()       # question keys to reload from the database
+        self.loaded = False
+        self.lock = None # created on first use (inside the event loop)
+
+    def mark_stale(self, question_keys: Iterable[int]):
+        self.stale.update(question_keys)
+
+    async def refresh(self, embed_fn: Callable[[List[str]], Awaitable[np.ndarray]]):
+        """ Loads all questions on first use, afterwards only re-embeds questions that were added, changed or deleted """
+        if self.loaded and not self.stale:
+            return
+        if isinstance(self.lock, type(None)):
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # keys marked while embedding (or if embedding fails) stay stale for the next refresh
+            stale = set(self.stale)
+            if not self.loaded:
+                questions = Question.objects.filter(node__graph_id=self.graph_id)
+            elif stale:
+                questions = Question.objects.filter(node__graph_id=self.graph_id, key__in=stale)
+            else:
+                return
+            questions = list(questions.values_list('key', 'node__key', 'text'))
+            embeddings = await embed_fn([text for _, _, text in questions]) if questions else np.zeros((0, self.embedding_dim), dtype=np.float32)
+            found = set(key for key, _, _ in questions)
+            for key in stale:
+                if not key in found:
+                    self._remove(key)
+            for (key, node_key, _), embedding in zip(questions, embeddings):
+                self._set(key, node_key, embedding)
+            self.stale -= stale
+            self.loaded = True
+
+    def _set(self, question_key: int, node_key: int, embedding: np.ndarray):
+        row = self.rows.get(question_key)
+        if isinstance(row, type(None)):
+            if self.size == len(self.matrix):
+                self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+                self.node_keys = np.concatenate([self.node_keys, np.zeros_like(self.node_keys)])
+            row = self.size
+            self.size += 1
+            self.rows[question_key] = row
+            self.question_keys.append(question_key)
+        norm = np.linalg.norm(embedding)
+        self.matrix[row] = embedding / norm if norm > 0 else 0.0
+        self.node_keys[row] = node_key
+
+    def _remove(self, question_key: int):
+        """ Move the last row into the gap, so the rows stay contiguous """
+        row = self.rows.pop(question_key, None)
+        if isinstance(row, type(None)):
+            return
+        last = self.size - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.node_keys[row] = self.node_keys[last]
+            self.question_keys[row] = self.question_keys[last]
+            self.rows[self.question_keys[row]] = row
+        self.question_keys.pop()
+        self.size = last
+
+    def search(self, query: str, query_embedding: np.ndarray, k: int = 1) -> List[FAQSearchResult]:
+        """ The `k` questions with the highest cosine similarity to the query (best first) """
+        if self.size == 0:
+            return []
+        norm = np.linalg.norm(query_embedding)
+        if norm == 0:
+            return []
+        scores = self.matrix[:self.size] @ (np.asarray(query_embedding, dtype=np.float32) / norm)
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k] if k < self.size else np.arange(self.size)
+        top = top[np.argsort(-scores[top])]
+        return [FAQSearchResult(query=query, similarity=float(scores[row]), top_k=rank, goal_node_key=int(self.node_keys[row])) for rank, row in enumerate(top)]
+
+
+class FAQIndexCache:
+    """ FAQ indices per (graph, embedding model), kept up to date by `graph.changed` events """
+    def __init__(self) -> None:
+        self.lock = RLock()
+        self.indices: Dict[Tuple[str, str], FAQIndex] = {}
+
+    def get(self, graph_id: str, model_name: str, embedding_dim: int) -> FAQIndex:
+        with self.lock:
+            if not (str(graph_id), model_name) in self.indices:
+                self.indices[(str(graph_id), model_name)] = FAQIndex(str(graph_id), embedding_dim)
+            return self.indices[(str(graph_id), model_name)]
+
+    def apply_change(self, change: GraphChange):
+        with self.lock:
+            for (graph_id, model_name) in list(self.indices.keys()):
+                if graph_id != change.graph_id:
+                    continue
+                if change.reload:
+                    del self.indices[(graph_id, model_name)]
+                elif change.questions:
+                    self.indices[(graph_id, model_name)].mark_stale(change.questions)
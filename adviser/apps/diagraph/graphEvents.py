@@ -0,0 +1,51 @@
+from dataclasses import asdict, dataclass, field
+from typing import List
+
+from autobahn.wamp import SubscribeOptions
+
+
+# published as `graph.changed.<graph uuid>` by the dialog designer after every modification of a graph
+GRAPH_CHANGED_TOPIC = "graph.changed"
+
+
+@dataclass
+class GraphChange:
+    """
+    Describes a single modification of a dialog graph.
+
+    Args:
+        graph_id: uuid of the modified graph
+        version: graph version after the modification (see `DialogGraph.bump_version`)
+        nodes: keys of all nodes whose content, answers or outgoing connections changed (including deleted nodes)
+        answers: keys of all added, changed or deleted answers
+        questions: keys of all added, changed or deleted FAQ questions
+        tables: ids of all added, renamed or deleted data tables
+        reload: if True, the whole graph was replaced (e.g. by a file import) and all cached data should be dropped
+    """
+    graph_id: str
+    version: int
+    nodes: List[int] = field(default_factory=list)
+    answers: List[int] = field(default_factory=list)
+    questions: List[int] = field(default_factory=list)
+    tables: List[int] = field(default_factory=list)
+    reload: bool = False
+
+
+def publish_graph_changed(session, change: GraphChange):
+    session.publish(f"{GRAPH_CHANGED_TOPIC}.{change.graph_id}", **asdict(change))
+
+
+class GraphChangeListener:
+    """
+    Mixin for services holding per-graph caches: subscribes to all `graph.changed` events and forwards them to `on_graph_changed`.
+    Has to be listed before `Service` in the base classes.
+    """
+    async def _register(self, session):
+        await super()._register(session)
+        await session.subscribe(self._on_graph_changed, GRAPH_CHANGED_TOPIC, options=SubscribeOptions(match="prefix"))
+
+    def _on_graph_changed(self, **kwargs):
+        self.on_graph_changed(GraphChange(**kwargs))
+
+    def on_graph_changed(self, change: GraphChange):
+        pass
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+import traceback
+from typing import List, Union
+
+from django.db.models import Max
+
+from apps.diagraph.compiledGraph import CompiledGraph, compiled_graphs
+from apps.diagraph.data.dialogGraph import DialogGraph, NodeType
+from apps.diagraph.similarityMatchingNLU import SentenceEmbeddings, SimilarityMatchingNLU
+from services.service import Service
+
+
+WARMUP_STATUS_RPC = "dialogsystem.warmup.status"
+WARMUP_PROGRESS_TOPIC = "dialogsystem.warmup.progress"
+
+
+class GraphWarmup(Service):
+    """
+    Background warm-up after startup: compiles graphs and embeds their answers and FAQ questions,
+    most recently used graphs (by conversation log activity) first, so their first users don't pay for it.
+
+    Progress is available via the `dialogsystem.warmup.status` RPC and published on `dialogsystem.warmup.progress`.
+    The system counts as ready once the `hot_graphs` most active graphs are warm; then `ready_file` is created
+    (e.g. for container health checks), while the remaining graphs are warmed up in the background.
+    The warm-up waits for pending database migrations (applied by the django container) and reports ready
+    after `timeout` seconds at the latest, so services waiting for it are never blocked forever.
+    """
+    EMBEDDING_CHUNK_SIZE = 256 # answer texts per inference job, so user requests don't wait behind a whole graph
+
+    MIGRATION_POLL_INTERVAL = 5.0 # seconds
+
+    def __init__(self, nlu: SimilarityMatchingNLU, hot_graphs: int = 10, max_graphs: int = -1, ready_file: str = None, timeout: float = 900.0,
+                    identifier: str = "graphWarmup", transports: str = "ws://localhost:8080/ws", realm="adviser") -> None:
+        super().__init__(identifier=identifier, transports=transports, realm=realm)
+        self.nlu = nlu
+        self.hot_graphs = hot_graphs
+        self.max_graphs = max_graphs # -1: all graphs
+        self.ready_file = ready_file
+        self.timeout = timeout # seconds until the system counts as ready anyway (< 0: wait for the hot graphs)
+        if ready_file and os.path.isfile(ready_file):
+            os.remove(ready_file) # left over from a previous run
+
+        self.graphs_total = 0
+        self.graphs_warm = 0
+        self.graphs_failed = 0
+        self.current: Union[str, None] = None
+        self.ready = False
+        self.finished = False
+        self.start_time = None
+        self.ready_time = None
+        self.task = None
+
+    async def _register(self, session):
+        await super()._register(session)
+        await session.register(self.status, WARMUP_STATUS_RPC)
+        self.task = asyncio.get_event_loop().create_task(self.warm_up(session))
+
+    def status(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        return {
+            "ready": self.ready,
+            "finished": self.finished,
+            "graphs_total": self.graphs_total,
+            "graphs_warm": self.graphs_warm,
+            "graphs_failed": self.graphs_failed,
+            "hot_graphs": min(self.hot_graphs, self.graphs_total),
+            "current": self.current,
+            "elapsed_s": elapsed,
+            "ready_after_s": self.ready_time,
+        }
+
+    def graphs_by_activity(self) -> List[str]:
+        """ uuids of all graphs, most recent conversation first (log indices are increasing), unused graphs last """
+        graphs = DialogGraph.objects.annotate(last_log=Max('logs__log_index')).order_by('-last_log').values_list('uuid', 'last_log')
+        used = [str(uuid) for uuid, last_log in graphs if not isinstance(last_log, type(None))]
+        unused = [str(uuid) for uuid, last_log in graphs if isinstance(last_log, type(None))]
+        graph_ids = used + unused
+        return graph_ids if self.max_graphs < 0 else graph_ids[:self.max_graphs]
+
+    async def warm_graph(self, graph_id: str):
+        graph: CompiledGraph = compiled_graphs.get(graph_id)
+        async with self.nlu.embeddings.use(graph.similarity_model) as embeddings:
+            await self._embed_graph(graph, embeddings)
+
+    async def _embed_graph(self, graph: CompiledGraph, embeddings: SentenceEmbeddings):
+
+        # answers are only matched by embedding in user response nodes (see `SimilarityMatchingNLU._match_answer`)
+        nodes = [node for node in graph.nodes.values()
+                    if node.node_type == NodeType.QUESTION and node.answers and not embeddings.cache_name in node.answer_embeddings]
+        chunks = [[]]
+        num_texts = 0
+        for node in nodes:
+            if num_texts >= self.EMBEDDING_CHUNK_SIZE:
+                chunks.append([])
+                num_texts = 0
+            chunks[-1].append(node)
+            num_texts += len(node.answers)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            answer_embs = await embeddings.embed_texts([answer.text for node in chunk for answer in node.answers])
+            offset = 0
+            for node in chunk:
+                node.answer_embeddings.setdefault(embeddings.cache_name, answer_embs[offset:offset+len(node.answers)])
+                offset += len(node.answers)
+
+        faq_index = self.nlu.faq_indices.get(graph.uuid, embeddings.cache_name, embeddings.embedding_dim)
+        await faq_index.refresh(embeddings.embed_texts_numpy)
+
+    async def warm_up(self, session):
+        self.start_time = time.perf_counter()
+        if self.timeout >= 0:
+            asyncio.get_event_loop().call_later(self.timeout, self._on_timeout)
+        await self.wait_for_migrations()
+        try:
+            graph_ids = self.graphs_by_activity()
+        except:
+            # e.g. database not migrated: nothing to warm up, graphs are compiled on first use
+            traceback.print_exc()
+            graph_ids = []
+        self.graphs_total = len(graph_ids)
+        print(f"Warming up {len(graph_ids)} graphs ({min(self.hot_graphs, len(graph_ids))} most active first)")
+        for graph_id in graph_ids:
+            if self.graphs_warm + self.graphs_failed >= self.hot_graphs:
+                self._set_ready()
+            self.current = graph_id
+            try:
+                await self.warm_graph(graph_id)
+                self.graphs_warm += 1
+            except:
+                traceback.print_exc()
+                self.graphs_failed += 1
+            session.publish(WARMUP_PROGRESS_TOPIC, **self.status())
+        self.current = None
+        self.finished = True
+        self._set_ready()
+        session.publish(WARMUP_PROGRESS_TOPIC, **self.status())
+        print(f"Warm-up finished after {time.perf_counter() - self.start_time:.1f}s: {self.graphs_warm} graphs warm, {self.graphs_failed} failed")
+
+    def pending_migrations(self) -> int:
+        from django.db import connection
+        from django.db.migrations.executor import MigrationExecutor
+        executor = MigrationExecutor(connection)
+        return len(executor.migration_plan(executor.loader.graph.leaf_nodes()))
+
+    async def wait_for_migrations(self):
+        """ Graphs compiled against an outdated schema would fail, wait until the migrations are applied (or the timeout is over) """
+        while not self.ready:
+            try:
+                pending = self.pending_migrations()
+            except:
+                traceback.print_exc()
+                return
+            if pending == 0:
+                return
+            print(f"Warm-up: waiting for {pending} database migrations")
+            await asyncio.sleep(self.MIGRATION_POLL_INTERVAL)
+
+    def _on_timeout(self):
+        if not self.ready:
+            print(f"Warm-up: not finished after {self.timeout:.0f}s, reporting ready (warm-up continues in the background)")
+            self._set_ready()
+
+    def _set_ready(self):
+        if self.ready:
+            return
+        self.ready = True
+        self.ready_time = time.perf_counter() - self.start_time
+        print(f"Warm-up: {self.graphs_warm} most active graphs ready after {self.ready_time:.1f}s")
+        if self.ready_file:
+            os.makedirs(os.path.dirname(self.ready_file) or ".", exist_ok=True)
+            with open(self.ready_file, "w") as f:
+                f.write(f"{self.graphs_warm}\n")
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+import numpy as np
+
+
+_worker = threading.local() # model of the current worker thread / process
+
+
+def _init_worker(model_loader: Callable[[], Any]):
+    _worker.model = model_loader()
+
+
+def _run_with_model(fn: Callable, *args):
+    return fn(_worker.model, *args)
+
+
+class SentenceTransformerLoader:
+    """ Picklable model factory, called once in each worker (thread workers share the model via the model registry) """
+    def __init__(self, pretrained_name: str, device: str = 'cpu', cache_folder: str = '.models') -> None:
+        self.pretrained_name = pretrained_name
+        self.device = device
+        self.cache_folder = cache_folder
+
+    def __call__(self):
+        from apps.diagraph.modelRegistry import sentence_transformer
+        return sentence_transformer(self.pretrained_name, device=self.device, cache_folder=self.cache_folder)
+
+
+def encode_texts(model, texts) -> np.ndarray:
+    """ Batched sentence embeddings (#texts x embedding_dim) """
+    import torch
+    with torch.no_grad():
+        return model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+
+
+def embedding_dimension(model) -> int:
+    return model.get_sentence_embedding_dimension()
+
+
+def model_memory(model) -> int:
+    """ Size of the model's parameters and buffers in bytes """
+    from apps.diagraph.modelRegistry import parameter_memory
+    return parameter_memory(model)
+
+
+class InferenceExecutor:
+    """
+    Runs model inference in a pool of workers (threads or processes), so the asyncio event loop
+    (WAMP session, routing, database access) keeps running while a model is busy.
+
+    Each worker loads its own model once on startup (`model_loader`); jobs are functions `fn(model, *args)`
+    (module level functions for process pools, so they can be pickled).
+    At most `max_queue` jobs are submitted at the same time, further callers wait (backpressure).
+    """
+    def __init__(self, model_loader: Callable[[], Any], kind: str = 'thread', workers: int = 1, max_queue: int = 64) -> None:
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        if kind == 'process':
+            self.pool: Executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(model_loader,))
+        elif kind == 'thread':
+            self.pool: Executor = ThreadPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(model_loader,), thread_name_prefix='inference')
+        else:
+            raise ValueError(f"Unknown inference executor '{kind}', expected 'thread' or 'process'")
+        self.slots = None # created on first use (inside the event loop)
+
+        # backpressure metrics
+        self.waiting = 0     # jobs waiting for a free slot
+        self.in_flight = 0   # jobs submitted to the pool (queued or running)
+        self.completed = 0
+        self.failed = 0
+        self.max_in_flight = 0
+        self.max_waiting = 0
+        self.total_wait_time = 0.0  # seconds spent waiting for a free slot
+        self.total_run_time = 0.0   # seconds from submission until the result was available
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """ Runs `fn(model, *args)` on a worker and returns its result """
+        if isinstance(self.slots, type(None)):
+            self.slots = asyncio.Semaphore(self.max_queue)
+        start = time.perf_counter()
+        if self.slots.locked():
+            # all slots taken: wait until a running job finishes
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+        submitted = time.perf_counter()
+        self.total_wait_time += submitted - start
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.pool, _run_with_model, fn, *args)
+            self.completed += 1
+            return result
+        except:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.total_run_time += time.perf_counter() - submitted
+            self.slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "max_waiting": self.max_waiting,
+            "max_in_flight": self.max_in_flight,
+            "avg_wait_ms": 1000 * self.total_wait_time / finished if finished else 0.0,
+            "avg_run_ms": 1000 * self.total_run_time / finished if finished else 0.0,
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,79 @@
+import os
+import time
+from threading import RLock
+from typing import Any, Callable, Dict, Tuple
+
+
+def _resident_memory() -> int:
+    """ Current resident set size of this process in bytes (0 if unavailable) """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except:
+        return 0
+
+
+def parameter_memory(model: Any) -> int:
+    """ Size of all parameters and buffers of a torch module in bytes (0 for other objects) """
+    if hasattr(model, 'memory_size'):
+        return model.memory_size()
+    try:
+        return sum(tensor.numel() * tensor.element_size() for tensor in list(model.parameters()) + list(model.buffers()))
+    except:
+        return 0
+
+
+class LoadedModel:
+    __slots__ = ('name', 'device', 'model', 'memory', 'load_time')
+
+    def __init__(self, name: str, device: str, model: Any, memory: int, load_time: float) -> None:
+        self.name = name
+        self.device = device
+        self.model = model
+        self.memory = memory # bytes
+        self.load_time = load_time # seconds
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of loaded models, keyed by (model name, device).
+    Each model is loaded on first use and the same instance is shared by all services of the process.
+    """
+    def __init__(self) -> None:
+        self.lock = RLock()
+        self.models: Dict[Tuple[str, str], LoadedModel] = {}
+
+    def get(self, name: str, device: str, loader: Callable[[], Any]) -> Any:
+        """ Returns the model registered under (name, device), calling `loader` if it wasn't loaded yet """
+        with self.lock:
+            if not (name, device) in self.models:
+                rss_before = _resident_memory()
+                start = time.perf_counter()
+                model = loader()
+                load_time = time.perf_counter() - start
+                # parameters might live on a GPU, RSS also covers tokenizers etc.
+                memory = max(_resident_memory() - rss_before, parameter_memory(model))
+                self.models[(name, device)] = LoadedModel(name=name, device=device, model=model, memory=memory, load_time=load_time)
+                print(f"Loaded model {name} ({device}) in {load_time:.1f}s, {memory / 2**20:.0f} MB")
+            return self.models[(name, device)].model
+
+    def unload(self, name: str, device: str):
+        """ Drop the registry's reference, the model is freed once no service uses it anymore """
+        with self.lock:
+            self.models.pop((name, device), None)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """ Memory per loaded model in bytes ("name (device)" -> bytes) """
+        with self.lock:
+            return {f"{entry.name} ({entry.device})": entry.memory for entry in self.models.values()}
+
+
+def sentence_transformer(name: str, device: str = 'cpu', cache_folder: str = '.models'):
+    """ Shared `SentenceTransformer` instance """
+    def load():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(name, device=device, cache_folder=cache_folder)
+    return models.get(name, device, load)
+
+
+models = ModelRegistry()
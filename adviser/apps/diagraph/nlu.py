@@ -1,4 +1,7 @@
-from typing import Dict, List, Optional, Union
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import re
 import json
 import datetime
@@ -14,6 +17,44 @@ with open(resource_dir / 'months.json', 'r') as f:
 
 WEEKDAYS = {'montag': 1, 'dienstag': 2, 'mittwoch': 3, 'donnerstag': 4, 'freitag': 5, 'samstag': 6, 'sonntag': 7}
 
+# date relative time words are resolved against (None: today), see `NLU.extract_time`
+_reference_date: ContextVar[Optional[datetime.date]] = ContextVar('reference_date', default=None)
+
+
+def _today() -> datetime.date:
+    reference_date = _reference_date.get()
+    return reference_date if reference_date else datetime.date.today()
+
+
+# all patterns are compiled once at import
+_ones_string = "|".join(NUMBERS['ones'])
+_tens_string = "|".join(NUMBERS['tens'])
+_ones_ordinal_string = "|".join(NUMBERS['ones_ordinal'])
+_tens_ordinal_string = "|".join(NUMBERS['tens_ordinal'])
+_months_string = "|".join(MONTHS.keys())
+_weekdays_string = "|".join(WEEKDAYS.keys())
+
+# recognition of numbers and time words (one pass over the utterance each)
+DIGITS_REGEX = re.compile(r'[0-9]+([.:][0-9]+)*')
+NUM_WORD_REGEX = re.compile(fr'\b((?P<thousand>(?P<ones_thousand>{_ones_string})?tausend)?(?P<hundred>(?P<ones_hundred>{_ones_string})?hundert)?'
+                            fr'((?P<ones_with_tens>{_ones_string})?(und)?(?P<tens>{_tens_string})|'
+                            fr'(?P<ones>{_ones_string}))|(?P<single>{NUMBERS["single"]}))\b')
+NUM_WORD_ORDINAL_REGEX = re.compile(fr'\b((?P<thousand>(?P<ones_thousand>{_ones_string})?tausendste(r|n|m)?)|'
+                                    fr'(?P<hundred>(?P<ones_hundred>{_ones_string})?hundertste(r|n|m)?)|'
+                                    fr'(?P<ones_with_tens>{_ones_string})?(und)?(?P<tens>{_tens_ordinal_string})|'
+                                    fr'(?P<ones>{_ones_ordinal_string})|(?P<single>{NUMBERS["single"]}))\b')
+TIME_WORD_REGEX = re.compile(fr'(heute|gestern|vorgestern|morgen|übermorgen|'
+                             fr'(letzten|nächsten|kommenden)\s*({_weekdays_string})|'
+                             fr'|(letzte|nächste|kommende)\s*woche\s*({_weekdays_string}))')
+
+# context of a recognized number, matched at the number's position
+UNIT_REGEX = re.compile(fr'\s*((?P<hours>stunden?)|(?P<days>tag(en|e)?)|(?P<weeks>wochen?)|(?P<months>monate?)|'
+                        fr'(?P<time>uhr)|(?P<month>{_months_string}))') # directly after a number
+SINCE_UNTIL_REGEX = re.compile(r'(?P<since>seit\s*(dem\s*)?)|(?P<until>bis\s*(zum\s*)?)') # directly before a number
+BETWEEN_REGEX = re.compile(r'zwischen\s*') # directly before the first of two numbers
+NUMBER_GAP_REGEX = re.compile(fr'(?P<from_to>\s*bis (zum)?\s*)|(?P<from_to_hyphen>\s*-\s*)|(?P<between>\s*und\s*)|'
+                              fr'(?P<time>\s*uhr\s*)|(?P<month>\.?\s*({_months_string})\s*)') # text between two adjacent numbers
+
 
 class Number:
 
@@ -166,18 +207,18 @@ class TimePoint:
         # converts the numerical values of the TimePoint into a time object (either datetime.date or datetime.time)
         if self.unit == 'day':
             if isinstance(self.number_value, int):  # if only one int value is given, assume that it is the day
-                today = datetime.date.today()
+                today = _today()
                 return datetime.date(year=today.year, month=today.month, day=self.number_value)
             elif isinstance(self.number_value, tuple):
                 if len(self.number_value) == 2:  # if a tuple of two numbers is given, assume that it is (day, month)
                     day, month = self.number_value
-                    year = datetime.date.today().year
+                    year = _today().year
                     return datetime.date(year=year, month=month, day=day)
                 elif len(self.number_value) == 3:  # if a tuple of three numbers is given, assume that it is
                     # (day, month, year)
                     day, month, year = self.number_value
                     if year < 100:  # convert abbreviated years (e.g. 21 instead of 2021) into the full number
-                        if year <= ((datetime.date.today().year + 10) - 2000):
+                        if year <= ((_today().year + 10) - 2000):
                             year = 2000 + year
                         else:
                             year = 1900 + year
@@ -205,7 +246,7 @@ class TimePoint:
             'morgen': datetime.timedelta(days=1),
             'übermorgen': datetime.timedelta(days=2)
         }
-        today = datetime.date.today()
+        today = _today()
 
         if time_word in fixed_intervals:
             return today + fixed_intervals[time_word]
@@ -255,13 +296,13 @@ class TimeSpan:
         # if something like 'seit gestern', add a span from yesterday to today (24 hours)
         if self.number_from and not self.number_to and self.relation == 'since':
             if self.number_from.unit == 'day':
-                self.number_to = TimePoint(time_object=datetime.date.today())
+                self.number_to = TimePoint(time_object=_today())
             elif self.number_from.unit == 'day':
                 self.number_to = TimePoint(time_object=datetime.datetime.now().time())
         # if something like 'bis übermorgen', add a span from today to in two days (48 hours)
         elif self.number_to and not self.number_from and self.relation == 'until':
             if self.number_to.unit == 'day':
-                self.number_from = TimePoint(time_object=datetime.date.today())
+                self.number_from = TimePoint(time_object=_today())
             elif self.number_to.unit == 'day':
                 self.number_from = TimePoint(time_object=datetime.datetime.now().time())
 
@@ -317,8 +358,17 @@ class TimeSpan:
 
 class NLU:
 
-    def __init__(self):
+    def __init__(self, cache_size: int = 4096):
         # class for recognizing country and city names as well as time expressions in text
+
+        # results of `extract_time` per (normalized utterance, date), least recently used first;
+        # the date is part of the key because relative words like 'morgen' depend on it
+        self.cache_size = cache_size
+        self.time_cache: Dict[Tuple[str, datetime.date], dict] = OrderedDict()
+        self.cache_date = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         # with open(resource_dir / 'country_synonyms.json', 'r') as f:
         #     country_synonyms = json.load(f)
         #     self.countries = {country.lower(): country for country in country_synonyms.keys()}
@@ -352,8 +402,68 @@ class NLU:
     #         'LAND': [self.countries[country] for country in found_countries]  # list of country names
     #     }
 
-    def extract_time(self, user_utterance: str):
-        # extract time points and time spans
+    def extract_time(self, user_utterance: str, reference_date: Optional[datetime.date] = None):
+        # extract time points and time spans (cached, see `cache_info`)
+        # relative time words ('morgen') are resolved from the reference date (default: today)
+        today = datetime.date.today()
+        if today != self.cache_date:
+            # after midnight, relative time words resolve to different dates
+            self.time_cache.clear()
+            self.cache_date = today
+        key = (user_utterance.lower().strip(), reference_date if reference_date else today)
+        if key in self.time_cache:
+            self.cache_hits += 1
+            self.time_cache.move_to_end(key)
+        else:
+            self.cache_misses += 1
+            token = _reference_date.set(key[1])
+            try:
+                result = self._extract_time(key[0])
+            finally:
+                _reference_date.reset(token)
+            if self.cache_size <= 0:
+                return result
+            self.time_cache[key] = result
+            if len(self.time_cache) > self.cache_size:
+                self.time_cache.popitem(last=False)
+        # copy the lists, callers may store or modify them (e.g. in the beliefstate)
+        return {name: list(values) for name, values in self.time_cache[key].items()}
+
+    def cache_info(self) -> dict:
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self.time_cache), "max_size": self.cache_size}
+
+    def extract_times(self, utterances: Iterable[str], reference_date: Optional[datetime.date] = None, processes: int = 0,
+                      chunk_size: int = 256) -> Iterator[dict]:
+        # extract time points and time spans from a stream of utterances (e.g. logged user inputs), results are yielded
+        # lazily in input order; with processes > 0, chunks of utterances are distributed over a process pool, keeping
+        # at most two chunks per process in flight, so memory stays flat for arbitrarily long inputs
+        if processes <= 0:
+            for utterance in utterances:
+                yield self.extract_time(utterance, reference_date)
+            return
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            pending = deque()
+            try:
+                chunk = []
+                for utterance in utterances:
+                    chunk.append(utterance)
+                    if len(chunk) < chunk_size:
+                        continue
+                    pending.append(pool.submit(_extract_times_chunk, chunk, reference_date))
+                    chunk = []
+                    if len(pending) >= 2 * processes:
+                        yield from pending.popleft().result()
+                if chunk:
+                    pending.append(pool.submit(_extract_times_chunk, chunk, reference_date))
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                # consumer stopped early: don't compute the remaining chunks
+                for future in pending:
+                    future.cancel()
+
+    def _extract_time(self, user_utterance: str):
         user_utterance = user_utterance.lower()
         found_numbers = self._recognize_numbers(user_utterance)  # numbers like '1', 'eins', 'erster'
         found_time_words = self._recognize_time_words(user_utterance)  # words like 'morgen', 'nächsten Montag'
@@ -395,54 +505,31 @@ class NLU:
         # 'zweitausend'), or (c) ordinal number words ('erster', 'dreizehnte', 'zweitausendstem')
 
         # (a) digits
-        digits_regex = re.compile(r'[0-9]+([.:][0-9]+)*')
         found_digits = [Number(number_string=match.group(0), position_in_utterance=match.span())
-                        for match in digits_regex.finditer(user_utterance)]
+                        for match in DIGITS_REGEX.finditer(user_utterance)]
 
         # (b) number words
-        ones_string = "|".join(NUMBERS['ones'])
-        tens_string = "|".join(NUMBERS['tens'])
-        hundreds_string = f'(?P<ones_hundred>{ones_string})?hundert'
-        thousands_string = f'(?P<ones_thousand>{ones_string})?tausend'
-        num_word_regex = re.compile(fr'\b((?P<thousand>{thousands_string})?(?P<hundred>{hundreds_string})?'
-                                    fr'((?P<ones_with_tens>{ones_string})?(und)?(?P<tens>{tens_string})|'
-                                    fr'(?P<ones>{ones_string}))|(?P<single>{NUMBERS["single"]}))\b')
         found_num_words = [Number(number_string=match.group(0), position_in_utterance=match.span(),
-                                  match_dict=match.groupdict()) for match in num_word_regex.finditer(user_utterance)]
+                                  match_dict=match.groupdict()) for match in NUM_WORD_REGEX.finditer(user_utterance)]
 
         # (c) ordinal number words
-        ones_ordinal_string = "|".join(NUMBERS['ones_ordinal'])
-        tens_ordinal_string = "|".join(NUMBERS['tens_ordinal'])
-        hundreds_ordinal_string = f'(?P<ones_hundred>{ones_string})?hundertste(r|n|m)?'
-        thousands_ordinal_string = f'(?P<ones_thousand>{ones_string})?tausendste(r|n|m)?'
-        num_word_ordinal_regex = re.compile(fr'\b((?P<thousand>{thousands_ordinal_string})|'
-                                            fr'(?P<hundred>{hundreds_ordinal_string})|'
-                                            fr'(?P<ones_with_tens>{ones_string})?(und)?(?P<tens>{tens_ordinal_string})|'
-                                            fr'(?P<ones>{ones_ordinal_string})|(?P<single>{NUMBERS["single"]}))\b')
         found_num_ordinal_words = [Number(number_string=match.group(0), position_in_utterance=match.span(),
                                           match_dict=match.groupdict(), ordinal=True)
-                                   for match in num_word_ordinal_regex.finditer(user_utterance)]
+                                   for match in NUM_WORD_ORDINAL_REGEX.finditer(user_utterance)]
 
         return found_digits + found_num_words + found_num_ordinal_words
 
     def _recognize_time_words(self, user_utterance: str):
         # recognize time words that are in relation to the current day, like 'heute', 'vorgestern', 'letzten Samstag'
-        weekdays_string = "|".join(WEEKDAYS.keys())
-        time_word_regex = re.compile(fr'(heute|gestern|vorgestern|morgen|übermorgen|'
-                                     fr'(letzten|nächsten|kommenden)\s*({weekdays_string})|'
-                                     fr'|(letzte|nächste|kommende)\s*woche\s*({weekdays_string}))')
         return [Number(number_string=match.group(0), position_in_utterance=match.span())
-                for match in time_word_regex.finditer(user_utterance) if match.group(0)]
+                for match in TIME_WORD_REGEX.finditer(user_utterance) if match.group(0)]
 
 
     def _extract_time_unit(self, user_utterance: str, number: Number):
         # recognize the unit of the number; e.g. '3 Tage' means a duration over three days but '3 Uhr' means a time
         # point at a certain hour
         # also recognize if a month is given with its name, e.g '3. März'
-        months_string = "|".join(MONTHS.keys())
-        unit_regex = re.compile(fr'{number.original_string}\s*((?P<hours>stunden?)|(?P<days>tag(en|e)?)|(?P<weeks>wochen?)|(?P<months>monate?)|'
-                                fr'(?P<time>uhr)|(?P<month>{months_string}))')
-        match = re.search(unit_regex, user_utterance)
+        match = UNIT_REGEX.match(user_utterance, number.end_position)
         if match:
             for unit, found_string in match.groupdict().items():
                 if found_string:
@@ -457,13 +544,13 @@ class NLU:
         until_spans = {}
 
         # (a) time span between the current day and the recognized day (e.g. 'seit gestern', 'bis morgen')
+        # 'seit' / 'bis' ending at each position of the utterance (single pass)
+        since_until = {match.end(): match for match in SINCE_UNTIL_REGEX.finditer(user_utterance)}
         for time_match in time_numbers:
             match_string = time_match.original_string
             if not match_string:
                 continue
-            single_time_regex = re.compile(fr'((?P<since>seit\s*(dem\s*)?{match_string})|'
-                                           fr'(?P<until>bis\s*(zum\s*)?{match_string}))')
-            match = re.search(single_time_regex, user_utterance)
+            match = since_until.get(time_match.start_position)
             if match:
                 for label, found_string in match.groupdict().items():
                     if found_string:
@@ -478,20 +565,19 @@ class NLU:
         # (b) time span between two time points
         # might also just extend time points that consist of several numbers (like '1 Uhr 30' or '1. Juni 1987')
         if len(time_numbers) > 1:
-            months_string = "|".join(MONTHS.keys())
+            between_ends = set(match.end() for match in BETWEEN_REGEX.finditer(user_utterance))
             for match_1, match_2 in list(zip(time_numbers[:-1], time_numbers[1:])):
                 string_1, string_2 = match_1.original_string, match_2.original_string
-                if not string_1 or not string_2:
+                if not string_1 or not string_2 or match_1.end_position > match_2.start_position:
                     continue
-                multi_time_regex = re.compile(fr'((?P<from_to>(vo(n|m))?\s*{string_1}\s*bis (zum)?\s*{string_2})|'
-                                              fr'(?P<from_to_hyphen>{string_1}\s*-\s*{string_2})|'
-                                              fr'(?P<between>zwischen\s*{string_1}\s*und\s*{string_2})|'
-                                              fr'(?P<time>{string_1}\s*uhr\s*{string_2})|'
-                                              fr'(?P<month>{string_1}\.?\s*({months_string})\s*{string_2}))')
-                match = re.search(multi_time_regex, user_utterance)
+                # classify the text between the two numbers
+                match = NUMBER_GAP_REGEX.fullmatch(user_utterance, match_1.end_position, match_2.start_position)
                 if match:
-                    for label, found_string in match.groupdict().items():
-                        if found_string:
+                    found_string = user_utterance[match_1.start_position:match_2.end_position]
+                    for label, gap_string in match.groupdict().items():
+                        if gap_string:
+                            if label == 'between' and not match_1.start_position in between_ends:
+                                continue
                             if label == 'from_to' and match_2 in until_spans:
                                 # in 'von 1 bis 3', the 'bis 3' is not in reference to the current day (see (a))
                                 del until_spans[match_2]
@@ -552,6 +638,16 @@ class NLU:
         time_numbers = list(set(time_numbers) - set(remove_time_numbers))
         return time_numbers, time_spans
 
+_worker_nlu = None # one NLU (and time cache) per worker process of `NLU.extract_times`
+
+
+def _extract_times_chunk(utterances: List[str], reference_date: Optional[datetime.date]) -> List[dict]:
+    global _worker_nlu
+    if _worker_nlu is None:
+        _worker_nlu = NLU()
+    return [_worker_nlu.extract_time(utterance, reference_date) for utterance in utterances]
+
+
 # if __name__ == '__main__':
 #     # examples, should be recognized correctly (probably incomplete)
 #     nlu = NLU()
@@ -0,0 +1,120 @@
+import json
+import os
+from typing import List, Union
+
+import numpy as np
+
+
+BACKENDS = ['torch', 'onnx', 'onnx-int8']
+
+
+def onnx_model_dir(pretrained_name: str, cache_dir: str = '.models/onnx') -> str:
+    return os.path.join(cache_dir, pretrained_name.replace("/", "_"))
+
+
+def export_onnx(pretrained_name: str, output_dir: str, quantize: bool = False, device: str = 'cpu', cache_folder: str = '.models') -> str:
+    """
+    Export the complete forward pass of a sentence transformer (transformer + pooling + dense / normalization layers) to ONNX,
+    so the ONNX model outputs the same sentence embeddings as `SentenceTransformer.encode`.
+    Optionally adds a dynamically int8-quantized copy of the model.
+
+    Returns:
+        path of the exported (quantized) model
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model_file = os.path.join(output_dir, "model.onnx")
+    config_file = os.path.join(output_dir, "config.json")
+    if not os.path.isfile(config_file):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(pretrained_name, device=device, cache_folder=cache_folder)
+        model.eval()
+        # workers exporting at the same time: write to temporary files, config.json marks a complete export
+        tmp_suffix = f".{os.getpid()}.tmp"
+        class SentenceEmbeddingModule(torch.nn.Module):
+            def __init__(self, sentence_transformer) -> None:
+                super().__init__()
+                self.sentence_transformer = sentence_transformer
+
+            def forward(self, input_ids, attention_mask):
+                return self.sentence_transformer({'input_ids': input_ids, 'attention_mask': attention_mask})['sentence_embedding']
+
+        sample = model.tokenizer(["export sample"], padding=True, truncation=True, return_tensors='pt')
+        with torch.no_grad():
+            torch.onnx.export(SentenceEmbeddingModule(model), (sample['input_ids'], sample['attention_mask']), model_file + tmp_suffix,
+                            input_names=['input_ids', 'attention_mask'], output_names=['sentence_embedding'],
+                            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'sentence_embedding': {0: 'batch'}},
+                            opset_version=14)
+        os.replace(model_file + tmp_suffix, model_file)
+        model.tokenizer.save_pretrained(output_dir)
+        with open(config_file + tmp_suffix, "w") as f:
+            json.dump({"pretrained_name": pretrained_name, "max_seq_length": model.max_seq_length, "embedding_dim": model.get_sentence_embedding_dimension()}, f)
+        os.replace(config_file + tmp_suffix, config_file)
+    if not quantize:
+        return model_file
+
+    quantized_file = os.path.join(output_dir, "model-int8.onnx")
+    if not os.path.isfile(quantized_file):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(model_file, quantized_file + f".{os.getpid()}.tmp", weight_type=QuantType.QInt8)
+        os.replace(quantized_file + f".{os.getpid()}.tmp", quantized_file)
+    return quantized_file
+
+
+class OnnxSentenceEncoder:
+    """ Runs an exported sentence transformer (see `export_onnx`) with onnxruntime, offering the `encode` interface of `SentenceTransformer` """
+    def __init__(self, model_dir: str, quantized: bool = False, num_threads: int = 1) -> None:
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.model_file = os.path.join(model_dir, "model-int8.onnx" if quantized else "model.onnx")
+        with open(os.path.join(model_dir, "config.json")) as f:
+            config = json.load(f)
+        self.max_seq_length = config['max_seq_length']
+        self.embedding_dim = config['embedding_dim']
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(self.model_file, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        # sort by length to reduce padding (like `SentenceTransformer.encode`)
+        order = np.argsort([-len(sentence) for sentence in sentences])
+        embeddings = np.zeros((len(sentences), self.embedding_dim), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            batch_indices = order[start:start+batch_size]
+            tokens = self.tokenizer([sentences[i] for i in batch_indices], padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+            outputs = self.session.run(['sentence_embedding'], {'input_ids': tokens['input_ids'].astype(np.int64), 'attention_mask': tokens['attention_mask'].astype(np.int64)})
+            embeddings[batch_indices] = outputs[0]
+        return embeddings[0] if single else embeddings
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.embedding_dim
+
+    def memory_size(self) -> int:
+        """ Size of the model weights in bytes """
+        return os.path.getsize(self.model_file)
+
+
+class OnnxSentenceEncoderLoader:
+    """ Picklable model factory for inference workers, exports the model on first use """
+    def __init__(self, pretrained_name: str, quantized: bool = False, num_threads: int = 1, cache_dir: str = '.models/onnx') -> None:
+        self.pretrained_name = pretrained_name
+        self.quantized = quantized
+        self.num_threads = num_threads
+        self.cache_dir = cache_dir
+
+    def __call__(self):
+        from apps.diagraph.modelRegistry import models
+        model_dir = onnx_model_dir(self.pretrained_name, self.cache_dir)
+        def load():
+            export_onnx(self.pretrained_name, model_dir, quantize=self.quantized)
+            return OnnxSentenceEncoder(model_dir, quantized=self.quantized, num_threads=self.num_threads)
+        return models.get(self.pretrained_name, 'onnx-int8' if self.quantized else 'onnx', load)
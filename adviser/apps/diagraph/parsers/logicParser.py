@@ -1,4 +1,7 @@
+from bisect import bisect_left, bisect_right
 from functools import reduce
+from operator import add, sub, mul, truediv, neg, gt, ge, le, lt
+from typing import Any, Callable, Dict, List, Tuple, Union
 from lark import Lark
 from lark import Transformer
 from lark.visitors import  v_args
@@ -9,6 +12,15 @@ class LogicTemplateParser:
         self.grammar = """
             template: "{{" and "}}"
 
+            // logic nodes: shared left hand side (node text) and one comparison per branch (answer text)
+            lhs: "{{" sum
+            branch: "==" sum "}}"   -> branch_eq
+                | "!=" sum "}}"     -> branch_ne
+                | ">" sum "}}"      -> branch_gt
+                | ">=" sum "}}"     -> branch_ge
+                | "<" sum "}}"      -> branch_lt
+                | "<=" sum "}}"     -> branch_le
+
             ?and: or
                 | and "AND" and -> _and
                 | and "DEFAULT"
@@ -53,74 +65,353 @@ class LogicTemplateParser:
 
             %ignore WS_INLINE
         """
-        self.parser = Lark(self.grammar, start='template', parser='lalr')
+        self.parser = Lark(self.grammar, start=['template', 'lhs', 'branch'], parser='lalr')
 
     def parse_template(self, template: str, graph: "DialogGraph", bst: dict):
+        return self.compile_template(template)(graph, bst)
+
+    def compile_template(self, template: str) -> Callable[["DialogGraph", dict], Any]:
+        """
+        Parse a template once and compile it into a closure `(graph, bst) -> value`.
+        The closure can be evaluated repeatedly without building a parse tree or running a transformer.
+        """
         # parse & analyze template
-        parse_tree = self.parser.parse(template)
+        parse_tree = self.parser.parse(template, start='template')
+
+        # build closures filling in constants, evaluating variables + functions
+        return LogicCompiler().transform(parse_tree)
+
+    def compile_branches(self, lhs: str, branches: List[str]) -> "LogicBranchTable":
+        """
+        Compile all branches of a logic node into a decision table.
+
+        Args:
+            lhs: incomplete template shared by all branches (node text), e.g. `{{ x`
+            branches: remainder of the template for each branch (answer texts, in order), e.g. `== 3}}` or `DEFAULT`
+        """
+        default_index = None
+        compiled_branches = []
+        try:
+            lhs_fn = LogicCompiler().transform(self.parser.parse(lhs, start='lhs'))
+        except:
+            lhs_fn = None # evaluate each branch as complete template instead
+        for index, rhs in enumerate(branches):
+            if "DEFAULT" in rhs:
+                default_index = index # handle DEFAULT case last!
+                continue
+            try:
+                op, rhs_tree = self._parse_branch(rhs) if lhs_fn else (None, None)
+            except:
+                op, rhs_tree = None, None
+            if isinstance(op, type(None)):
+                # not a single comparison (e.g. combined with AND / OR): evaluate the full template
+                compiled_branches.append(_FallbackBranch(index, self._compile_or_fail(f"{lhs} {rhs}")))
+                continue
+            rhs_fn = LogicCompiler().transform(rhs_tree)
+            if not any(subtree.data in ('var', 'func') for subtree in rhs_tree.iter_subtrees()):
+                try:
+                    compiled_branches.append(_ConstantBranch(index, op, rhs_fn(None, {})))
+                    continue
+                except:
+                    pass # e.g. division by zero: keep raising at runtime
+            compiled_branches.append(_DynamicBranch(index, op, rhs_fn))
+        return LogicBranchTable(lhs_fn, compiled_branches, default_index)
+
+    def _parse_branch(self, rhs: str):
+        branch_tree = self.parser.parse(rhs, start='branch')
+        return _BRANCH_OPS[branch_tree.data], branch_tree.children[0]
+
+    def _compile_or_fail(self, template: str):
+        try:
+            return self.compile_template(template)
+        except Exception as error:
+            def fail(graph, bst):
+                raise error
+            return fail
+
+
+def eq(lhs, rhs) -> bool:
+    if isinstance(lhs, str): 
+        # handle string comparison
+        return lhs.lower().strip() == str(rhs).lower().strip()
+    return lhs == rhs
+
+def ne(lhs, rhs) -> bool:
+    if isinstance(lhs, str):
+        return lhs.lower().strip() != str(rhs).lower().strip()
+    return lhs != rhs
+
+
+_BRANCH_OPS = {'branch_eq': eq, 'branch_ne': ne, 'branch_gt': gt, 'branch_ge': ge, 'branch_lt': lt, 'branch_le': le}
+
+
+class _ConstantBranch:
+    __slots__ = ('index', 'op', 'value')
+
+    def __init__(self, index: int, op: Callable, value: Any) -> None:
+        self.index = index
+        self.op = op
+        self.value = value
+
+    def is_true(self, graph, bst: dict, lhs_value) -> bool:
+        return self.op(lhs_value, self.value)
+
+
+class _DynamicBranch:
+    __slots__ = ('index', 'op', 'rhs')
+
+    def __init__(self, index: int, op: Callable, rhs: Callable) -> None:
+        self.index = index
+        self.op = op
+        self.rhs = rhs
+
+    def is_true(self, graph, bst: dict, lhs_value) -> bool:
+        return self.op(lhs_value, self.rhs(graph, bst))
+
+
+class _FallbackBranch:
+    __slots__ = ('index', 'condition')
+
+    def __init__(self, index: int, condition: Callable) -> None:
+        self.index = index
+        self.condition = condition
+
+    def is_true(self, graph, bst: dict, lhs_value) -> bool:
+        return self.condition(graph, bst)
+
+
+def _holds(branch, graph, bst: dict, lhs_value) -> bool:
+    try:
+        return bool(branch.is_true(graph, bst, lhs_value))
+    except:
+        # evaluation errors count as satisfied condition (the policy used to follow the branch on the error message)
+        return True
+
+
+class _ThresholdTable:
+    """ Sorted thresholds of all constant branches with the same comparison operator + min. branch index per prefix / suffix """
+    def __init__(self, thresholds: List[Tuple[float, int]]) -> None:
+        thresholds = sorted(thresholds)
+        self.values = [value for value, _ in thresholds]
+        self.prefix_min = [None]
+        for _, index in thresholds:
+            self.prefix_min.append(index if isinstance(self.prefix_min[-1], type(None)) else min(self.prefix_min[-1], index))
+        self.suffix_min = [None]
+        for _, index in reversed(thresholds):
+            self.suffix_min.append(index if isinstance(self.suffix_min[-1], type(None)) else min(self.suffix_min[-1], index))
+        self.suffix_min.reverse()
+
+    def below(self, count: int):
+        """ first branch among the `count` smallest thresholds """
+        return self.prefix_min[count]
+
+    def above(self, start: int):
+        """ first branch among all thresholds from position `start` on """
+        return self.suffix_min[start]
+
+
+def _first(*indices) -> Union[int, None]:
+    indices = [index for index in indices if not isinstance(index, type(None))]
+    return min(indices) if indices else None
+
+
+class LogicBranchTable:
+    """
+    Decision table for the branches of a logic node.
+    The shared left hand side is evaluated once per visit. Branches comparing it against constants are resolved by dict lookups 
+    (==, !=) or binary search over sorted thresholds (<, <=, >, >=); all other branches are evaluated in order.
+    Selects the same branch as evaluating each complete template `{{lhs rhs}}` in order would.
+    """
+    def __init__(self, lhs: Union[Callable, None], branches: List[Union[_ConstantBranch, _DynamicBranch, _FallbackBranch]], default_index: Union[int, None]) -> None:
+        self.lhs = lhs
+        self.branches = branches
+        self.default_index = default_index
+
+        self.equal: Dict[Any, int] = {}     # constant -> first branch (non-string lhs)
+        self.equal_str: Dict[str, int] = {} # normalized constant -> first branch (string lhs, see `eq`)
+        self.not_equal: List[_ConstantBranch] = []
+        self.evaluated: List[Union[_DynamicBranch, _FallbackBranch]] = []
+        thresholds = {gt: [], ge: [], lt: [], le: []}
+        for branch in branches:
+            if isinstance(branch, _ConstantBranch) and branch.op == eq:
+                self.equal_str.setdefault(str(branch.value).lower().strip(), branch.index)
+                try:
+                    self.equal.setdefault(branch.value, branch.index)
+                except TypeError:
+                    self.evaluated.append(branch)
+            elif isinstance(branch, _ConstantBranch) and branch.op == ne:
+                self.not_equal.append(branch)
+            elif isinstance(branch, _ConstantBranch) and branch.op in thresholds and _is_number(branch.value):
+                thresholds[branch.op].append((branch.value, branch.index))
+            else:
+                self.evaluated.append(branch)
+        self.thresholds = {op: _ThresholdTable(values) for op, values in thresholds.items() if values}
+        self.non_default = [branch.index for branch in branches]
+
+    def select(self, graph, bst: dict) -> Union[int, None]:
+        """ Returns the index of the first satisfied branch, the DEFAULT branch or None """
+        if isinstance(self.lhs, type(None)):
+            index = self._select_in_order(graph, bst, None)
+            return index if not isinstance(index, type(None)) else self.default_index
+        try:
+            lhs_value = self.lhs(graph, bst)
+        except:
+            # every branch would fail to evaluate, so the first one is followed (see `_holds`)
+            return self.non_default[0] if self.non_default else self.default_index
+
+        if _is_number(lhs_value) and lhs_value == lhs_value: # excludes NaN
+            index = _first(self.equal.get(lhs_value), self._select_threshold(lhs_value), self._select_not_equal(lhs_value, lhs_value))
+        elif isinstance(lhs_value, str) and not self.thresholds:
+            normalized = lhs_value.lower().strip()
+            index = _first(self.equal_str.get(normalized), self._select_not_equal(lhs_value, normalized))
+        else:
+            # no shortcuts for other types (e.g. comparisons might raise errors)
+            index = self._select_in_order(graph, bst, lhs_value)
+            return index if not isinstance(index, type(None)) else self.default_index
+        index = _first(index, self._select_evaluated(graph, bst, lhs_value, index))
+        return index if not isinstance(index, type(None)) else self.default_index
+
+    def _select_threshold(self, lhs_value) -> Union[int, None]:
+        candidates = []
+        if gt in self.thresholds: # threshold < lhs
+            candidates.append(self.thresholds[gt].below(bisect_left(self.thresholds[gt].values, lhs_value)))
+        if ge in self.thresholds: # threshold <= lhs
+            candidates.append(self.thresholds[ge].below(bisect_right(self.thresholds[ge].values, lhs_value)))
+        if lt in self.thresholds: # threshold > lhs
+            candidates.append(self.thresholds[lt].above(bisect_right(self.thresholds[lt].values, lhs_value)))
+        if le in self.thresholds: # threshold >= lhs
+            candidates.append(self.thresholds[le].above(bisect_left(self.thresholds[le].values, lhs_value)))
+        return _first(*candidates)
+
+    def _select_not_equal(self, lhs_value, normalized) -> Union[int, None]:
+        # stops at the first constant different from lhs
+        for branch in self.not_equal:
+            if isinstance(lhs_value, str):
+                if normalized != str(branch.value).lower().strip():
+                    return branch.index
+            elif lhs_value != branch.value:
+                return branch.index
+        return None
+
+    def _select_evaluated(self, graph, bst: dict, lhs_value, best: Union[int, None]) -> Union[int, None]:
+        for branch in self.evaluated:
+            if not isinstance(best, type(None)) and branch.index > best:
+                break
+            if _holds(branch, graph, bst, lhs_value):
+                return branch.index
+        return None
+
+    def _select_in_order(self, graph, bst: dict, lhs_value) -> Union[int, None]:
+        for branch in self.branches:
+            if _holds(branch, graph, bst, lhs_value):
+                return branch.index
+        return None
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float))
+
+
+def _binary(op: Callable[[Any, Any], Any], lhs, rhs):
+    return lambda graph, bst: op(lhs(graph, bst), rhs(graph, bst))
+
+def _constant(value):
+    return lambda graph, bst: value
 
-        # fill in constants, evaluate variables + functions
-        return LogicTransformer(graph, bst).transform(parse_tree)
 
 @v_args(inline=True)
-class LogicTransformer(Transformer):
-    from operator import add, sub, mul, truediv as div, neg, gt, ge, le, lt
+class LogicCompiler(Transformer):
+    """ Turns each node of the parse tree into a closure `(graph, bst) -> value` evaluating the subtree """
+
+    def add(self, lhs, rhs):
+        return _binary(add, lhs, rhs)
 
-    def __init__(self, graph: "DialogGraph", bst: dict):
-        self.graph = graph
-        self.bst = bst
+    def sub(self, lhs, rhs):
+        return _binary(sub, lhs, rhs)
+
+    def mul(self, lhs, rhs):
+        return _binary(mul, lhs, rhs)
+
+    def div(self, lhs, rhs):
+        return _binary(truediv, lhs, rhs)
+
+    def gt(self, lhs, rhs):
+        return _binary(gt, lhs, rhs)
+
+    def ge(self, lhs, rhs):
+        return _binary(ge, lhs, rhs)
+
+    def lt(self, lhs, rhs):
+        return _binary(lt, lhs, rhs)
+
+    def le(self, lhs, rhs):
+        return _binary(le, lhs, rhs)
+
+    def eq(self, lhs, rhs):
+        return _binary(eq, lhs, rhs)
+
+    def ne(self, lhs, rhs):
+        return _binary(ne, lhs, rhs)
+
+    def neg(self, value):
+        return lambda graph, bst: neg(value(graph, bst))
 
     def var(self, name):
-        return self.bst[name]
+        name = name.value
+        return lambda graph, bst: bst[name]
 
     def func(self, table_name, func_name, func_args):
-        return self.graph.get_data_table_values(table_name.value, func_args, return_columns=[func_name.value])
+        table_name = table_name.value
+        func_name = func_name.value
         # TODO how to handle multiple results?
+        return lambda graph, bst: graph.get_data_table_values(table_name, func_args(graph, bst), return_columns=[func_name])
 
     def func_args(self, *args):
-        return reduce(lambda d1, d2: d1 | d2, args)
+        return lambda graph, bst: reduce(lambda d1, d2: d1 | d2, [arg(graph, bst) for arg in args])
 
     def func_arg(self, name, value):
-        return {name.value: value}
-
-    def eq(self, lhs, rhs):
-        if isinstance(lhs, str): 
-            # handle string comparison
-            return lhs.lower().strip() == str(rhs).lower().strip()
-        return lhs == rhs
-
-    def ne(self, lhs, rhs):
-        if isinstance(lhs, str):
-            return lhs.lower().strip() != str(rhs).lower().strip()
-        return lhs != rhs
+        name = name.value
+        return lambda graph, bst: {name: value(graph, bst)}
 
     def number(self, num):
-        return float(num.value)
+        return _constant(float(num.value))
 
     def const(self, content):
-        return content.value.strip('"')
+        return _constant(content.value.strip('"'))
 
     def default(self, *args):
-        return True
+        return _constant(True)
         
     def trueval(self):
-        return True
+        return _constant(True)
     
     def falseval(self):
-        return False
+        return _constant(False)
 
-    def _or(self, *args):
-        args = args[0]
-        if len(args) == 1:
-            return args[0]
-        return args[0] or args[1]
+    # NOTE: methods starting with an underscore are not affected by `v_args` and receive the list of children
+    # both sides are always evaluated (no short-circuiting), e.g. unknown variables raise an error in either branch
+    def _or(self, children):
+        if len(children) == 1:
+            return children[0]
+        lhs, rhs = children
+        def _or(graph, bst):
+            lhs_value = lhs(graph, bst)
+            rhs_value = rhs(graph, bst)
+            return lhs_value or rhs_value
+        return _or
     
-    def _and(self, *args):
-        args = args[0]
-        if len(args) == 1:
-            return args[0]
-        return args[0] and args[1]
+    def _and(self, children):
+        if len(children) == 1:
+            return children[0]
+        lhs, rhs = children
+        def _and(graph, bst):
+            lhs_value = lhs(graph, bst)
+            rhs_value = rhs(graph, bst)
+            return lhs_value and rhs_value
+        return _and
 
-    def template(self, *args) -> bool:
+    def template(self, *args):
         return args[0] # there is only 1 arg (final truth value)
 
+    def lhs(self, value):
+        return value
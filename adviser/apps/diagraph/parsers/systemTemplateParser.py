@@ -1,4 +1,6 @@
 from functools import reduce
+from operator import add, sub, mul, truediv, neg
+from typing import Callable, Union
 from lark import Lark
 from lark import Visitor
 from lark import Transformer
@@ -42,11 +44,31 @@ class SystemTemplateParser:
         self.parser = Lark(self.grammar, start='template', parser='lalr')
 
     def parse_template(self, template: str, graph: "DialogGraph", bst: dict):
+        return self.compile_template(template)(graph, bst)
+
+    def compile_template(self, template: str) -> Callable[["DialogGraph", dict], str]:
+        """
+        Parse a template once and compile it into a closure `(graph, bst) -> str`.
+        The closure can be evaluated repeatedly without building a parse tree or running a transformer.
+        """
         # parse & analyze template
         parse_tree = self.parser.parse(template)
 
-        # fill in constants, evaluate variables + functions
-        return ValueTransformer(graph, bst).transform(parse_tree)
+        # build closures filling in constants, evaluating variables + functions
+        return ValueCompiler().transform(parse_tree)
+
+    def render_static(self, template: str) -> Union[str, None]:
+        """
+        Render a template that does not depend on the beliefstate or any data table (no variables, no functions).
+        Returns None for all other templates (or if the template can't be rendered).
+        """
+        try:
+            parse_tree = self.parser.parse(template)
+            if any(subtree.data in ('var', 'func') for subtree in parse_tree.iter_subtrees()):
+                return None
+            return ValueCompiler().transform(parse_tree)(None, {})
+        except:
+            return None
 
     def find_variables(self, template: str):
         # parse & analyze template
@@ -67,36 +89,55 @@ class VariableFinder(Visitor):
         self.var_table.add(tree.children[0].value)
 
 @v_args(inline=True)
-class ValueTransformer(Transformer):
-    from operator import add, sub, mul, truediv as div, neg
+class ValueCompiler(Transformer):
+    """ Turns each node of the parse tree into a closure `(graph, bst) -> value` evaluating the subtree """
 
-    def __init__(self, graph: "DialogGraph", bst: dict):
-        self.graph = graph
-        self.bst = bst
+    def add(self, lhs, rhs):
+        return lambda graph, bst: add(lhs(graph, bst), rhs(graph, bst))
+
+    def sub(self, lhs, rhs):
+        return lambda graph, bst: sub(lhs(graph, bst), rhs(graph, bst))
+
+    def mul(self, lhs, rhs):
+        return lambda graph, bst: mul(lhs(graph, bst), rhs(graph, bst))
+
+    def div(self, lhs, rhs):
+        return lambda graph, bst: truediv(lhs(graph, bst), rhs(graph, bst))
+
+    def neg(self, value):
+        return lambda graph, bst: neg(value(graph, bst))
 
     def var(self, name):
-        return self.bst[name]
+        name = name.value
+        return lambda graph, bst: bst[name]
 
     def func(self, table_name, func_name, func_args):
-        results = self.graph.get_data_table_values(table_name.value, func_args, return_columns=[func_name.value])
-        # TODO how to handle multiple results?
-        return results[0][func_name]
+        table_name = table_name.value
+        func_name = func_name.value
+        def lookup(graph, bst):
+            results = graph.get_data_table_values(table_name, func_args(graph, bst), return_columns=[func_name])
+            # TODO how to handle multiple results?
+            return results[0][func_name]
+        return lookup
 
     def func_args(self, *args):
-        return reduce(lambda d1, d2: d1 | d2, args)
+        return lambda graph, bst: reduce(lambda d1, d2: d1 | d2, [arg(graph, bst) for arg in args])
 
     def func_arg(self, name, value):
-        return {name.value: value}
+        name = name.value
+        return lambda graph, bst: {name: value(graph, bst)}
 
     def number(self, num):
-        return float(num)
+        value = float(num)
+        return lambda graph, bst: value
 
     def text(self, content):
-        return content.value
+        value = content.value
+        return lambda graph, bst: value
 
     def const(self, content):
-        return content.value
+        value = content.value
+        return lambda graph, bst: value
 
     def template(self, *args):
-        return " ".join([str(arg).strip() for arg in args])
-
+        return lambda graph, bst: " ".join([str(arg(graph, bst)).strip() for arg in args])
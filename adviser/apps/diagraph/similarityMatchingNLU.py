@@ -1,9 +1,22 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import logging
-from typing import List, Tuple, Union
+from typing import AsyncIterator, Dict, List, Tuple, Union
 
+import numpy as np
 import torch
 from torch.nn.functional import cosine_similarity
-from apps.diagraph.data.dialogGraph import DialogGraph, DialogNode, NodeType, ConversationLogEntry
+from apps.diagraph.data.dialogGraph import NodeType, ConversationLogEntry
+from apps.diagraph.compiledGraph import CompiledAnswer, CompiledGraph, CompiledNode, compiled_graphs
+from apps.diagraph.answerMatcher import LexicalAnswerMatcher
+from apps.diagraph.batchingEncoder import BatchingEncoder
+from apps.diagraph.embeddingStore import EmbeddingStore
+from apps.diagraph.faqIndex import FAQIndexCache, FAQSearchResult
+from apps.diagraph.graphEvents import GraphChange, GraphChangeListener
+from apps.diagraph.inferenceExecutor import InferenceExecutor, SentenceTransformerLoader, embedding_dimension, encode_texts, model_memory
+from apps.diagraph.modelRegistry import models
+from apps.diagraph.onnxEncoder import BACKENDS, OnnxSentenceEncoderLoader
 
 from services.service import Service, PublishSubscribe
 from apps.diagraph.parsers.answerTemplateParser import AnswerTemplateParser
@@ -13,45 +26,179 @@ from utils.memory import UserState
 from utils.useract import UserAct, UserActionType
 
 
-# TODO clear after DB change
+# current match rates per tier and inference stats per model (see `SimilarityMatchingNLU.stats`)
+NLU_STATS_RPC = "dialogsystem.nlu.stats"
+
+
 class SentenceEmbeddings():
     SIMILARITY_THRESHOLD = 0.01 # TODO find acceptable threshold
 
-    def __init__(self, device: str, pretrained_name: str = 'distiluse-base-multilingual-cased', embedding_dim: int = 512) -> None:
-        from sentence_transformers import SentenceTransformer
+    def __init__(self, device: str, pretrained_name: str = 'distiluse-base-multilingual-cased', embedding_dim: int = None, max_batch_size: int = 32, max_wait_ms: float = 5.0,
+                    executor: InferenceExecutor = None, backend: str = 'torch') -> None:
         self.device = device
-        self.embedding_dim = embedding_dim        
+        self.embedding_dim = embedding_dim # None: ask the model on first use
         self.pretrained_name = pretrained_name
-        self.bert_sentence_embedder = SentenceTransformer(pretrained_name, device=device, cache_folder = '.models')
+        self.backend = backend
+        # embeddings of different backends (e.g. quantized models) differ slightly, don't mix them in caches
+        self.cache_name = pretrained_name if backend == 'torch' else f"{pretrained_name}-{backend}"
+        # the model is loaded (and run) by the executor's workers, outside of the event loop
+        self.executor = executor if executor else InferenceExecutor(SentenceTransformerLoader(pretrained_name, device=device))
+        self.store: EmbeddingStore = None # opened once the embedding dimension is known
+        self.memory = 0 # estimated memory of the model (bytes, all workers)
+        self.leases = 0 # coroutines currently using the model (see `EmbeddingModelPool.use`)
+        self.ready_lock = None
+        # user utterances arriving at the same time are encoded together
+        self.batcher = BatchingEncoder(self._encode_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    async def ready(self):
+        """ Loads the model (in the executor's workers) and opens the embedding store """
+        if isinstance(self.ready_lock, type(None)):
+            self.ready_lock = asyncio.Lock()
+        async with self.ready_lock:
+            if not isinstance(self.store, type(None)):
+                return
+            if isinstance(self.embedding_dim, type(None)):
+                self.embedding_dim = await self.executor.run(embedding_dimension)
+            workers = self.executor.workers if self.executor.kind == 'process' else 1 # thread workers share the model
+            self.memory = workers * await self.executor.run(model_memory)
+            self.store = EmbeddingStore(model_name=self.cache_name, embedding_dim=self.embedding_dim)
+
+    def is_busy(self) -> bool:
+        return self.leases > 0 or bool(self.batcher.pending) or self.executor.in_flight > 0 or self.executor.waiting > 0
+
+    def close(self):
+        self.batcher.close()
+        self.executor.shutdown()
+
+    async def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        return await self.executor.run(encode_texts, texts)
 
-    @torch.no_grad()
-    def encode(self, text: Union[str, None]) -> torch.FloatTensor:
+    async def encode(self, text: Union[str, None]) -> torch.FloatTensor:
         """
+        Embedding of a user utterance, batched with concurrent requests of other users.
+
         Returns:
             (1, 512)
         """
+        await self.ready()
         if text:
-            return self.bert_sentence_embedder.encode(text, convert_to_numpy=False, convert_to_tensor=True, show_progress_bar=False).unsqueeze(0)
+            return torch.from_numpy(await self.batcher.encode(text)).to(self.device).unsqueeze(0)
         else:
-            return torch.zeros(1, 1, self.embedding_dim, dtype=torch.float, device=self.device)
+            return torch.zeros(1, self.embedding_dim, dtype=torch.float, device=self.device)
+
+    async def embed_texts(self, texts: List[str]) -> torch.FloatTensor:
+        """
+        Embeddings of (recurring) texts, e.g. answers: looked up in the embedding store, missing texts are encoded in a single batch.
+
+        Returns:
+            (#texts, 512)
+        """
+        return torch.from_numpy(await self.embed_texts_numpy(texts)).to(self.device)
+
+    async def embed_texts_numpy(self, texts: List[str]) -> np.ndarray:
+        """ Same as `embed_texts`, as numpy array """
+        await self.ready()
+        return await self.store.embed_async(texts, self._encode_batch)
 
-    @torch.no_grad()
-    def embed_node_answers(self, node: DialogNode) -> torch.FloatTensor:
+    async def embed_node_answers(self, node: CompiledNode) -> torch.FloatTensor:
         """
+        Kept on the compiled node until its answers change (the node is reloaded then).
+
         Returns:
             (#answers, 512)
         """
-        return torch.cat([self.encode(answer.text) for answer in node.answers.all().order_by('index')], dim=0)
+        if not self.cache_name in node.answer_embeddings:
+            node.answer_embeddings[self.cache_name] = await self.embed_texts([answer.text for answer in node.answers])
+        return node.answer_embeddings[self.cache_name]
         
 
+class EmbeddingModelPool:
+    """
+    Sentence embedding models by name, loaded on first request (e.g. per graph, see `DialogGraphSettings.similarity_model`).
+    If the models exceed the memory budget, the least recently used idle models are unloaded
+    (models are only used inside `use`, which keeps them loaded until the caller is done).
+    Each model has its own executor and micro-batcher, so concurrent requests are batched per model.
+    Models run with PyTorch by default, `backends` selects ONNX Runtime ('onnx' or int8-quantized 'onnx-int8') per model name.
+    """
+    def __init__(self, device: str = 'cpu', memory_budget_mb: int = 4096, executor_kind: str = 'thread', workers: int = 1, max_queue: int = 64,
+                    max_batch_size: int = 32, max_wait_ms: float = 5.0, default_backend: str = 'torch', backends: Dict[str, str] = {}, onnx_threads: int = 1) -> None:
+        for backend in [default_backend] + list(backends.values()):
+            if not backend in BACKENDS:
+                raise ValueError(f"Unknown inference backend '{backend}', expected one of {BACKENDS}")
+        self.device = device
+        self.default_backend = default_backend
+        self.backends = backends
+        self.onnx_threads = onnx_threads
+        self.memory_budget = memory_budget_mb * 2**20
+        self.executor_kind = executor_kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.embeddings: Dict[str, SentenceEmbeddings] = OrderedDict() # least recently used first
+
+    @asynccontextmanager
+    async def use(self, pretrained_name: str) -> AsyncIterator[SentenceEmbeddings]:
+        """ The (ready) model for the duration of the `async with` block, it is not unloaded before the block is left """
+        embeddings = self._get(pretrained_name)
+        embeddings.leases += 1
+        try:
+            await embeddings.ready()
+            self._evict(keep=pretrained_name)
+            yield embeddings
+        finally:
+            embeddings.leases -= 1
+
+    def _get(self, pretrained_name: str) -> SentenceEmbeddings:
+        if pretrained_name in self.embeddings:
+            self.embeddings.move_to_end(pretrained_name)
+            return self.embeddings[pretrained_name]
+        backend = self.backends.get(pretrained_name, self.default_backend)
+        if backend == 'torch':
+            loader = SentenceTransformerLoader(pretrained_name, device=self.device)
+        else:
+            loader = OnnxSentenceEncoderLoader(pretrained_name, quantized=backend == 'onnx-int8', num_threads=self.onnx_threads)
+        executor = InferenceExecutor(loader, kind=self.executor_kind, workers=self.workers, max_queue=self.max_queue)
+        embeddings = SentenceEmbeddings(device=self.device, pretrained_name=pretrained_name, executor=executor, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms,
+                                        backend=backend)
+        self.embeddings[pretrained_name] = embeddings
+        return embeddings
+
+    def memory_usage(self) -> int:
+        return sum(embeddings.memory for embeddings in self.embeddings.values())
+
+    def stats(self) -> Dict[str, dict]:
+        """ Inference stats per loaded model """
+        return {name: {"backend": embeddings.backend,
+                       "memory_mb": embeddings.memory / 2**20,
+                       "batches": embeddings.batcher.num_batches,
+                       "batched_texts": embeddings.batcher.num_texts,
+                       "executor": embeddings.executor.stats()}
+                for name, embeddings in self.embeddings.items()}
+
+    def _evict(self, keep: str):
+        for name in list(self.embeddings.keys()):
+            if self.memory_usage() <= self.memory_budget:
+                return
+            if name == keep or self.embeddings[name].is_busy():
+                continue
+            print(f"Unloading similarity model {name} (memory budget {self.memory_budget / 2**20:.0f} MB exceeded)")
+            embeddings = self.embeddings.pop(name)
+            embeddings.close()
+            models.unload(name, self.device if embeddings.backend == 'torch' else embeddings.backend)
+        if self.memory_usage() > self.memory_budget:
+            print(f"Similarity models need {self.memory_usage() / 2**20:.0f} MB, exceeding the memory budget of {self.memory_budget / 2**20:.0f} MB")
+
 
-class SimilarityMatchingNLU(Service):
+class SimilarityMatchingNLU(GraphChangeListener, Service):
     SIMILARITY_THRESHOLD = 0.01 # TODO find acceptable threshold
+    FAQ_SIMILARITY_THRESHOLD = 0.5 # TODO find acceptable threshold
+    STATS_LOG_INTERVAL = 100 # log the match rates every n matched utterances
 
-    def __init__(self, embeddings: SentenceEmbeddings, domain='reisekosten', logger: DiasysLogger = None, identifier: str = "similarityMatchingNLU", 
+    def __init__(self, embeddings: EmbeddingModelPool, domain='reisekosten', logger: DiasysLogger = None, identifier: str = "similarityMatchingNLU", 
                     transports: str = "ws://localhost:8080/ws", realm="adviser") -> None:
         super().__init__(domain=domain, identifier=identifier, realm=realm, transports=transports)
-        self.embeddings = embeddings
+        self.embeddings = embeddings # similarity model is chosen per graph
         self.logger = logger
         self.templateParser = AnswerTemplateParser()
         self.nlu = NLU()
@@ -59,6 +206,70 @@ class SimilarityMatchingNLU(Service):
         self.beliefstate = UserState(lambda: dict())
         self.turn = UserState(lambda: 0)
 
+        # number of answers matched per tier (see `_match_answer`)
+        self.match_counts = {"exact": 0, "lexical": 0, "neural": 0, "unmatched": 0}
+        # embeddings of all FAQ questions per graph
+        self.faq_indices = FAQIndexCache()
+
+    async def _register(self, session):
+        await super()._register(session)
+        await session.register(self.stats, NLU_STATS_RPC)
+
+    def on_graph_changed(self, change: GraphChange):
+        compiled_graphs.apply_change(change)
+        self.faq_indices.apply_change(change)
+
+    def match_rates(self) -> dict:
+        """ Share of matched user utterances per tier """
+        total = sum(self.match_counts.values())
+        return {tier: count / total if total else 0.0 for tier, count in self.match_counts.items()}
+
+    def stats(self) -> dict:
+        return {"match_counts": dict(self.match_counts), "match_rates": self.match_rates(), "models": self.embeddings.stats()}
+
+    def _count_match(self, tier: str):
+        self.match_counts[tier] += 1
+        total = sum(self.match_counts.values())
+        if total % self.STATS_LOG_INTERVAL == 0:
+            rates = ", ".join(f"{tier}: {rate:.1%}" for tier, rate in self.match_rates().items())
+            logging.getLogger('chat').info(f"NLU match rates after {total} utterances - {rates}")
+
+    async def _match_answer(self, embeddings: SentenceEmbeddings, node: CompiledNode, user_utterance: str) -> Tuple[Union[int, None], str, float, Union[torch.FloatTensor, None]]:
+        """
+        Find the answer of the node closest to the user utterance, trying cheap tiers first:
+        exact match (normalized text) -> character n-gram overlap -> sentence embedding similarity (only if the other tiers are ambiguous).
+
+        Returns:
+            (answer index or None, tier, score, utterance embedding (only computed for the neural tier))
+        """
+        if isinstance(node.answer_matcher, type(None)):
+            node.answer_matcher = LexicalAnswerMatcher([answer.text for answer in node.answers])
+        answer_idx = node.answer_matcher.match_exact(user_utterance)
+        if not isinstance(answer_idx, type(None)):
+            return answer_idx, "exact", 1.0, None
+        lexical_match = node.answer_matcher.match_lexical(user_utterance)
+        if not isinstance(lexical_match, type(None)):
+            answer_idx, score = lexical_match
+            return answer_idx, "lexical", score, None
+
+        utterance_emb = (await embeddings.encode(user_utterance)).squeeze(0) #  1 x 512 -> 512
+        answer_embs = await embeddings.embed_node_answers(node) # answers x 512
+        similarities = cosine_similarity(utterance_emb, answer_embs, -1)
+        most_similar_answer_idx = similarities.argmax(-1).item()
+        max_similarity_score = similarities[most_similar_answer_idx].item() # top answer score
+        if max_similarity_score >= self.SIMILARITY_THRESHOLD:
+            return most_similar_answer_idx, "neural", max_similarity_score, utterance_emb
+        return None, "unmatched", max_similarity_score, utterance_emb
+
+    async def _search_faq(self, embeddings: SentenceEmbeddings, graph: CompiledGraph, user_utterance: str, utterance_emb: torch.FloatTensor) -> Union[FAQSearchResult, None]:
+        """ Most similar FAQ question of the whole graph, if it is similar enough """
+        index = self.faq_indices.get(graph.uuid, embeddings.cache_name, embeddings.embedding_dim)
+        await index.refresh(embeddings.embed_texts_numpy)
+        results = index.search(user_utterance, utterance_emb.cpu().numpy(), k=1)
+        if results and results[0].similarity >= self.FAQ_SIMILARITY_THRESHOLD:
+            return results[0]
+        return None
+
     def match_help(self, utterance: str) -> bool:
         if 'help' in utterance:
             return True
@@ -109,9 +320,12 @@ class SimilarityMatchingNLU(Service):
         return []
         # TODO handle times in BST
 
-    def _fill_variable(self, user_id: int, answer_template: str, user_utterance: str, beliefstate: dict, node: DialogNode):
+    async def _fill_variable(self, user_id: int, answer: CompiledAnswer, user_utterance: str, beliefstate: dict, node: CompiledNode, embeddings: SentenceEmbeddings):
         acts = []
-        expected_var = self.templateParser.find_variable(answer_template)
+        if isinstance(answer.variable, type(None)):
+            # parse variable template only once per graph version
+            answer.variable = self.templateParser.find_variable(answer.text)
+        expected_var = answer.variable
         # print(" - requested filling variable", expected_var.name, expected_var.type)
         if expected_var.name and expected_var.type:
             if len(user_utterance.strip()) == 0:
@@ -133,9 +347,9 @@ class SimilarityMatchingNLU(Service):
                     except:
                         acts.append(UserAct(act_type=UserActionType.UnrecognizedValue, slot=expected_var.name, value=user_utterance.strip()))
             elif expected_var.type == "BOOLEAN":
-                utterance_emb = self.embeddings.encode(user_utterance) # 1 x 512
+                utterance_emb = await embeddings.encode(user_utterance) # 1 x 512
                 answers = ["yes", "no"]
-                answer_embs = torch.cat([self.embeddings.encode(answer) for answer in answers], axis=0) # 2 x 512
+                answer_embs = await embeddings.embed_texts(answers) # 2 x 512
                 similarities = cosine_similarity(utterance_emb, answer_embs, -1)
                 most_similar_answer_idx = similarities.argmax(-1).item()
                 max_similarity_score = similarities[most_similar_answer_idx] # top answer score
@@ -204,19 +418,23 @@ class SimilarityMatchingNLU(Service):
 
         return acts
         
-    def log_to_database(self, graph: DialogGraph, user_id: int, usr_utterance: str):
-        ConversationLogEntry(graph=graph, user=user_id, module="INPUT", content=usr_utterance).save()
+    def log_to_database(self, graph: CompiledGraph, user_id: int, usr_utterance: str):
+        ConversationLogEntry(graph_id=graph.uuid, user=user_id, module="INPUT", content=usr_utterance).save()
 
     @PublishSubscribe(sub_topics=["user_utterance", "node_id", "graph_id", "beliefstate"], pub_topics=["user_acts", "beliefstate"], user_id=True)
-    def extract_user_acts(self, user_id: int, graph_id: str, user_utterance: str, node_id: int, beliefstate: dict) -> dict(user_acts=List[UserAct]):
+    async def extract_user_acts(self, user_id: int, graph_id: str, user_utterance: str, node_id: int, beliefstate: dict) -> dict(user_acts=List[UserAct]):
         logging.getLogger('chat').info(f"NLU (user: {user_id}, node: {node_id}) - input: {user_utterance}")
 
-        graph: DialogGraph = DialogGraph.objects.get(uuid=graph_id)
+        graph: CompiledGraph = compiled_graphs.get(graph_id)
+        async with self.embeddings.use(graph.similarity_model) as embeddings:
+            return await self._extract_user_acts(embeddings, graph, user_id, user_utterance, node_id, beliefstate)
+
+    async def _extract_user_acts(self, embeddings: SentenceEmbeddings, graph: CompiledGraph, user_id: int, user_utterance: str, node_id: int, beliefstate: dict) -> dict:
         self.log_to_database(graph, user_id, user_utterance)
 
         acts = []
         beliefstate = self.beliefstate[user_id] | beliefstate
-        current_node = graph.nodes.get(key=node_id)
+        current_node = graph.node(node_id)
         turn = self.turn[user_id]
         self.turn[user_id] = turn + 1
 
@@ -228,7 +446,7 @@ class SimilarityMatchingNLU(Service):
 
         # check if this turn should fill a variable for BST
         if current_node.node_type == NodeType.VARIABLE:
-            acts += self._fill_variable(user_id, current_node.answers.first().text, user_utterance, beliefstate, current_node)
+            acts += await self._fill_variable(user_id, current_node.answers[0], user_utterance, beliefstate, current_node, embeddings)
             logging.getLogger('chat').info(f"NLU (user: {user_id}, node: {node_id}, turn: {turn}) - VAR ACTS: {user_utterance}")
 
         logging.getLogger('chat').info(f"NLU (user: {user_id}, node: {node_id}, turn: {turn}) - BST: {beliefstate}")
@@ -241,16 +459,19 @@ class SimilarityMatchingNLU(Service):
             }
         
         # match user utterance against possible answers
-        utterance_emb = self.embeddings.encode(user_utterance).squeeze(0) #  1 x 512 -> 512
-        answer_embs = self.embeddings.embed_node_answers(current_node) # answers x 512
-        similarities = cosine_similarity(utterance_emb, answer_embs, -1)
-        most_similar_answer_idx = similarities.argmax(-1).item()
-        max_similarity_score = similarities[most_similar_answer_idx] # top answer score
-
-        if max_similarity_score >= self.SIMILARITY_THRESHOLD:
+        answer_idx, tier, score, utterance_emb = await self._match_answer(embeddings, current_node, user_utterance)
+        self._count_match(tier)
+        faq = None
+        if not isinstance(utterance_emb, type(None)):
+            # no obvious answer: the user might have asked one of the graph's FAQ questions instead
+            faq = await self._search_faq(embeddings, graph, user_utterance, utterance_emb)
+        if not isinstance(faq, type(None)) and (isinstance(answer_idx, type(None)) or faq.similarity > score):
+            acts.append(UserAct(text=user_utterance, act_type=UserActionType.FAQ, value=faq.goal_node_key, score=faq.similarity))
+            logging.getLogger('chat').info(f"NLU (user: {user_id}, node: {node_id}, turn: {turn}) - MATCHED FAQ: node {faq.goal_node_key} - SCORE: {faq.similarity}")
+        elif not isinstance(answer_idx, type(None)):
             # found acceptable answer, return top answer
-            acts.append(UserAct(text=current_node.answers.get(index=most_similar_answer_idx).text, act_type=UserActionType.NormalUtterance))
-            logging.getLogger('chat').info(f"NLU (user: {user_id}, node: {node_id}, turn: {turn}) - MATCHED ANSWER: {current_node.answers.get(index=most_similar_answer_idx).text} - SCORE: {max_similarity_score}")
+            acts.append(UserAct(text=current_node.answers[answer_idx].text, act_type=UserActionType.NormalUtterance))
+            logging.getLogger('chat').info(f"NLU (user: {user_id}, node: {node_id}, turn: {turn}) - MATCHED ANSWER: {current_node.answers[answer_idx].text} - TIER: {tier} - SCORE: {score}")
         logging.getLogger('chat').info(f"NLU (user: {user_id}, node: {node_id}, turn: {turn}) - ACTS: {acts}")
 
         self.beliefstate[user_id] = beliefstate
@@ -0,0 +1,226 @@
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+
+
+OPERATORS = ("==", "!=", "<", "<=", ">", ">=")
+EMPTY_ROWS = np.zeros(0, dtype=np.int64)
+EMPTY_CODES = np.zeros(0, dtype=np.int32)
+
+
+def normalize(value: Any) -> str:
+    """ Text comparison key, same semantics as string comparisons in logic templates (see `parsers.logicParser.eq`) """
+    return str(value).lower().strip()
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+
+
+@dataclass(frozen=True)
+class Predicate:
+    """
+    Structured condition on one column of a data table: `<column> <op> <value>`, op in `OPERATORS`.
+    Equality on text cells ignores case and surrounding whitespace (like `==` in logic templates).
+    Texts containing a number (e.g. user input) are compared as numbers against numeric columns.
+    """
+    column: str
+    op: str
+    value: Any
+
+    def __post_init__(self):
+        if not self.op in OPERATORS:
+            raise ValueError(f"Unknown operator {self.op}")
+
+
+def predicates_from_constraints(column_constraints: Dict[str, Any]) -> List[Predicate]:
+    """ Column constraints as passed from templates (`Table.column(key=value)`): a value (equality) or a tuple (operator, value) per column """
+    predicates = []
+    for column, value in column_constraints.items():
+        if isinstance(value, Predicate):
+            predicates.append(value)
+        elif isinstance(value, tuple):
+            predicates.append(Predicate(column, value[0], value[1]))
+        else:
+            predicates.append(Predicate(column, "==", value))
+    return predicates
+
+
+class TextColumn:
+    """
+    Dictionary encoded text column: one int32 code per row (-1: missing) into the sorted distinct texts.
+    Constraints are matched against the dictionary and turned into codes, only projected rows are decoded,
+    so the codes can stay memory-mapped (see `columnarTables.read_columns`).
+    """
+    __slots__ = ('codes', 'dictionary')
+
+    def __init__(self, codes: np.ndarray, dictionary: List[str]) -> None:
+        self.codes = codes
+        self.dictionary = dictionary
+
+    @classmethod
+    def from_unsorted(cls, codes: np.ndarray, texts: List[str]) -> "TextColumn":
+        """ From codes into distinct texts in any order (e.g. first occurrence, see `tableUpload.ColumnCells`) """
+        order = sorted(range(len(texts)), key=texts.__getitem__)
+        remap = np.full(len(texts) + 1, -1, dtype=np.int32) # code -1 (missing) maps to the trailing -1
+        remap[order] = np.arange(len(texts), dtype=np.int32)
+        return cls(remap[codes], [texts[code] for code in order])
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def rows(self, codes: np.ndarray) -> np.ndarray:
+        """ Indices (ascending) of all rows with one of the given codes """
+        if len(codes) == 0:
+            return EMPTY_ROWS
+        if len(codes) == 1:
+            return np.flatnonzero(self.codes == codes[0])
+        return np.flatnonzero(np.isin(self.codes, codes))
+
+    def code_range(self, start: int, stop: int) -> np.ndarray:
+        """ Indices (ascending) of all rows with a code in [start, stop), i.e. a text in that range of the sorted dictionary """
+        if start >= stop:
+            return EMPTY_ROWS
+        return np.flatnonzero((self.codes >= start) & (self.codes < stop))
+
+    def take(self, rows: np.ndarray) -> List[Any]:
+        """ Texts of the given rows (NaN: missing, like in pandas' object columns) """
+        return [self.dictionary[code] if code >= 0 else np.nan for code in self.codes[rows].tolist()]
+
+
+# a table column: numeric array or dictionary encoded texts
+Column = Union[np.ndarray, TextColumn]
+
+
+class ColumnIndex:
+    """
+    Lookup structures of one table column, built on first use.
+    Numeric columns: hash index (value -> row indices) for equality and the sorted column values (+ their row indices) for comparisons.
+    Text columns: constraints are matched against the dictionary (normalized text -> codes for equality, the sorted texts for comparisons),
+    the rows are then found by their codes.
+    """
+    __slots__ = ('values', 'numeric', 'positions', 'text_codes', 'sorted_values', 'sorted_rows')
+
+    def __init__(self, values: Column) -> None:
+        self.values = values
+        self.numeric = not isinstance(values, TextColumn)
+        self.positions = None   # value -> rows (numeric columns)
+        self.text_codes = None  # normalized text -> codes (text columns)
+        self.sorted_values = None
+        self.sorted_rows = None
+
+    def _coerce(self, value: Any) -> Any:
+        if self.numeric and isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                return None
+        return value
+
+    def equal(self, value: Any) -> np.ndarray:
+        """ Indices (ascending) of all rows whose value equals `value` """
+        if not self.numeric:
+            if isinstance(self.text_codes, type(None)):
+                text_codes: Dict[str, List[int]] = {}
+                for code, text in enumerate(self.values.dictionary):
+                    text_codes.setdefault(normalize(text), []).append(code)
+                self.text_codes = {text: np.array(codes, dtype=np.int32) for text, codes in text_codes.items()}
+            return self.values.rows(self.text_codes.get(normalize(value), EMPTY_CODES))
+        if isinstance(self.positions, type(None)):
+            positions: Dict[Any, List[int]] = {}
+            for row, cell in enumerate(self.values.tolist()):
+                if cell == cell: # skip NaN (never equal to anything)
+                    positions.setdefault(cell, []).append(row)
+            self.positions = {cell: np.array(rows, dtype=np.int64) for cell, rows in positions.items()}
+        try:
+            return self.positions.get(self._coerce(value), EMPTY_ROWS)
+        except TypeError: # unhashable value
+            return EMPTY_ROWS
+
+    def compare(self, op: str, value: Any) -> np.ndarray:
+        """ Indices (ascending) of all rows whose value `op` `value` holds, op in <, <=, >, >= """
+        if not op in ("<", "<=", ">", ">="):
+            raise ValueError(f"Unknown comparison {op}")
+        if not self.numeric:
+            if not isinstance(value, str):
+                return EMPTY_ROWS # texts are only comparable to texts
+            dictionary = self.values.dictionary
+            if op == "<":
+                return self.values.code_range(0, bisect_left(dictionary, value))
+            if op == "<=":
+                return self.values.code_range(0, bisect_right(dictionary, value))
+            if op == ">":
+                return self.values.code_range(bisect_right(dictionary, value), len(dictionary))
+            return self.values.code_range(bisect_left(dictionary, value), len(dictionary))
+        if isinstance(self.sorted_values, type(None)):
+            valid = np.flatnonzero(~np.isnan(self.values)) if self.values.dtype.kind == "f" else np.arange(len(self.values))
+            order = np.argsort(self.values[valid], kind="stable")
+            self.sorted_rows = valid[order]
+            self.sorted_values = self.values[self.sorted_rows]
+        value = self._coerce(value)
+        if len(self.sorted_values) == 0 or not _is_number(value):
+            return EMPTY_ROWS # numbers are only comparable to numbers
+        if op == "<":
+            rows = self.sorted_rows[:np.searchsorted(self.sorted_values, value, side="left")]
+        elif op == "<=":
+            rows = self.sorted_rows[:np.searchsorted(self.sorted_values, value, side="right")]
+        elif op == ">":
+            rows = self.sorted_rows[np.searchsorted(self.sorted_values, value, side="right"):]
+        else:
+            rows = self.sorted_rows[np.searchsorted(self.sorted_values, value, side="left"):]
+        return np.sort(rows)
+
+
+class TableQuery:
+    """
+    Evaluates predicates over the columns of a table as boolean masks (one entry per row).
+    The masks of all predicates of a constraint set are combined with AND; masks are memoized per predicate,
+    so predicates shared by several constraint sets (see `select_many`) are evaluated only once.
+    """
+    def __init__(self, columns: Dict[str, Column], num_rows: int, indices: Union[Dict[str, ColumnIndex], None] = None) -> None:
+        self.columns = columns
+        self.num_rows = num_rows
+        self.indices = indices if not isinstance(indices, type(None)) else {}
+        self.masks: Dict[Tuple[str, str, Any], np.ndarray] = {}
+
+    def index(self, column: str) -> ColumnIndex:
+        if not column in self.indices:
+            self.indices[column] = ColumnIndex(self.columns[column])
+        return self.indices[column]
+
+    def mask(self, predicate: Predicate) -> np.ndarray:
+        try:
+            key = (predicate.column, predicate.op, predicate.value)
+            hash(key)
+        except TypeError:
+            key = None
+        if not isinstance(key, type(None)) and key in self.masks:
+            return self.masks[key]
+        index = self.index(predicate.column)
+        mask = np.zeros(self.num_rows, dtype=bool)
+        if predicate.op in ("==", "!="):
+            mask[index.equal(predicate.value)] = True
+            if predicate.op == "!=":
+                mask = ~mask
+        else:
+            mask[index.compare(predicate.op, predicate.value)] = True
+        if not isinstance(key, type(None)):
+            self.masks[key] = mask
+        return mask
+
+    def select(self, predicates: Iterable[Predicate]) -> np.ndarray:
+        """ Indices (ascending) of all rows satisfying all predicates """
+        mask = None
+        for predicate in predicates:
+            mask = self.mask(predicate) if isinstance(mask, type(None)) else mask & self.mask(predicate)
+        return np.arange(self.num_rows) if isinstance(mask, type(None)) else np.flatnonzero(mask)
+
+    def select_many(self, constraint_sets: Iterable[Iterable[Predicate]]) -> List[np.ndarray]:
+        """ Row indices for each constraint set (batch evaluation, e.g. one lookup per item of a list) """
+        return [self.select(predicates) for predicates in constraint_sets]
+
+    def project(self, rows: np.ndarray, columns: List[str]) -> List[Dict[str, Any]]:
+        values = [self.columns[col].take(rows) if isinstance(self.columns[col], TextColumn) else self.columns[col][rows].tolist() for col in columns]
+        return [dict(zip(columns, row)) for row in zip(*values)]
@@ -0,0 +1,229 @@
+from array import array
+import csv
+from io import StringIO
+from tempfile import SpooledTemporaryFile
+import time
+from typing import Dict, List, Union
+import uuid
+
+import numpy as np
+
+from apps.diagraph.tableQuery import Column, TextColumn
+
+
+# inferred column types, ordered from most to least specific (a column only ever widens)
+INT = "int"
+FLOAT = "float"
+TEXT = "text"
+_WIDTH = {INT: 0, FLOAT: 1, TEXT: 2}
+
+
+def _cell_type(cell: str) -> Union[str, None]:
+    """ Narrowest type a single CSV cell parses as (None: empty cell) """
+    cell = cell.strip()
+    if not cell:
+        return None
+    try:
+        int(cell)
+        return INT
+    except ValueError:
+        pass
+    try:
+        float(cell)
+        return FLOAT
+    except ValueError:
+        return TEXT
+
+
+class TableFormatError(Exception):
+    pass
+
+
+class ColumnCells:
+    """
+    Cells of one column, dictionary encoded while parsing: one int32 code per row (-1: empty cell) and every distinct cell text once,
+    so a parsed column needs 4 bytes per row instead of one string per cell
+    """
+    def __init__(self) -> None:
+        self.codes = array('i')
+        self.texts: List[str] = [] # code -> cell text
+        self.lookup: Dict[str, int] = {} # cell text -> code
+
+    def add(self, cell: str) -> Union[str, None]:
+        """ Adds the next cell, returns its type if the cell text wasn't seen before in this column (None otherwise) """
+        code = self.lookup.get(cell)
+        if not isinstance(code, type(None)):
+            self.codes.append(code)
+            return None
+        cell_type = _cell_type(cell)
+        if not cell_type:
+            self.codes.append(-1)
+            return None
+        code = len(self.texts)
+        self.lookup[cell] = code
+        self.texts.append(cell)
+        self.codes.append(code)
+        return cell_type
+
+    def code_array(self) -> np.ndarray:
+        return np.frombuffer(self.codes, dtype=np.intc).astype(np.int32) if len(self.codes) else np.zeros(0, dtype=np.int32)
+
+
+class StreamingTableParser:
+    """
+    Parses a `;`-separated CSV table (as stored in `DataTable.content`) chunk by chunk.
+    Only complete records are parsed, the remainder is kept until the next chunk arrives (also inside quoted fields).
+    Column types are inferred incrementally from every distinct cell: int -> float -> text.
+    The cells are kept dictionary encoded per column (see `ColumnCells`), so typed column arrays can be built without parsing again (see `typed_columns`).
+    """
+    def __init__(self, delimiter: str = ";") -> None:
+        self.delimiter = delimiter
+        self.columns: Union[List[str], None] = None
+        self.types: List[Union[str, None]] = [] # None: no value seen yet
+        self.cells: List[ColumnCells] = []
+        self.num_rows = 0
+        self.pending = ""
+
+    def feed(self, chunk: str):
+        text = self.pending + chunk
+        end = self._complete_records(text)
+        self.pending = text[end:]
+        if end > 0:
+            self._parse(text[:end])
+
+    def close(self):
+        """ Parse the last record (if the data doesn't end with a newline) """
+        if self.pending.strip():
+            if self.pending.count('"') % 2:
+                raise TableFormatError("Unterminated quoted field")
+            self._parse(self.pending)
+        self.pending = ""
+        if isinstance(self.columns, type(None)):
+            raise TableFormatError("Missing header")
+
+    def column_types(self) -> Dict[str, str]:
+        """ Inferred type per column, columns without any value count as text """
+        return {column: col_type if col_type else TEXT for column, col_type in zip(self.columns or [], self.types)}
+
+    def typed_columns(self) -> Dict[str, Column]:
+        """
+        One column per inferred type: int64 array (float64 if cells are missing), float64 array (NaN: missing)
+        or `TextColumn` (dictionary encoded texts, code -1: missing).
+        Every distinct cell text is converted once, the rows are filled in from the codes.
+        """
+        columns = {}
+        for column, col_type, cells in zip(self.columns or [], self.types, self.cells):
+            codes = cells.code_array()
+            if col_type == INT and not (codes < 0).any():
+                try:
+                    columns[column] = np.array([int(text) for text in cells.texts], dtype=np.int64)[codes]
+                    continue
+                except OverflowError:
+                    pass
+            if col_type in (INT, FLOAT):
+                # code -1 (missing) picks the trailing NaN
+                columns[column] = np.array([float(text) for text in cells.texts] + [np.nan], dtype=np.float64)[codes]
+            else:
+                columns[column] = TextColumn.from_unsorted(codes, cells.texts)
+        return columns
+
+    def _complete_records(self, text: str) -> int:
+        """ End of the last newline outside of quotes (0 if there is none) """
+        end = text.rfind("\n")
+        quotes = text.count('"', 0, end) if end >= 0 else 0
+        while end >= 0 and quotes % 2:
+            previous = text.rfind("\n", 0, end)
+            quotes -= text.count('"', max(previous, 0), end)
+            end = previous
+        return end + 1
+
+    def _parse(self, text: str):
+        try:
+            for row in csv.reader(StringIO(text), delimiter=self.delimiter):
+                self._add_row(row)
+        except csv.Error as error: # e.g. NUL bytes or misplaced quotes
+            raise TableFormatError(f"Row {self.num_rows + 1}: {error}")
+
+    def _add_row(self, row: List[str]):
+        if not row:
+            return
+        if isinstance(self.columns, type(None)):
+            self.columns = row
+            self.types = [None] * len(row)
+            self.cells = [ColumnCells() for _ in row]
+            return
+        if len(row) > len(self.columns): # missing trailing fields are empty (like in pandas)
+            raise TableFormatError(f"Row {self.num_rows + 1} has {len(row)} instead of {len(self.columns)} fields")
+        for col, cells in enumerate(self.cells):
+            cell_type = cells.add(row[col] if col < len(row) else "")
+            if cell_type and (isinstance(self.types[col], type(None)) or _WIDTH[cell_type] > _WIDTH[self.types[col]]):
+                self.types[col] = cell_type
+        self.num_rows += 1
+
+
+# raw CSV text of an upload is kept in memory up to this size, larger uploads are spilled to a temporary file
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+
+
+class TableUpload:
+    """
+    State of one chunked data table upload (see `DialogDesigner.on_datatable_upload_start`).
+    Chunks are parsed into dictionary encoded columns as they arrive (stored as typed columns on commit),
+    the raw CSV text is only spooled for `DataTable.content`.
+    """
+    def __init__(self, graph_id: str, name: str, size_limit: Union[int, None]) -> None:
+        self.upload_id = uuid.uuid4().hex
+        self.graph_id = graph_id
+        self.name = name
+        self.size_limit = size_limit
+        self.size = 0 # bytes received
+        self.raw = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, mode="w+", encoding="utf-8", newline="")
+        self.parser = StreamingTableParser()
+        self.last_activity = time.monotonic()
+
+    def add_chunk(self, data: str):
+        self.size += len(data.encode("utf-8"))
+        if not isinstance(self.size_limit, type(None)) and self.size > self.size_limit:
+            raise TableFormatError(f"Data table exceeds the upload limit of {self.size_limit} bytes")
+        self.parser.feed(data)
+        self.raw.write(data)
+        self.last_activity = time.monotonic()
+
+    def content(self) -> str:
+        self.parser.close()
+        self.raw.seek(0)
+        return self.raw.read()
+
+    def discard(self):
+        """ Releases the spooled CSV text (the parsed columns stay available) """
+        self.raw.close()
+
+
+class TableUploads:
+    """ Uploads in progress (upload id -> `TableUpload`), uploads without activity for `timeout` seconds are dropped """
+    def __init__(self, timeout: float = 600.0) -> None:
+        self.timeout = timeout
+        self.uploads: Dict[str, TableUpload] = {}
+
+    def start(self, graph_id: str, name: str, size_limit: Union[int, None]) -> TableUpload:
+        self.expire()
+        upload = TableUpload(graph_id=graph_id, name=name, size_limit=size_limit)
+        self.uploads[upload.upload_id] = upload
+        return upload
+
+    def get(self, upload_id: str) -> Union[TableUpload, None]:
+        self.expire()
+        return self.uploads.get(upload_id)
+
+    def pop(self, upload_id: str) -> Union[TableUpload, None]:
+        return self.uploads.pop(upload_id, None)
+
+    def abort(self, upload_id: str):
+        upload = self.pop(upload_id)
+        if not isinstance(upload, type(None)):
+            upload.discard()
+
+    def expire(self):
+        now = time.monotonic()
+        for upload_id in [upload_id for upload_id, upload in self.uploads.items() if now - upload.last_activity > self.timeout]:
+            self.abort(upload_id)
@@ -106,22 +106,42 @@ def _init_django():
     # import sys
     # execute_from_command_line(sys.argv)
 
+def _parse_backends(backends: str):
+    """ "model_a=onnx,model_b=onnx-int8" -> {"model_a": "onnx", "model_b": "onnx-int8"} """
+    return dict(entry.strip().rsplit("=", 1) for entry in backends.split(",") if "=" in entry)
+
 def load_tree_policy():
     _init_django()
 
-    from apps.diagraph.similarityMatchingNLU import SimilarityMatchingNLU, SentenceEmbeddings
+    from apps.diagraph.similarityMatchingNLU import SimilarityMatchingNLU, EmbeddingModelPool
     from apps.diagraph.dialogTreePolicy import DialogTreePolicy
     from apps.diagraph.domain import TreeDomain
     from apps.diagraph.dialogdesigner import DialogDesigner
+    from apps.diagraph.graphWarmup import GraphWarmup
 
 
     domain = TreeDomain("tree")
-    embeddings = SentenceEmbeddings(device='cpu') # TODO make embedding name configurable via UI / console
+    # one sentence embedding model per graph (DialogGraphSettings.similarity_model), loaded on demand;
+    # transformer inference runs in worker threads / processes, so the event loop isn't blocked
+    embeddings = EmbeddingModelPool(device='cpu',
+                                    memory_budget_mb=int(os.environ.get('SIMILARITY_MODEL_MEMORY_BUDGET_MB', 4096)),
+                                    executor_kind=os.environ.get('INFERENCE_EXECUTOR', 'thread'),
+                                    workers=int(os.environ.get('INFERENCE_WORKERS', 1)),
+                                    max_queue=int(os.environ.get('INFERENCE_MAX_QUEUE', 64)),
+                                    max_batch_size=int(os.environ.get('ENCODER_MAX_BATCH_SIZE', 32)),
+                                    max_wait_ms=float(os.environ.get('ENCODER_MAX_WAIT_MS', 5.0)),
+                                    default_backend=os.environ.get('INFERENCE_BACKEND', 'torch'),
+                                    backends=_parse_backends(os.environ.get('INFERENCE_BACKENDS', '')),
+                                    onnx_threads=int(os.environ.get('ONNX_THREADS', 1)))
     designer = DialogDesigner(transports=f"ws://{ROUTER_HOST}:{ROUTER_PORT}/ws")
     nlu = SimilarityMatchingNLU(embeddings=embeddings, domain=domain, transports=f"ws://{ROUTER_HOST}:{ROUTER_PORT}/ws")
     policy = DialogTreePolicy(domain=domain, transports=f"ws://{ROUTER_HOST}:{ROUTER_PORT}/ws")
+    # compile graphs and embed their answers / FAQs in the background, most active graphs first
+    warmup = GraphWarmup(nlu=nlu, hot_graphs=int(os.environ.get('WARMUP_HOT_GRAPHS', 10)), max_graphs=int(os.environ.get('WARMUP_MAX_GRAPHS', -1)),
+                         ready_file=os.environ.get('WARMUP_READY_FILE') or None, timeout=float(os.environ.get('WARMUP_TIMEOUT_S', 900)),
+                         transports=f"ws://{ROUTER_HOST}:{ROUTER_PORT}/ws")
 
-    return domain, [nlu, policy, designer]
+    return domain, [nlu, policy, designer, warmup]
 
 
 if __name__ == "__main__":
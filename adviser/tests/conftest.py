@@ -0,0 +1,7 @@
+import os
+import sys
+
+
+# tests import the adviser packages (`apps`, `tools`, ...) like `run_dialogsystem.py`
+ADVISER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ADVISER_DIR)
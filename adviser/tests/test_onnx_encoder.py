@@ -0,0 +1,45 @@
+"""
+Parity of the ONNX Runtime backends (fp32 and int8-quantized export) with the PyTorch sentence encoder,
+see `tools/benchmark_onnx_encoder.py` for the latency benchmark. Skipped if torch / onnxruntime aren't installed.
+"""
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("sentence_transformers")
+
+from apps.diagraph.onnxEncoder import OnnxSentenceEncoder, export_onnx, onnx_model_dir
+from tools.benchmark_onnx_encoder import MIN_COSINE, MIN_TOP1, load_faq_questions, load_texts, parity
+
+
+ADVISER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = os.environ.get('ONNX_PARITY_MODEL', 'distiluse-base-multilingual-cased')
+GRAPH = os.path.join(os.path.dirname(ADVISER_DIR), 'graph_05_01_2025.json')
+MODEL_CACHE = os.path.join(ADVISER_DIR, '.models')
+
+
+@pytest.fixture(scope="module")
+def torch_encode():
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(MODEL, device='cpu', cache_folder=MODEL_CACHE)
+    return lambda texts: model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+
+
+@pytest.fixture(scope="module")
+def graph_texts():
+    return load_texts(GRAPH), load_faq_questions(GRAPH)
+
+
+@pytest.mark.parametrize("quantized", [False, True], ids=["onnx", "onnx-int8"])
+def test_onnx_parity(torch_encode, graph_texts, quantized):
+    model_dir = onnx_model_dir(MODEL, cache_dir=os.path.join(MODEL_CACHE, 'onnx'))
+    export_onnx(MODEL, model_dir, quantize=quantized, cache_folder=MODEL_CACHE)
+    encoder = OnnxSentenceEncoder(model_dir, quantized=quantized, num_threads=1)
+
+    answers_per_node, faq_questions = graph_texts
+    result = parity(encoder.encode, torch_encode, answers_per_node, faq_questions)
+    assert result["cosine"] >= MIN_COSINE, result
+    assert result["top1"] >= MIN_TOP1, result
+    assert result["faq_top1"] >= MIN_TOP1, result
@@ -0,0 +1,57 @@
+"""
+Counts the database queries (and time) of `DialogGraph.fromJSON` for a graph export: first import and re-import over the existing graph.
+Everything runs in a transaction that is rolled back, so the database is left unchanged.
+The script fails if an import needs more than --max_queries queries (-1: no limit), e.g. as a check in CI;
+the fixed query count itself is tested in `apps/diagraph/data/tests.py` (`manage.py test data`).
+
+Usage (from the adviser directory, with the database of `run_dialogsystem.py`):
+    python -m tools.benchmark_graph_import --graph ../graph_05_01_2025.json
+"""
+import argparse
+import json
+import sys
+import time
+
+
+class Rollback(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query count of the graph import')
+    parser.add_argument('--graph', default='../graph_05_01_2025.json', help="dialog graph (json) exported from the dialog designer")
+    parser.add_argument('--max_queries', type=int, default=40, help="fail if an import issues more queries (-1: no limit)")
+    args = parser.parse_args()
+
+    from run_dialogsystem import _init_django
+    _init_django()
+    from django.contrib.auth.models import User
+    from django.db import connection, transaction
+    from django.test.utils import CaptureQueriesContext
+    from apps.diagraph.data.dialogGraph import DialogGraph
+
+    with open(args.graph) as f:
+        data = json.load(f)
+    print(f"{len(data['nodes'])} nodes, {len(data['connections'])} connections")
+
+    results = []
+    try:
+        with transaction.atomic():
+            user = User.objects.create(username="__benchmark_graph_import__")
+            for run in ("import", "re-import"):
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    DialogGraph.fromJSON(graph_name="benchmark", owner=user, data=data)
+                    elapsed = time.perf_counter() - start
+                results.append((run, len(queries.captured_queries), elapsed))
+            raise Rollback()
+    except Rollback:
+        pass
+
+    failed = False
+    for run, num_queries, elapsed in results:
+        print(f"{run:10s} {num_queries} queries, {elapsed * 1000:.0f} ms")
+        failed = failed or (args.max_queries >= 0 and num_queries > args.max_queries)
+    if failed:
+        print(f"More than {args.max_queries} queries")
+        sys.exit(1)
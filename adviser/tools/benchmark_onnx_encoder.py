@@ -0,0 +1,140 @@
+"""
+Compares the ONNX Runtime backends of the sentence encoder with the PyTorch model:
+- parity: cosine similarity of the embeddings, agreement of the answer rankings (top-1 and full ranking) and of the top FAQ question
+- latency: mean / p95 time per batch
+Fails (exit code 1) if an ONNX backend's top-1 agreement or mean cosine to torch is below --min_top1 / --min_cosine
+(the same check runs in `tests/test_onnx_encoder.py`).
+
+Usage (from the adviser directory):
+    python -m tools.benchmark_onnx_encoder --model distiluse-base-multilingual-cased --graph ../graph_05_01_2025.json
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from apps.diagraph.onnxEncoder import OnnxSentenceEncoder, export_onnx, onnx_model_dir
+
+
+# minimum agreement of the ONNX backends (fp32 and int8) with torch
+MIN_TOP1 = 0.97
+MIN_COSINE = 0.98
+
+
+def load_texts(graph_file: str):
+    """ Answer texts per node (candidates) of a dialog graph exported from the dialog designer """
+    with open(graph_file) as f:
+        data = json.load(f)
+    answers_per_node = []
+    for node in data['nodes']:
+        answers = [answer['text'].strip() for answer in node['data'].get('answers', [])]
+        answers = [answer for answer in answers if answer and not "{{" in answer]
+        if len(answers) > 1:
+            answers_per_node.append(answers)
+    return answers_per_node
+
+
+def load_faq_questions(graph_file: str):
+    """ FAQ questions of all nodes of a dialog graph exported from the dialog designer """
+    with open(graph_file) as f:
+        data = json.load(f)
+    questions = [question['text'].strip() for node in data['nodes'] for question in node['data'].get('questions', [])]
+    return sorted(set(question for question in questions if question))
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-12)
+
+
+def rankings(queries: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    return np.argsort(-normalize(queries) @ normalize(candidates).T, axis=-1)
+
+
+def parity(encode, reference_encode, answers_per_node, faq_questions):
+    """
+    Agreement of an encoder with the reference (torch) encoder:
+    mean cosine of the embeddings, top-1 / full agreement of the answer rankings per node (queries: answers as typed user input)
+    and top-1 agreement of the FAQ search (queries: FAQ questions as typed user input, candidates: all FAQ questions)
+    """
+    answer_queries = [answer.lower().rstrip("?.!") for answers in answers_per_node for answer in answers]
+    faq_queries = [question.lower().rstrip("?.!") for question in faq_questions]
+    texts = sorted(set(answer for answers in answers_per_node for answer in answers)) + faq_questions + answer_queries + faq_queries
+    embeddings = dict(zip(texts, encode(texts)))
+    reference = dict(zip(texts, reference_encode(texts)))
+    cosine = float(np.mean([normalize(embeddings[text]) @ normalize(reference[text]) for text in texts]))
+    top1 = []
+    full = []
+    for answers in answers_per_node:
+        for query in [answer.lower().rstrip("?.!") for answer in answers]:
+            ranking = rankings(np.stack([embeddings[query]]), np.stack([embeddings[answer] for answer in answers]))[0]
+            reference_ranking = rankings(np.stack([reference[query]]), np.stack([reference[answer] for answer in answers]))[0]
+            top1.append(ranking[0] == reference_ranking[0])
+            full.append((ranking == reference_ranking).all())
+    faq_top1 = []
+    if faq_questions:
+        faq_ranking = rankings(np.stack([embeddings[query] for query in faq_queries]), np.stack([embeddings[question] for question in faq_questions]))[:, 0]
+        reference_faq_ranking = rankings(np.stack([reference[query] for query in faq_queries]), np.stack([reference[question] for question in faq_questions]))[:, 0]
+        faq_top1 = faq_ranking == reference_faq_ranking
+    return {"cosine": cosine,
+            "top1": float(np.mean(top1)) if top1 else 1.0,
+            "ranking": float(np.mean(full)) if full else 1.0,
+            "faq_top1": float(np.mean(faq_top1)) if len(faq_top1) else 1.0}
+
+
+def time_encoder(encode, texts, batch_size: int, repeats: int):
+    timings = []
+    for _ in range(repeats):
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start+batch_size]
+            begin = time.perf_counter()
+            encode(batch)
+            timings.append(time.perf_counter() - begin)
+    timings = np.array(timings) * 1000
+    return timings.mean(), np.percentile(timings, 95)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ONNX sentence encoder parity + latency benchmark')
+    parser.add_argument('--model', default='distiluse-base-multilingual-cased')
+    parser.add_argument('--graph', default='../graph_05_01_2025.json', help="dialog graph (json) providing answer texts")
+    parser.add_argument('--threads', type=int, default=1, help="onnxruntime / torch threads")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--min_top1', type=float, default=MIN_TOP1, help="minimum top-1 answer / FAQ agreement with torch (onnx, onnx-int8)")
+    parser.add_argument('--min_cosine', type=float, default=MIN_COSINE, help="minimum mean cosine similarity to the torch embeddings (onnx, onnx-int8)")
+    args = parser.parse_args()
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(args.threads)
+
+    answers_per_node = load_texts(args.graph)
+    texts = sorted(set(answer for answers in answers_per_node for answer in answers))
+    # queries: answers with some noise, like typed user input
+    queries = [answers[i].lower().rstrip("?.!") for answers in answers_per_node for i in range(len(answers))]
+    print(f"{len(texts)} answer texts, {len(answers_per_node)} nodes with > 1 answer, {len(queries)} queries")
+
+    torch_model = SentenceTransformer(args.model, device='cpu', cache_folder='.models')
+    encoders = {'torch': lambda batch: torch_model.encode(batch, convert_to_numpy=True, show_progress_bar=False)}
+    model_dir = onnx_model_dir(args.model)
+    for backend, quantized in [('onnx', False), ('onnx-int8', True)]:
+        export_onnx(args.model, model_dir, quantize=quantized)
+        encoders[backend] = OnnxSentenceEncoder(model_dir, quantized=quantized, num_threads=args.threads).encode
+
+    faq_questions = load_faq_questions(args.graph)
+    failures = []
+    for backend, encode in encoders.items():
+        result = parity(encode, encoders['torch'], answers_per_node, faq_questions)
+        mean_ms, p95_ms = time_encoder(encode, queries, args.batch_size, args.repeats)
+        print(f"{backend:10s} cosine to torch: {result['cosine']:.5f}  top-1 agreement: {result['top1']:.3f}  ranking agreement: {result['ranking']:.3f}  "
+              f"FAQ top-1 agreement: {result['faq_top1']:.3f}  latency (batch {args.batch_size}): mean {mean_ms:.1f} ms, p95 {p95_ms:.1f} ms")
+        if backend != 'torch':
+            for metric, threshold in [('top1', args.min_top1), ('faq_top1', args.min_top1), ('cosine', args.min_cosine)]:
+                if result[metric] < threshold:
+                    failures.append(f"{backend}: {metric} {result[metric]:.5f} < {threshold}")
+
+    if failures:
+        print("Parity check failed:\n" + "\n".join(failures))
+        sys.exit(1)
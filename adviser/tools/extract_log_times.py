@@ -0,0 +1,52 @@
+"""
+Extracts time points / time spans from all logged user inputs (`ConversationLogEntry` rows of module INPUT) and writes them as JSON lines.
+Rows are streamed from the database and results are written as they arrive, so memory use doesn't grow with the size of the log table.
+
+Usage (from the adviser directory, with the database of `run_dialogsystem.py`):
+    python -m tools.extract_log_times --output log_times.jsonl --processes 4 --reference_date 2025-01-05
+"""
+import argparse
+import datetime
+import json
+import time
+from collections import deque
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time extraction over logged user inputs')
+    parser.add_argument('--output', default='log_times.jsonl')
+    parser.add_argument('--graph', default=None, help="only inputs of this graph (uuid)")
+    parser.add_argument('--reference_date', default=None, help="resolve relative words ('morgen') from this date (YYYY-MM-DD), default: today")
+    parser.add_argument('--processes', type=int, default=0, help="worker processes (0: extract in this process)")
+    parser.add_argument('--chunk_size', type=int, default=256)
+    args = parser.parse_args()
+
+    from run_dialogsystem import _init_django
+    _init_django()
+    from apps.diagraph.data.dialogGraph import ConversationLogEntry
+    from apps.diagraph.nlu import NLU
+
+    reference_date = datetime.date.fromisoformat(args.reference_date) if args.reference_date else None
+    rows = ConversationLogEntry.objects.filter(module="INPUT")
+    if args.graph:
+        rows = rows.filter(graph_id=args.graph)
+    rows = rows.order_by('log_index').values_list('log_index', 'graph_id', 'content').iterator(chunk_size=2000)
+
+    keys = deque()
+    def utterances():
+        for log_index, graph_id, content in rows:
+            keys.append((log_index, str(graph_id)))
+            yield content
+
+    start = time.perf_counter()
+    num_rows = 0
+    nlu = NLU()
+    with open(args.output, "w") as f:
+        for times in nlu.extract_times(utterances(), reference_date=reference_date, processes=args.processes, chunk_size=args.chunk_size):
+            # results arrive in input order, `keys` only holds the rows still in flight
+            log_index, graph_id = keys.popleft()
+            f.write(json.dumps({"log_index": log_index, "graph": graph_id, **times}, default=str) + "\n")
+            num_rows += 1
+            if num_rows % 100000 == 0:
+                print(f"{num_rows} inputs, {num_rows / (time.perf_counter() - start):.0f} inputs/s")
+    print(f"Processed {num_rows} inputs in {time.perf_counter() - start:.1f}s (cache: {nlu.cache_info()})")
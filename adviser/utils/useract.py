@@ -44,6 +44,7 @@ class UserActionType(Enum):
     SelectDomain = 'selectdomain'
 
     NormalUtterance = 'normal'
+    FAQ = 'faq' # value: key of the node answering the question
     UnrecognizedValue = 'unrecognized_value'
     TooManyValues = 'toomany_values'
 